@@ -305,6 +305,20 @@ def parseExptConfig(configFile, librariesToSublibrariesDict):
         else:
             warningString += 'No pseudogene size provided\n'
 
+    if parser.has_option('gene_analysis','pseudogene_seed'):
+        try:
+            pseudogeneSeed = parser.getint('gene_analysis','pseudogene_seed')
+            if pseudogeneSeed < 0 or pseudogeneSeed >= 2**32:
+                warningString += 'Pseudogene seed must be between 0 and 2**32 - 1\n'
+                exitStatus += 1
+            else:
+                paramDict['pseudogene_seed'] = pseudogeneSeed
+        except ValueError:
+            warningString += 'Pseudogene seed entry not a recognized integer value\n'
+            exitStatus += 1
+    else:
+        paramDict['pseudogene_seed'] = None
+
     #list possible analyses in param dict as dictionary with keys = analysis and values = analysis-specific params
     
     paramDict['analyses'] = dict()
@@ -364,6 +378,43 @@ def parseExptConfig(configFile, librariesToSublibrariesDict):
     else:
         warningString += 'Nth best sgRNA analysis not specified, defaulting to False\n'
 
+    #empirical p-values and FDRs of the average of best n, from resampled negative controls
+    if parser.has_option('gene_analysis','calculate_empirical'):
+        try:
+            if parser.getboolean('gene_analysis','calculate_empirical') == True:
+                paramDict['analyses']['calculate_empirical'] = []
+        except ValueError:
+            warningString += 'Calculate empirical entry not a recognized boolean value\n'
+            exitStatus += 1
+
+        if 'calculate_empirical' in paramDict['analyses']:
+            if parser.has_option('gene_analysis','best_n'):
+                try:
+                    paramDict['analyses']['calculate_empirical'].append(parser.getint('gene_analysis','best_n'))
+                except ValueError:
+                    warningString += 'Best_n entry not a recognized integer value\n'
+                    exitStatus += 1
+            else:
+                warningString += 'No best_n value provided for empirical analysis function\n'
+                exitStatus += 1
+
+            if parser.has_option('gene_analysis','empirical_draws'):
+                try:
+                    empiricalDraws = parser.getint('gene_analysis','empirical_draws')
+                    if empiricalDraws < 1:
+                        warningString += 'Empirical draws must be at least 1\n'
+                        exitStatus += 1
+                    else:
+                        paramDict['analyses']['calculate_empirical'].append(empiricalDraws)
+                except ValueError:
+                    warningString += 'Empirical draws entry not a recognized integer value\n'
+                    exitStatus += 1
+            else:
+                paramDict['analyses']['calculate_empirical'].append(100000)
+                warningString += 'Empirical draws defaulting to 100000\n'
+    else:
+        warningString += 'Empirical analysis not specified, defaulting to False\n'
+
 
     if len(paramDict['analyses']) == 0:
         warningString += 'No analyses selected to compute gene scores\n' #should this raise exitStatus?
@@ -7,16 +7,39 @@ import multiprocessing
 import fnmatch
 import glob
 import argparse
+import collections
+import shutil
+import itertools
+import heapq
+import operator
+import io
+import zlib
+import struct
+import subprocess
+import multiprocessing.pool
+import distutils.spawn
+import json
+import hashlib
+import time
+import datetime
+import numpy as np
 
 ### Sequence File to Trimmed Fasta Functions ###
 
-def parallelSeqFileToCountsParallel(fastqGzFileNameList, fastaFileNameList, countFileNameList, processPool, libraryFasta, startIndex=None, stopIndex=None, test=False):
+#trimList optionally gives each file its own (startIndex, stopIndex, staggerStarts), as found by detectTrim
+def parallelSeqFileToCountsParallel(fastqGzFileNameList, fastaFileNameList, countFileNameList, processPool, libraryFasta, startIndex=None, stopIndex=None, test=False, mismatches=0, 
+		unalignedMode='fasta', unalignedNumber=10000, decompression='auto', decompressionThreads=4, trimList=None):
 
 	if len(fastqGzFileNameList) != len(fastaFileNameList):
 		raise ValueError('In and out file lists must be the same length')
 
+	if trimList is None:
+		trimList = [(startIndex, stopIndex, None)]*len(fastaFileNameList)
+
 	arglist = zip(fastqGzFileNameList, fastaFileNameList, countFileNameList, [libraryFasta]*len(fastaFileNameList), 
-                  [startIndex]*len(fastaFileNameList),[stopIndex]*len(fastaFileNameList), [test]*len(fastaFileNameList))
+                  zip(*trimList)[0], zip(*trimList)[1], [test]*len(fastaFileNameList), [mismatches]*len(fastaFileNameList),
+                  [unalignedMode]*len(fastaFileNameList), [unalignedNumber]*len(fastaFileNameList),
+                  [decompression]*len(fastaFileNameList), [decompressionThreads]*len(fastaFileNameList), zip(*trimList)[2])
 	
 	readsPerFile = processPool.map(seqFileToCountsWrapper, arglist)
 
@@ -27,73 +50,1088 @@ def seqFileToCountsWrapper(arg):
 	return seqFileToCounts(*arg)
 
 
-def seqFileToCounts(infileName, fastaFileName, countFileName, libraryFasta, startIndex=None, stopIndex=None, test=False):
+#unaligned reads are written according to unalignedMode (see unalignedFileSuffixes); unalignedNumber is the number of
+#reads kept when sampling, or the number of most frequent sequences listed when collapsing
+#gzipped files are read with the given decompression backend (see openSeqFile)
+#staggerStarts are other start offsets tried for reads that do not match the library when trimmed at startIndex
+def seqFileToCounts(infileName, fastaFileName, countFileName, libraryFasta, startIndex=None, stopIndex=None, test=False, mismatches=0, 
+		unalignedMode='fasta', unalignedNumber=10000, decompression='auto', decompressionThreads=4, staggerStarts=None):
 	printNow('Processing %s' % infileName)
 	
-	fileType = None
-
-	for fileTup in acceptedFileTypes:
-		if fnmatch.fnmatch(infileName,fileTup[0]):
-			fileType = fileTup[1]
-			break
-		
-	if fileType == 'fqgz':
-		linesPerRead = 4
-		infile = gzip.open(infileName)
-	elif fileType == 'fq':
-		linesPerRead = 4
-		infile = open(infileName)
-	elif fileType == 'fa':
-		linesPerRead = 2
-		infile = open(infileName)
-	else:
-		raise ValueError('Sequencing file type not recognized!')
-		
+	fileType, linesPerRead = getSeqFileType(infileName)
+	infile, decompression = openSeqFile(infileName, fileType, decompression, decompressionThreads)
 	
-	seqToIdDict, idsToReadcountDict, expectedReadLength = parseLibraryFasta(libraryFasta)
+	libraryIndex = loadLibraryFasta(libraryFasta)
+	seqCounts = np.zeros(len(libraryIndex.seqToIndex), dtype=np.int64)
 	
 	curRead = 0
-	numAligning = 0
+	numMismatched = 0
 
-	with open(fastaFileName,'w') as unalignedFile:
-		for i, fastqLine in enumerate(infile):
-			if i % linesPerRead != 1:
-				continue
+	unalignedFile = openUnalignedFile(fastaFileName, unalignedMode)
+	unalignedSeqCounts = collections.Counter()
+	numUnalignedWritten = 0
 
-			else:
-				seq = fastqLine.strip()[startIndex:stopIndex]
-			
-				if i == 1 and len(seq) != expectedReadLength:
-					raise ValueError('Trimmed read length does not match expected reference read length')
-			
-				if seq in seqToIdDict:
-					for seqId in seqToIdDict[seq]:
-						idsToReadcountDict[seqId] += 1
-						
-					numAligning += 1
-			
-				else:
-					unalignedFile.write('>%d\n%s\n' % (i, seq))
+	metrics = CountingMetrics(infileName, infile, os.path.getsize(infileName))
 
-				curRead += 1
-		
-				#allow test runs using only the first N reads from the fastq file
-				if test and curRead >= testLines:
-					break
+	try:
+		for recordBlock in readRecordBlocks(infile, linesPerRead):
+			metrics.endStage('decompress')
+
+			seqBatch = getBlockSeqs(recordBlock, linesPerRead, startIndex, stopIndex, staggerStarts, libraryFasta)
+
+			#allow test runs using only the first N reads from the fastq file
+			if test:
+				seqBatch = seqBatch[:testLines - curRead]
+
+			if curRead == 0 and len(seqBatch) > 0 and len(seqBatch[0]) != libraryIndex.readLength:
+				raise ValueError('Trimmed read length does not match expected reference read length')
+
+			metrics.endStage('parse')
+
+			seqIndices, batchMismatched = alignSeqBatch(seqBatch, libraryFasta, mismatches)
+			isAligned = seqIndices >= 0
+
+			addSeqCounts(seqCounts, seqIndices[isAligned])
+			numMismatched += batchMismatched
+
+			metrics.endStage('lookup')
 
-	with open(countFileName,'w') as countFile:
-		for countTup in (sorted(zip(idsToReadcountDict.keys(), idsToReadcountDict.values()))):
-			countFile.write('%s\t%d\n' % countTup)
+			numUnalignedWritten = saveUnalignedReads(unalignedFile, unalignedSeqCounts, seqBatch, np.flatnonzero(~isAligned), curRead, linesPerRead, 
+				unalignedMode, unalignedNumber, numUnalignedWritten)
+
+			metrics.endStage('write')
+
+			curRead += len(seqBatch)
+			metrics.addBlock(len(seqBatch), len(recordBlock))
+
+			if test and curRead >= testLines:
+				break
+
+	finally:
+		infile.close()
+
+		if unalignedFile is not None:
+			unalignedFile.close()
+
+	if unalignedMode == 'collapsed':
+		writeCollapsedUnalignedFile(fastaFileName, unalignedSeqCounts, unalignedNumber)
+
+	numAligning = int(seqCounts.sum())
+
+	writeCountsFile(countFileName, libraryIndex, seqCounts)
+	metrics.endStage('write')
 
 	printNow('Done processing %s' % infileName)
 	
-	return curRead, numAligning, numAligning * 100.0 / curRead
+	return curRead, numAligning, numAligning * 100.0 / curRead, numMismatched, decompression, metrics.getSummary()
+
+
+### Single File Sharding Functions ###
+
+#count one large sequencing file with every process in the pool instead of one process per file
+#plain text files are split into byte ranges aligned to record boundaries that each worker reads independently;
+#gzipped files cannot be seeked into, so they are decompressed once here and blocks of whole records are fanned out,
+#as are the first testLines reads of any file in test runs
+#unaligned reads are named by line number and written in file order, just as when the file is counted by one process;
+#byte range shards do not know how many reads come before them, so they number their reads from 0 and their part files
+#are renumbered here by the reads of the shards before them
+def shardedSeqFileToCounts(infileName, fastaFileName, countFileName, processPool, numShards, libraryFasta, startIndex=None, stopIndex=None, test=False, mismatches=0, 
+		unalignedMode='fasta', unalignedNumber=10000, decompression='auto', decompressionThreads=4, staggerStarts=None):
+	printNow('Processing %s in %d shards' % (infileName, numShards))
+
+	fileType, linesPerRead = getSeqFileType(infileName)
+
+	for partFileName in glob.glob(fastaFileName + '.part*'):
+		os.remove(partFileName)
+
+	libraryIndex = loadLibraryFasta(libraryFasta)
+	seqCounts = np.zeros(len(libraryIndex.seqToIndex), dtype=np.int64)
+	readTotals = np.zeros(3, dtype=np.int64) #reads, aligning reads and reads aligning with mismatches
+	unalignedSeqCounts = collections.Counter()
+
+	#part files are copied byte for byte, so gzipped parts become members of one multi-member gzip file
+	unalignedFile = open(fastaFileName, 'wb') if unalignedMode in ('fasta', 'gzip', 'sample') else None
+	numUnalignedWritten = 0
+
+	try:
+		if fileType == 'fqgz' or test:
+			pendingBlocks = collections.deque()
+
+			infile, decompression = openSeqFile(infileName, fileType, decompression, decompressionThreads)
+			metrics = CountingMetrics(infileName, infile, os.path.getsize(infileName))
+
+			with infile:
+				blockFirstRead = 0
+				for blockNum, recordBlock in enumerate(readRecordBlocks(infile, linesPerRead)):
+					metrics.endStage('decompress')
+
+					#once enough reads have been sampled, later blocks do not need to write any
+					blockUnalignedMode = 'off' if unalignedMode == 'sample' and numUnalignedWritten >= unalignedNumber else unalignedMode
+
+					pendingBlocks.append((getUnalignedPartFileName(fastaFileName, blockNum), processPool.apply_async(countRecordBlock, 
+						(recordBlock, blockFirstRead, getUnalignedPartFileName(fastaFileName, blockNum), linesPerRead, libraryFasta, startIndex, stopIndex, mismatches, 
+						blockUnalignedMode, unalignedNumber, staggerStarts, 0, testLines - blockFirstRead if test else None))))
+
+					blockFirstRead += countBlockReads(recordBlock, linesPerRead)
+
+					#only keep a few blocks in flight so the whole decompressed file is never held in memory
+					while len(pendingBlocks) >= 2 * numShards or (test and blockFirstRead >= testLines and len(pendingBlocks) > 0):
+						partFileName, pendingBlock = pendingBlocks.popleft()
+						numUnalignedWritten = addShardResult(pendingBlock.get(), partFileName, readTotals, seqCounts, unalignedSeqCounts, metrics, 
+							unalignedFile, unalignedMode, unalignedNumber, numUnalignedWritten)
+
+					if test and blockFirstRead >= testLines:
+						break
+
+			for partFileName, pendingBlock in pendingBlocks:
+				numUnalignedWritten = addShardResult(pendingBlock.get(), partFileName, readTotals, seqCounts, unalignedSeqCounts, metrics, 
+					unalignedFile, unalignedMode, unalignedNumber, numUnalignedWritten)
+
+		else:
+			byteRanges = getShardByteRanges(infileName, linesPerRead, numShards)
+			metrics = CountingMetrics(infileName)
+
+			arglist = [(infileName, byteStart, byteEnd, shardNum, linesPerRead, fastaFileName, libraryFasta, startIndex, stopIndex, mismatches, 
+				unalignedMode, unalignedNumber, staggerStarts) for shardNum, (byteStart, byteEnd) in enumerate(byteRanges)]
+
+			for shardNum, shardResult in enumerate(processPool.map(seqFileShardToCountsWrapper, arglist)):
+				shardFirstLine = int(readTotals[0]) * linesPerRead
+				numUnalignedWritten = addShardResult(shardResult, getUnalignedPartFileName(fastaFileName, shardNum), readTotals, seqCounts, unalignedSeqCounts, metrics, 
+					unalignedFile, unalignedMode, unalignedNumber, numUnalignedWritten, shardFirstLine)
+
+			decompression = 'none'
+
+	finally:
+		if unalignedFile is not None:
+			unalignedFile.close()
+
+	curRead, numAligning, numMismatched = readTotals.tolist()
+
+	if unalignedMode == 'collapsed':
+		writeCollapsedUnalignedFile(fastaFileName, unalignedSeqCounts, unalignedNumber)
+
+	writeCountsFile(countFileName, libraryIndex, seqCounts)
+	metrics.endStage('write')
+
+	printNow('Done processing %s' % infileName)
+
+	return curRead, numAligning, numAligning * 100.0 / curRead, numMismatched, decompression, metrics.getSummary()
+
+
+def seqFileShardToCountsWrapper(arg):
+	return seqFileShardToCounts(*arg)
+
+
+#count the records between two record-aligned byte offsets of a plain text sequencing file; unaligned reads are written
+#to the part file of the shard, named by their line number counting from byteStart
+def seqFileShardToCounts(infileName, byteStart, byteEnd, shardNum, linesPerRead, fastaFileName, libraryFasta, startIndex=None, stopIndex=None, mismatches=0, 
+		unalignedMode='fasta', unalignedNumber=10000, staggerStarts=None):
+	seqCounts = np.zeros(len(loadLibraryFasta(libraryFasta).seqToIndex), dtype=np.int64)
+	curRead, numAligning, numMismatched = 0, 0, 0
+
+	partFileName = getUnalignedPartFileName(fastaFileName, shardNum)
+	unalignedSeqCounts = collections.Counter()
+	numUnalignedWritten = 0
+
+	metrics = CountingMetrics('%s shard %d' % (infileName, shardNum), totalBytes=byteEnd - byteStart)
+
+	with open(infileName) as infile:
+		infile.seek(byteStart)
+		for recordBlock in readRecordBlocks(infile, linesPerRead, maxBytes=byteEnd - byteStart):
+			metrics.endStage('decompress')
+
+			blockReads, blockAligning, blockMismatched, blockSeqCounts, blockUnaligned, blockMetrics = countRecordBlock(recordBlock, 
+				curRead, partFileName, linesPerRead, libraryFasta, startIndex, stopIndex, mismatches, unalignedMode, unalignedNumber, staggerStarts, 
+				numUnalignedWritten)
+
+			curRead += blockReads
+			numAligning += blockAligning
+			numMismatched += blockMismatched
+			seqCounts += blockSeqCounts
+
+			if unalignedMode == 'collapsed':
+				unalignedSeqCounts.update(dict(blockUnaligned))
+				pruneUnalignedSeqCounts(unalignedSeqCounts, unalignedNumber)
+			else:
+				numUnalignedWritten = blockUnaligned
+
+			metrics.addMetrics(blockMetrics)
+
+	return curRead, numAligning, numMismatched, seqCounts, \
+		getTopUnalignedSeqs(unalignedSeqCounts, collapsedKeepFactor * unalignedNumber) if unalignedMode == 'collapsed' else numUnalignedWritten, metrics.getSummary()
+
+
+#count a string of whole sequencing records whose first read is read number firstRead of the file (counting from 0),
+#appending unaligned reads to the given part file; maxReads, if given, stops after that many reads
+#returns the most frequent unaligned sequences of the block and their read counts (see getTopUnalignedSeqs) when
+#collapsing unaligned reads, otherwise the number of reads in the part file, which starts with numUnalignedWritten
+#the metrics summary returned covers parsing, lookup and writing; reading the block is timed by the caller
+def countRecordBlock(recordBlock, firstRead, partFileName, linesPerRead, libraryFasta, startIndex=None, stopIndex=None, mismatches=0, 
+		unalignedMode='fasta', unalignedNumber=10000, staggerStarts=None, numUnalignedWritten=0, maxReads=None):
+	libraryIndex = loadLibraryFasta(libraryFasta)
+	metrics = CountingMetrics(os.path.basename(partFileName))
+
+	seqs = getBlockSeqs(recordBlock, linesPerRead, startIndex, stopIndex, staggerStarts, libraryFasta)
+	if maxReads is not None:
+		seqs = seqs[:maxReads]
+
+	if len(seqs) > 0 and len(seqs[0]) != libraryIndex.readLength:
+		raise ValueError('Trimmed read length does not match expected reference read length')
+
+	metrics.endStage('parse')
+
+	seqIndices, numMismatched = alignSeqBatch(seqs, libraryFasta, mismatches)
+	isAligned = seqIndices >= 0
+
+	seqCounts = np.zeros(len(libraryIndex.seqToIndex), dtype=np.int64)
+	addSeqCounts(seqCounts, seqIndices[isAligned])
+
+	metrics.endStage('lookup')
+
+	unalignedPositions = np.flatnonzero(~isAligned)
+	unalignedSeqCounts = collections.Counter()
+
+	#sample mode keeps the first unalignedNumber reads of each part file, and the parts are cut to that many in total
+	if unalignedMode in ('fasta', 'gzip', 'sample') and len(unalignedPositions) > 0 and (unalignedMode != 'sample' or numUnalignedWritten < unalignedNumber):
+		unalignedFile = openUnalignedFile(partFileName, unalignedMode, append=True)
+		try:
+			numUnalignedWritten = saveUnalignedReads(unalignedFile, unalignedSeqCounts, seqs, unalignedPositions, firstRead, linesPerRead, 
+				unalignedMode, unalignedNumber, numUnalignedWritten)
+		finally:
+			unalignedFile.close()
+
+	elif unalignedMode == 'collapsed':
+		saveUnalignedReads(None, unalignedSeqCounts, seqs, unalignedPositions, firstRead, linesPerRead, unalignedMode, unalignedNumber, numUnalignedWritten)
+
+	metrics.endStage('write')
+	metrics.addBlock(len(seqs), len(recordBlock))
+
+	return len(seqs), int(isAligned.sum()), numMismatched, seqCounts, \
+		getTopUnalignedSeqs(unalignedSeqCounts, collapsedKeepFactor * unalignedNumber) if unalignedMode == 'collapsed' else numUnalignedWritten, metrics.getSummary()
+
+#the number of reads getBlockSeqs finds in a block of whole records, without splitting it into lines
+def countBlockReads(recordBlock, linesPerRead):
+	return (recordBlock.count('\n') + linesPerRead - 1) // linesPerRead
+
+def getUnalignedPartFileName(fastaFileName, partNum):
+	return '%s.part%d' % (fastaFileName, partNum)
+
+#add the result of counting a shard or block of a file to the totals of the whole file, in file order, and merge its
+#unaligned reads, adding lineOffset to their names; returns the number of reads in the unaligned read file in sample mode
+def addShardResult(shardResult, partFileName, readTotals, seqCounts, unalignedSeqCounts, metrics, unalignedFile, unalignedMode, unalignedNumber, numUnalignedWritten, 
+		lineOffset=0):
+	readTotals += shardResult[:3]
+	seqCounts += shardResult[3]
+	metrics.addMetrics(shardResult[5])
+
+	if unalignedMode == 'collapsed':
+		unalignedSeqCounts.update(dict(shardResult[4]))
+		pruneUnalignedSeqCounts(unalignedSeqCounts, unalignedNumber)
+
+	return mergeUnalignedPartFile(unalignedFile, partFileName, unalignedMode, unalignedNumber, numUnalignedWritten, lineOffset)
+
+#append the reads of an unaligned read part file to the unaligned read file and delete the part, keeping only up to
+#unalignedNumber reads in all in sample mode; returns the number of reads in the unaligned read file in sample mode
+#parts whose reads are named from the start of a shard are renumbered by adding lineOffset to each name, a batch of
+#records at a time (gzipped parts are recompressed as a new member of the unaligned read file); other parts are copied
+def mergeUnalignedPartFile(unalignedFile, partFileName, unalignedMode, unalignedNumber, numUnalignedWritten, lineOffset=0):
+	if unalignedFile is None or not os.path.exists(partFileName):
+		return numUnalignedWritten
+
+	if lineOffset > 0:
+		with (gzip.open(partFileName, 'rb') if unalignedMode == 'gzip' else open(partFileName, 'rb')) as partFile:
+			outfile = gzip.GzipFile(fileobj=unalignedFile, mode='wb') if unalignedMode == 'gzip' else unalignedFile
+			try:
+				while unalignedMode != 'sample' or numUnalignedWritten < unalignedNumber:
+					batchRecords = renumberBatchRecords if unalignedMode != 'sample' else min(renumberBatchRecords, unalignedNumber - numUnalignedWritten)
+					partLines = list(itertools.islice(partFile, 2 * batchRecords))
+					if len(partLines) == 0:
+						break
+
+					partLines[0::2] = ['>%d\n' % (int(nameLine[1:]) + lineOffset) for nameLine in partLines[0::2]]
+					outfile.write(''.join(partLines))
+					numUnalignedWritten += len(partLines) // 2
+			finally:
+				if outfile is not unalignedFile:
+					outfile.close()
+
+	else:
+		with open(partFileName, 'rb') as partFile:
+			if unalignedMode == 'sample':
+				partLines = list(itertools.islice(partFile, 2 * max(unalignedNumber - numUnalignedWritten, 0)))
+				unalignedFile.write(''.join(partLines))
+				numUnalignedWritten += len(partLines) // 2
+			else:
+				shutil.copyfileobj(partFile, unalignedFile)
+
+	os.remove(partFileName)
+
+	return numUnalignedWritten
+
+
+### Sample Demultiplexing Functions ###
+
+#count undemultiplexed sequencing files into one counts file per sample listed in the sample sheet, summing each sample
+#over all files; files are counted one per process and the per-sample counts arrays are added up here
+#returns the read statistics of each sequencing file and of each sample (and of reads with unrecognized indices)
+def parallelDemuxSeqFileToCounts(fastqGzFileNameList, indexFileNameList, fastaFileNameList, countFileNameList, processPool, libraryFasta, sampleSheet, 
+		startIndex=None, stopIndex=None, test=False, mismatches=0, unalignedMode='fasta', unalignedNumber=10000, decompression='auto', decompressionThreads=4, 
+		trimList=None):
+
+	if len(fastqGzFileNameList) != len(fastaFileNameList) or len(fastqGzFileNameList) != len(indexFileNameList):
+		raise ValueError('In and out file lists must be the same length')
+
+	if len(countFileNameList) != len(sampleSheet.sampleNames) + 1:
+		raise ValueError('A counts file name is needed for each sample and for undetermined reads')
+
+	if trimList is None:
+		trimList = [(startIndex, stopIndex, None)]*len(fastqGzFileNameList)
+
+	arglist = [(fastqGzFileName, indexFileName, fastaFileName, libraryFasta, sampleSheet, fileStartIndex, fileStopIndex, test, mismatches, 
+				unalignedMode, unalignedNumber, decompression, decompressionThreads, staggerStarts) 
+				for fastqGzFileName, indexFileName, fastaFileName, (fileStartIndex, fileStopIndex, staggerStarts) 
+				in zip(fastqGzFileNameList, indexFileNameList, fastaFileNameList, trimList)]
+
+	fileResults = processPool.map(demuxSeqFileToCountsWrapper, arglist)
+
+	libraryIndex = loadLibraryFasta(libraryFasta)
+	sampleSeqCounts = np.zeros((len(countFileNameList), len(libraryIndex.seqToIndex)), dtype=np.int64)
+	sampleReads = np.zeros(len(countFileNameList), dtype=np.int64)
+
+	for fileResult in fileResults:
+		sampleReads += fileResult[6]
+		sampleSeqCounts += fileResult[7]
+
+	sampleResults = []
+	for countFileName, numReads, seqCounts in zip(countFileNameList, sampleReads, sampleSeqCounts):
+		writeCountsFile(countFileName, libraryIndex, seqCounts)
+
+		numAligning = int(seqCounts.sum())
+		sampleResults.append((int(numReads), numAligning, numAligning * 100.0 / max(numReads, 1)))
+
+	return zip(fastqGzFileNameList, [fileResult[:6] for fileResult in fileResults]), zip(countFileNameList, sampleResults)
+
+
+def demuxSeqFileToCountsWrapper(arg):
+	return demuxSeqFileToCounts(*arg)
+
+
+#count an undemultiplexed sequencing file into one array of library sequence counts per sample in a single pass
+#each read's index sequence is taken from the end of its header (e.g. 1:N:0:ATCACG) or, when indexFileName is given,
+#from the matching read of a separate index read file; reads with unrecognized indices are counted as undetermined
+#returns the read statistics and metrics of the file, the reads per sample and a samples x library sequences array
+#of counts, with undetermined reads in the last row of both
+def demuxSeqFileToCounts(infileName, indexFileName, fastaFileName, libraryFasta, sampleSheet, startIndex=None, stopIndex=None, test=False, mismatches=0, 
+		unalignedMode='fasta', unalignedNumber=10000, decompression='auto', decompressionThreads=4, staggerStarts=None):
+	printNow('Processing %s' % infileName)
+
+	fileType, linesPerRead = getSeqFileType(infileName)
+	infile, decompression = openSeqFile(infileName, fileType, decompression, decompressionThreads)
+
+	if indexFileName is not None:
+		indexFileType, indexLinesPerRead = getSeqFileType(indexFileName)
+		indexFile = openSeqFile(indexFileName, indexFileType, decompression, decompressionThreads)[0]
+		indexBatches = readSeqBatches(indexFile, indexLinesPerRead, 0, sampleSheet.barcodeLength)
+		barcodeBuffer = []
+	else:
+		indexFile = None
+
+	libraryIndex = loadLibraryFasta(libraryFasta)
+	numSamples = len(sampleSheet.sampleNames)
+	sampleSeqCounts = np.zeros((numSamples + 1, len(libraryIndex.seqToIndex)), dtype=np.int64)
+	sampleReads = np.zeros(numSamples + 1, dtype=np.int64)
+
+	curRead = 0
+	numMismatched = 0
+
+	unalignedFile = openUnalignedFile(fastaFileName, unalignedMode)
+	unalignedSeqCounts = collections.Counter()
+	numUnalignedWritten = 0
+
+	metrics = CountingMetrics(infileName, infile, os.path.getsize(infileName))
+
+	try:
+		for recordBlock in readRecordBlocks(infile, linesPerRead):
+			metrics.endStage('decompress')
+
+			blockLines = getBlockLines(recordBlock)
+			seqBatch = trimSeqLines(blockLines[1::linesPerRead], startIndex, stopIndex, staggerStarts, libraryFasta)
+
+			if indexFile is None:
+				barcodes = getHeaderBarcodes(blockLines[0::linesPerRead][:len(seqBatch)], sampleSheet.barcodeLength)
+				metrics.endStage('parse')
+			else:
+				metrics.endStage('parse')
+				barcodes = takeIndexBarcodes(indexBatches, barcodeBuffer, len(seqBatch))
+				metrics.endStage('decompress')
+
+			#allow test runs using only the first N reads from the fastq file
+			if test:
+				seqBatch = seqBatch[:testLines - curRead]
+				barcodes = barcodes[:len(seqBatch)]
+
+			if curRead == 0 and len(seqBatch) > 0 and len(seqBatch[0]) != libraryIndex.readLength:
+				raise ValueError('Trimmed read length does not match expected reference read length')
+
+			seqIndices, batchMismatched = alignSeqBatch(seqBatch, libraryFasta, mismatches)
+			isAligned = seqIndices >= 0
+			sampleIndices = np.array(map(sampleSheet.barcodeToSample.get, barcodes, itertools.repeat(numSamples, len(barcodes))), dtype=np.int64)
+
+			addSampleSeqCounts(sampleSeqCounts, sampleIndices[isAligned], seqIndices[isAligned])
+			addSeqCounts(sampleReads, sampleIndices)
+			numMismatched += batchMismatched
+
+			metrics.endStage('lookup')
+
+			numUnalignedWritten = saveUnalignedReads(unalignedFile, unalignedSeqCounts, seqBatch, np.flatnonzero(~isAligned), curRead, linesPerRead, 
+				unalignedMode, unalignedNumber, numUnalignedWritten)
+
+			metrics.endStage('write')
+
+			curRead += len(seqBatch)
+			metrics.addBlock(len(seqBatch), len(recordBlock))
+
+			if test and curRead >= testLines:
+				break
+
+		if indexFile is not None and not test and (len(barcodeBuffer) > 0 or next(indexBatches, None) is not None):
+			raise ValueError('Index read file %s has more reads than %s' % (indexFileName, infileName))
+
+	finally:
+		infile.close()
+
+		if indexFile is not None:
+			indexFile.close()
+
+		if unalignedFile is not None:
+			unalignedFile.close()
+
+	if unalignedMode == 'collapsed':
+		writeCollapsedUnalignedFile(fastaFileName, unalignedSeqCounts, unalignedNumber)
+		metrics.endStage('write')
+
+	numAligning = int(sampleSeqCounts.sum())
+
+	printNow('Done processing %s' % infileName)
+
+	return curRead, numAligning, numAligning * 100.0 / max(curRead, 1), numMismatched, decompression, metrics.getSummary(), sampleReads, sampleSeqCounts
+
+
+#pull the index sequence from the end of each fastq header, e.g. ATCACG from @HWI-ST640:851:C4U9HACXX:8:1101:1124:2112 1:N:0:ATCACG
+def getHeaderBarcodes(headerLines, barcodeLength):
+	return map(operator.itemgetter(slice(0, barcodeLength)), 
+		map(operator.itemgetter(2), map(operator.methodcaller('rpartition', ':'), headerLines)))
+
+#take the index sequences of the next numReads reads from a separate index read file, which is read in blocks of its own
+def takeIndexBarcodes(indexBatches, barcodeBuffer, numReads):
+	while len(barcodeBuffer) < numReads:
+		indexBatch = next(indexBatches, None)
+		if indexBatch is None:
+			raise ValueError('Index read file has fewer reads than the sequencing file')
+
+		barcodeBuffer.extend(indexBatch)
+
+	barcodes = barcodeBuffer[:numReads]
+	del barcodeBuffer[:numReads]
+
+	return barcodes
+
+#add one count per read to a samples x library sequences array; only the combinations present are touched,
+#so the cost does not grow with the number of samples
+def addSampleSeqCounts(sampleSeqCounts, sampleIndices, seqIndices):
+	if len(seqIndices) > 0:
+		flatIndices, flatCounts = np.unique(sampleIndices * sampleSeqCounts.shape[1] + seqIndices, return_counts=True)
+		sampleSeqCounts.ravel()[flatIndices] += flatCounts
+
+
+#sample sheets are tab-delimited files of index sequences and sample names, one pair per line; a sample may be listed
+#with several index sequences, a first line that is not an index sequence is read as column headers, and lines
+#starting with # are skipped; no sample may be named undeterminedSampleName (in any case), as its counts file would be
+#that of the undetermined reads
+SampleSheet = collections.namedtuple('SampleSheet', ['barcodeToSample', 'sampleNames', 'barcodeLength'])
+
+#with barcodeMismatches of 1, index sequences with one substitution are also assigned to a sample unless they are
+#equally close to the index sequences of two samples
+def parseSampleSheet(sampleSheetName, barcodeMismatches=0):
+	barcodeToSample = dict()
+	sampleNames = []
+	firstLine = True
+
+	with open(sampleSheetName) as sampleSheet:
+		for lineNum, line in enumerate(sampleSheet):
+			linesplit = line.strip().split('\t')
+			if linesplit[0] == '' or linesplit[0][0] == '#':
+				continue
+
+			isFirstLine, firstLine = firstLine, False
+
+			barcode = linesplit[0].strip().upper()
+			if len(linesplit) < 2 or linesplit[1].strip() == '' or len(barcode.strip('ACGTN+')) != 0:
+				if isFirstLine:
+					continue
+				raise ValueError('Sample sheet line %d is not an index sequence and a sample name' % (lineNum + 1))
+
+			sampleName = linesplit[1].strip()
+			if sampleName.lower() == undeterminedSampleName.lower():
+				raise ValueError('Sample sheet line %d uses the name %s, which is kept for reads with unrecognized indices' % (lineNum + 1, sampleName))
+
+			if sampleName not in sampleNames:
+				sampleNames.append(sampleName)
+
+			if barcode in barcodeToSample and barcodeToSample[barcode] != sampleNames.index(sampleName):
+				raise ValueError('Index sequence %s is listed for more than one sample' % barcode)
+
+			barcodeToSample[barcode] = sampleNames.index(sampleName)
+
+	if len(barcodeToSample) == 0:
+		raise ValueError('No index sequences found in the sample sheet')
+
+	barcodeLengths = set([len(barcode) for barcode in barcodeToSample])
+	if len(barcodeLengths) != 1:
+		raise ValueError('Index sequences in the sample sheet are not all the same length')
+
+	if barcodeMismatches > 0:
+		mismatchToSample = dict()
+		for barcode, sampleNum in barcodeToSample.iteritems():
+			for i, base in enumerate(barcode):
+				if base == '+':
+					continue
+
+				for mismatchBase in mismatchBases:
+					if mismatchBase == base:
+						continue
+
+					mismatchBarcode = barcode[:i] + mismatchBase + barcode[i+1:]
+					if mismatchToSample.get(mismatchBarcode, sampleNum) != sampleNum:
+						mismatchToSample[mismatchBarcode] = -1 #ambiguous
+					else:
+						mismatchToSample[mismatchBarcode] = sampleNum
+
+		for mismatchBarcode, sampleNum in mismatchToSample.iteritems():
+			if sampleNum != -1 and mismatchBarcode not in barcodeToSample:
+				barcodeToSample[mismatchBarcode] = sampleNum
+
+	return SampleSheet(barcodeToSample, sampleNames, barcodeLengths.pop())
+
+
+### Decompression Functions ###
+
+#open a sequencing file for reading, returning the file and the name of the decompression backend actually used
+#gzipped files can be read by:
+#	pigz: a pipe from a pigz subprocess, which decompresses alongside this process
+#	bgzf: blocked gzip files (as written by bgzip) decompressed in parallel a batch of blocks at a time
+#	zlib: zlib reading large compressed chunks, much faster than gzip.open line iteration
+#	gzip: the gzip module
+#auto uses bgzf for blocked gzip files, then pigz if it is on the PATH, then zlib
+def openSeqFile(infileName, fileType, decompression='auto', decompressionThreads=4):
+	if fileType != 'fqgz':
+		return open(infileName, 'rb'), 'none'
+
+	if decompression == 'auto':
+		if isBgzfFile(infileName):
+			decompression = 'bgzf'
+		elif distutils.spawn.find_executable('pigz') is not None:
+			decompression = 'pigz'
+		else:
+			decompression = 'zlib'
+
+	if decompression == 'gzip':
+		return gzip.open(infileName), decompression
+	elif decompression == 'pigz':
+		return io.BufferedReader(DecompressedStream(iterProcessChunks(['pigz', '-dc', '-p', str(decompressionThreads), infileName])), 
+			buffer_size=decompressedBufferSize), decompression
+	elif decompression == 'bgzf':
+		rawFile = open(infileName, 'rb')
+		chunkIterator = iterBgzfChunks(rawFile, decompressionThreads)
+	elif decompression == 'zlib':
+		rawFile = open(infileName, 'rb')
+		chunkIterator = iterZlibChunks(rawFile)
+	else:
+		raise ValueError('Decompression backend not recognized')
+
+	return io.BufferedReader(DecompressedStream(chunkIterator, rawFile), buffer_size=decompressedBufferSize), decompression
+
+#read-only file object over a generator of decompressed strings, so each backend only has to produce chunks
+#rawFile is the compressed file the chunks are read from, if this process reads it, and is closed along with the stream
+class DecompressedStream(io.RawIOBase):
+	def __init__(self, chunkIterator, rawFile=None):
+		self.chunkIterator = chunkIterator
+		self.rawFile = rawFile
+		self.chunk = ''
+		self.chunkOffset = 0
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer):
+		while self.chunkOffset >= len(self.chunk):
+			try:
+				self.chunk = next(self.chunkIterator)
+			except StopIteration:
+				return 0
+			self.chunkOffset = 0
+
+		numBytes = min(len(buffer), len(self.chunk) - self.chunkOffset)
+		buffer[:numBytes] = self.chunk[self.chunkOffset:self.chunkOffset + numBytes]
+		self.chunkOffset += numBytes
+
+		return numBytes
+
+	def close(self):
+		if not self.closed:
+			self.chunkIterator.close()
+			if self.rawFile is not None:
+				self.rawFile.close()
+		io.RawIOBase.close(self)
+
+#return how far into the file on disk a sequencing file opened by openSeqFile has been read, in bytes,
+#or None if the file is read by another process
+def getRawFilePosition(infile):
+	if isinstance(infile, gzip.GzipFile):
+		return infile.fileobj.tell()
+	elif isinstance(infile, io.BufferedReader):
+		return infile.raw.rawFile.tell() if infile.raw.rawFile is not None else None
+	else:
+		return infile.tell()
+
+#decompress a gzip file with zlib, starting a new decompressor whenever a gzip member ends
+def iterZlibChunks(infile):
+	decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+	for compressed in iter(lambda: infile.read(compressedChunkSize), ''):
+		while compressed != '':
+			chunk = decompressor.decompress(compressed)
+			compressed = decompressor.unused_data
+
+			if compressed != '':
+				decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+			if chunk != '':
+				yield chunk
+
+#stream the standard output of a decompression command
+def iterProcessChunks(commandList):
+	process = subprocess.Popen(commandList, stdout=subprocess.PIPE)
+
+	try:
+		for chunk in iter(lambda: process.stdout.read(compressedChunkSize), ''):
+			yield chunk
+
+		if process.wait() != 0:
+			raise IOError('%s exited with status %d' % (commandList[0], process.returncode))
+
+	finally:
+		process.stdout.close()
+		if process.poll() is None:
+			process.kill()
+			process.wait()
+
+#decompress a blocked gzip file with a thread pool, reading the next batch of blocks while the last is decompressed
+def iterBgzfChunks(infile, decompressionThreads):
+	threadPool = multiprocessing.pool.ThreadPool(decompressionThreads)
+
+	try:
+		pendingBatch = None
+		while True:
+			bgzfBlocks = readBgzfBlocks(infile, bgzfBlocksPerBatch)
+
+			if pendingBatch is not None:
+				yield ''.join(pendingBatch.get())
+
+			if len(bgzfBlocks) == 0:
+				break
+
+			pendingBatch = threadPool.map_async(decompressBgzfBlock, bgzfBlocks)
+
+	finally:
+		threadPool.terminate()
+		threadPool.join()
+
+#read up to numBlocks blocks from a blocked gzip file, returning (deflate data, uncompressed size) for each
+#each block is a complete gzip member whose header carries its total size in a BC extra subfield
+def readBgzfBlocks(infile, numBlocks):
+	bgzfBlocks = []
+
+	while len(bgzfBlocks) < numBlocks:
+		header = infile.read(12)
+		if header == '':
+			break
+
+		extraLength = struct.unpack('<H', header[10:12])[0] if len(header) == 12 else 0
+		blockSize = getBgzfBlockSize(header, infile.read(extraLength))
+		if blockSize is None:
+			raise IOError('Not a blocked gzip file, or the file is truncated')
+
+		blockRemainder = infile.read(blockSize - 12 - extraLength)
+		if len(blockRemainder) < 8:
+			raise IOError('Blocked gzip file is truncated')
+
+		bgzfBlocks.append((blockRemainder[:-8], struct.unpack('<I', blockRemainder[-4:])[0]))
+
+	return bgzfBlocks
+
+#return the total size of a blocked gzip block given its 12 byte header and extra field, or None if it is not one
+def getBgzfBlockSize(header, extraField):
+	if len(header) != 12 or header[:4] != '\x1f\x8b\x08\x04':
+		return None
+
+	fieldStart = 0
+	while fieldStart + 4 <= len(extraField):
+		fieldLength = struct.unpack('<H', extraField[fieldStart + 2:fieldStart + 4])[0]
+		if extraField[fieldStart:fieldStart + 2] == 'BC' and fieldLength == 2:
+			return struct.unpack('<H', extraField[fieldStart + 4:fieldStart + 6])[0] + 1
+		fieldStart += 4 + fieldLength
+
+	return None
+
+def decompressBgzfBlock(bgzfBlock):
+	deflateData, uncompressedSize = bgzfBlock
+
+	#decompressor objects, unlike zlib.decompress, release the GIL while they work
+	chunk = zlib.decompressobj(-zlib.MAX_WBITS).decompress(deflateData)
+	if len(chunk) != uncompressedSize:
+		raise IOError('Blocked gzip block did not decompress to its expected size')
+
+	return chunk
+
+def isBgzfFile(infileName):
+	with open(infileName, 'rb') as infile:
+		header = infile.read(12)
+		if len(header) != 12:
+			return False
+
+		return getBgzfBlockSize(header, infile.read(struct.unpack('<H', header[10:12])[0])) is not None
+
+
+### Trim Detection Functions ###
+
+#find where library sequences sit in the reads of a sequencing file by looking up every trim of its first numReads reads
+#that is as long as the library sequences, so trimming does not have to be guessed before counting a whole file
+#returns (startIndex, stopIndex, staggerStarts, fraction of reads matching at startIndex), where staggerStarts are the other
+#start offsets matching at least staggerFraction of the reads, most matches first
+def detectTrim(infileName, libraryFasta, numReads=10000, decompression='auto', decompressionThreads=4):
+	fileType, linesPerRead = getSeqFileType(infileName)
+	infile = openSeqFile(infileName, fileType, decompression, decompressionThreads)[0]
+
+	seqLines = []
+	try:
+		for recordBlock in readRecordBlocks(infile, linesPerRead):
+			seqLines.extend(getBlockLines(recordBlock)[1::linesPerRead])
+			if len(seqLines) >= numReads:
+				break
+	finally:
+		infile.close()
+
+	seqLines = seqLines[:numReads]
+
+	libraryIndex = loadLibraryFasta(libraryFasta)
+	readLength = libraryIndex.readLength
+	maxLength = max(map(len, seqLines)) if len(seqLines) > 0 else 0
+
+	offsetMatches = [sum(map(libraryIndex.seqToIndex.__contains__, map(operator.itemgetter(slice(offset, offset + readLength)), seqLines))) 
+		for offset in range(maxLength - readLength + 1)]
+
+	if len(offsetMatches) == 0 or max(offsetMatches) == 0:
+		raise ValueError('No trim of the first %d reads of %s matches a library sequence' % (len(seqLines), infileName))
+
+	offsetsByMatches = sorted(range(len(offsetMatches)), key=lambda offset: (-offsetMatches[offset], offset))
+	startIndex = offsetsByMatches[0]
+	staggerStarts = [offset for offset in offsetsByMatches[1:] if offsetMatches[offset] >= staggerFraction * len(seqLines)]
+
+	return startIndex, startIndex + readLength, staggerStarts, offsetMatches[startIndex] * 1.0 / len(seqLines)
+
+
+### Progress and Metrics Functions ###
+
+#running totals of the reads, bytes and seconds spent in each stage (see metricsStages) while counting a sequencing file
+#or part of one, printing throughput every progressInterval seconds; the clock is read once per stage of each block
+#of reads, so metrics are always collected
+#infile and totalBytes, if given, are used to estimate how much of the file is left
+class CountingMetrics(object):
+	def __init__(self, name, infile=None, totalBytes=None):
+		self.name = name
+		self.infile = infile
+		self.totalBytes = totalBytes
+
+		self.numReads = 0
+		self.numBytes = 0
+		self.stageSeconds = collections.OrderedDict([(stage, 0.0) for stage in metricsStages])
+
+		self.startTime = self.stageTime = self.reportTime = time.time()
+		self.reportReads = 0
+		self.reportBytes = 0
+
+	#add the time since the last stage ended to this stage, or just restart the clock if stage is None
+	def endStage(self, stage):
+		curTime = time.time()
+		if stage is not None:
+			self.stageSeconds[stage] += curTime - self.stageTime
+		self.stageTime = curTime
+
+	def addBlock(self, numReads, numBytes):
+		self.numReads += numReads
+		self.numBytes += numBytes
+
+		if progressInterval > 0 and self.stageTime - self.reportTime >= progressInterval:
+			self.printProgress()
+
+	#add the totals from the summary of another process counting part of the same file
+	def addMetrics(self, metricsSummary):
+		for stage, seconds in metricsSummary['stage_seconds'].iteritems():
+			self.stageSeconds[stage] += seconds
+
+		self.endStage(None)
+		self.addBlock(metricsSummary['reads'], metricsSummary['bytes'])
+
+	def printProgress(self):
+		curTime = time.time()
+		intervalSeconds = max(curTime - self.reportTime, 1e-6)
+
+		progressString = '%s:\t%.2E reads\t%.2E reads/s\t%.1f MB/s' % (self.name, self.numReads, 
+			(self.numReads - self.reportReads) / intervalSeconds, (self.numBytes - self.reportBytes) / intervalSeconds / 2**20)
+
+		fractionDone = self.getFractionDone()
+		if fractionDone is not None and fractionDone > 0:
+			progressString += '\t%.1f%% done, %s left' % (fractionDone * 100, 
+				datetime.timedelta(seconds=int((curTime - self.startTime) * (1 - fractionDone) / fractionDone)))
+
+		printNow(progressString)
+
+		self.reportTime = curTime
+		self.reportReads = self.numReads
+		self.reportBytes = self.numBytes
+
+	def getFractionDone(self):
+		if self.totalBytes is None or self.totalBytes == 0:
+			return None
+
+		position = self.numBytes if self.infile is None else getRawFilePosition(self.infile)
+		if position is None:
+			return None
+
+		return min(position * 1.0 / self.totalBytes, 1.0)
+
+	#totals as a json-compatible dict; stage seconds summed over several processes can add up to more than seconds
+	def getSummary(self):
+		totalSeconds = max(time.time() - self.startTime, 1e-6)
+
+		return collections.OrderedDict([('reads', self.numReads), 
+										('bytes', self.numBytes), 
+										('seconds', totalSeconds), 
+										('reads_per_second', self.numReads / totalSeconds), 
+										('megabytes_per_second', self.numBytes / totalSeconds / 2**20), 
+										('stage_seconds', self.stageSeconds)])
+
+#one line breakdown of where the time counting a file went
+def getStageString(metricsSummary):
+	totalSeconds = max(sum(metricsSummary['stage_seconds'].values()), 1e-6)
+
+	return ', '.join(['%s %.0f%%' % (stage, seconds * 100.0 / totalSeconds) for stage, seconds in metricsSummary['stage_seconds'].iteritems()])
+
+def writeMetricsFile(metricsFileName, runMetrics):
+	with open(metricsFileName, 'w') as metricsFile:
+		json.dump(runMetrics, metricsFile, indent=2)
+		metricsFile.write('\n')
+
+
+### Unaligned Read Output Functions ###
+
+#return an open file for unaligned read records, or None if unaligned reads are discarded or only tallied
+def openUnalignedFile(fastaFileName, unalignedMode, append=False):
+	if unalignedMode == 'gzip':
+		return gzip.open(fastaFileName, 'ab' if append else 'wb')
+	elif unalignedMode in ('fasta', 'sample'):
+		return open(fastaFileName, 'a' if append else 'w')
+	elif unalignedMode in ('collapsed', 'off'):
+		return None
+	else:
+		raise ValueError('Unaligned read output mode not recognized')
+
+#write a batch of fasta records in a single call, keeping only the first unalignedNumber records in sample mode
+#returns the total number of records written to the file so far
+def writeUnalignedRecords(unalignedFile, unalignedRecords, unalignedMode, unalignedNumber, numUnalignedWritten):
+	if unalignedMode == 'sample':
+		unalignedRecords = unalignedRecords[:max(unalignedNumber - numUnalignedWritten, 0)]
+
+	unalignedFile.write(''.join(unalignedRecords))
+
+	return numUnalignedWritten + len(unalignedRecords)
+
+#save the unaligned reads at the given positions of a batch according to unalignedMode, naming them by the line number
+#of their sequence in the original file; returns the updated number of reads written to unalignedFile
+def saveUnalignedReads(unalignedFile, unalignedSeqCounts, seqBatch, unalignedPositions, firstRead, linesPerRead, 
+		unalignedMode, unalignedNumber, numUnalignedWritten):
+	if unalignedMode == 'collapsed':
+		unalignedSeqCounts.update([seqBatch[i] for i in unalignedPositions.tolist()])
+		pruneUnalignedSeqCounts(unalignedSeqCounts, unalignedNumber)
+
+	elif unalignedFile is not None and (unalignedMode != 'sample' or numUnalignedWritten < unalignedNumber):
+		if unalignedMode == 'sample':
+			unalignedPositions = unalignedPositions[:unalignedNumber - numUnalignedWritten]
+
+		numUnalignedWritten = writeUnalignedRecords(unalignedFile, 
+			['>%d\n%s\n' % ((firstRead + i) * linesPerRead + 1, seqBatch[i]) for i in unalignedPositions.tolist()], 
+			unalignedMode, unalignedNumber, numUnalignedWritten)
+
+	return numUnalignedWritten
+
+#write the most frequent unaligned sequences and their read counts, most frequent first
+def writeCollapsedUnalignedFile(collapsedFileName, unalignedSeqCounts, unalignedNumber):
+	with open(collapsedFileName, 'w') as collapsedFile:
+		collapsedFile.write(''.join(['%s\t%d\n' % seqTup for seqTup in getTopUnalignedSeqs(unalignedSeqCounts, unalignedNumber)]))
+
+#the numSeqs most frequent sequences of a tally of unaligned sequences, as (sequence, read count) pairs, most frequent first
+def getTopUnalignedSeqs(unalignedSeqCounts, numSeqs):
+	return heapq.nsmallest(numSeqs, unalignedSeqCounts.iteritems(), key=lambda seqTup: (-seqTup[1], seqTup[0]))
+
+#cut a tally of unaligned sequences down to its collapsedKeepFactor * unalignedNumber most frequent sequences once it
+#holds twice that many, so collapsing takes bounded memory however many distinct unaligned reads a file has
+#counts are exact for files with fewer distinct unaligned sequences than that; otherwise a sequence that was cut and
+#comes back is counted again from 0, so the counts listed are lower bounds
+def pruneUnalignedSeqCounts(unalignedSeqCounts, unalignedNumber):
+	keepNumber = collapsedKeepFactor * unalignedNumber
+	if len(unalignedSeqCounts) > 2 * keepNumber:
+		keptSeqs = getTopUnalignedSeqs(unalignedSeqCounts, keepNumber)
+		unalignedSeqCounts.clear()
+		unalignedSeqCounts.update(dict(keptSeqs))
+
+
+#look up a batch of trimmed reads, returning an array of library sequence indices (-1 for unaligned reads)
+#and the number of reads that only aligned with a mismatch
+def alignSeqBatch(seqBatch, libraryFasta, mismatches=0):
+	seqIndices = map(loadLibraryFasta(libraryFasta).seqToIndex.get, seqBatch, itertools.repeat(-1, len(seqBatch)))
+	numMismatched = 0
+
+	if mismatches > 0:
+		mismatchDict = loadMismatchIndex(libraryFasta)
+		numExact = len(seqIndices) - seqIndices.count(-1)
+		seqIndices = [seqIndex if seqIndex != -1 else mismatchDict.get(seq, -1) for seq, seqIndex in zip(seqBatch, seqIndices)]
+		numMismatched = len(seqIndices) - seqIndices.count(-1) - numExact
+
+	return np.array(seqIndices, dtype=np.int64), numMismatched
+
+#generate lists of trimmed read sequences from a sequencing file, one list per block of whole records read
+def readSeqBatches(infile, linesPerRead, startIndex=None, stopIndex=None, blockSize=None, maxBytes=None):
+	for recordBlock in readRecordBlocks(infile, linesPerRead, blockSize, maxBytes):
+		yield getBlockSeqs(recordBlock, linesPerRead, startIndex, stopIndex)
+
+#pull the trimmed sequence line out of every record in a block with one split and slice, skipping header
+#and quality lines without looking at them; map with C callables avoids running a bytecode loop per read
+def getBlockSeqs(recordBlock, linesPerRead, startIndex=None, stopIndex=None, staggerStarts=None, libraryFasta=None):
+	return trimSeqLines(getBlockLines(recordBlock)[1::linesPerRead], startIndex, stopIndex, staggerStarts, libraryFasta)
+
+def getBlockLines(recordBlock):
+	if '\r' in recordBlock:
+		recordBlock = recordBlock.replace('\r', '')
+
+	return recordBlock.split('\n')
+
+#with staggerStarts, reads that do not match a library sequence exactly are trimmed to the same length at each of those
+#start offsets in turn, keeping the first trim that does, so reads with variable length spacers are counted at their
+#own offset; mismatches are only looked for at startIndex
+def trimSeqLines(seqLines, startIndex=None, stopIndex=None, staggerStarts=None, libraryFasta=None):
+	if startIndex is None and stopIndex is None:
+		seqs = seqLines
+	else:
+		seqs = map(operator.itemgetter(slice(startIndex, stopIndex)), seqLines)
+
+	if staggerStarts:
+		seqToIndex = loadLibraryFasta(libraryFasta).seqToIndex
+		missingPositions = list(itertools.compress(xrange(len(seqs)), map(operator.not_, map(seqToIndex.__contains__, seqs))))
+
+		for staggerStart in staggerStarts:
+			staggerSlice = slice(staggerStart, staggerStart + stopIndex - startIndex)
+
+			stillMissing = []
+			for i in missingPositions:
+				seq = seqLines[i][staggerSlice]
+				if seq in seqToIndex:
+					seqs[i] = seq
+				else:
+					stillMissing.append(i)
+
+			missingPositions = stillMissing
+
+	return seqs
+
+#generate strings of whole records from a sequencing file, reading large blocks instead of iterating over lines
+#set maxBytes to stop after that many bytes, as when reading a single shard of a file
+def readRecordBlocks(infile, linesPerRead, blockSize=None, maxBytes=None):
+	if blockSize is None:
+		blockSize = recordBlockSize
+
+	leftover = ''
+	bytesLeft = maxBytes
+
+	while True:
+		readSize = blockSize if bytesLeft is None else min(blockSize, bytesLeft)
+		block = infile.read(readSize) if readSize > 0 else ''
+
+		if block == '':
+			if leftover.strip() != '':
+				yield leftover
+			return
+
+		if bytesLeft is not None:
+			bytesLeft -= len(block)
+
+		#cut the block after the last newline that ends a whole record and carry the rest over
+		block = leftover + block
+		cut = block.rfind('\n') + 1
+		for extraLine in range(block.count('\n', 0, cut) % linesPerRead):
+			cut = block.rfind('\n', 0, cut - 1) + 1
+
+		leftover = block[cut:]
+		if cut > 0:
+			yield block[:cut]
+
+
+#split a plain text sequencing file into up to numShards byte ranges that each begin at the start of a record
+def getShardByteRanges(infileName, linesPerRead, numShards):
+	fileSize = os.path.getsize(infileName)
+	boundaries = [0]
+
+	with open(infileName) as infile:
+		for shardNum in range(1, numShards):
+			boundary = findRecordStart(infile, shardNum * fileSize // numShards, linesPerRead)
+			if boundaries[-1] < boundary < fileSize:
+				boundaries.append(boundary)
+
+	boundaries.append(fileSize)
+
+	return zip(boundaries[:-1], boundaries[1:])
+
+#return the byte offset of the first record starting at or after byteOffset
+#fastq quality lines can begin with @, so a header is only accepted when the line two below it begins with +
+def findRecordStart(infile, byteOffset, linesPerRead):
+	if byteOffset == 0:
+		return 0
+
+	infile.seek(byteOffset - 1)
+	infile.readline()
+
+	lineStarts, lines = [], []
+	while True:
+		lineStarts.append(infile.tell())
+		lines.append(infile.readline())
+
+		if lines[-1] == '':
+			return lineStarts[-1]
+		elif linesPerRead == 2 and lines[-1][:1] == '>':
+			return lineStarts[-1]
+		elif linesPerRead == 4 and len(lines) >= 3 and lines[-3][:1] == '@' and lines[-1][:1] == '+':
+			return lineStarts[-3]
 
 
 ### Map File to Counts File Functions ###
 
+#library sequences are assigned integer indices so that reads can be tallied in an array; sequences shared by several
+#library elements are fanned out to each element only once the counts are written
+LibraryIndex = collections.namedtuple('LibraryIndex', ['seqToIndex', 'elementIds', 'fanoutElements', 'fanoutSeqs', 'readLength'])
+
 def parseLibraryFasta(libraryFasta):
-	seqToIds, idsToReadcounts, readLengths = dict(), dict(), []
+	seqToIndex, readLengths = dict(), []
+	recordIds, recordSeqIndices = [], []
 
 	curSeqId = ''
 	curSeq = ''
@@ -102,11 +1140,11 @@ def parseLibraryFasta(libraryFasta):
 		for line in infile:
 			if line[0] == '>':
 				if curSeqId != '' and curSeq != '':
-					if curSeq not in seqToIds:
-						seqToIds[curSeq] = []
-					seqToIds[curSeq].append(curSeqId)
+					if curSeq not in seqToIndex:
+						seqToIndex[curSeq] = len(seqToIndex)
 
-					idsToReadcounts[curSeqId] = 0
+					recordIds.append(curSeqId)
+					recordSeqIndices.append(seqToIndex[curSeq])
 
 					readLengths.append(len(curSeq))
 					
@@ -116,16 +1154,207 @@ def parseLibraryFasta(libraryFasta):
 			else:
 				curSeq += line.strip().upper()
 
-	if len(seqToIds) == 0 or len(idsToReadcounts) == 0 or readLengths[0] == 0:
+	if len(seqToIndex) == 0 or len(recordIds) == 0 or readLengths[0] == 0:
 		raise ValueError('library fasta could not be parsed or contains no sequences')
 	elif max(readLengths) != min(readLengths):
 		print min(readLengths), max(readLengths)
 		raise ValueError('library reference sequences are of inconsistent lengths')
 
-	return seqToIds, idsToReadcounts, readLengths[0]
+	elementIds = sorted(set(recordIds))
+	elementCodes = dict((elementId, i) for i, elementId in enumerate(elementIds))
+
+	return LibraryIndex(seqToIndex, elementIds, np.array([elementCodes[recordId] for recordId in recordIds], dtype=np.int64),
+		np.array(recordSeqIndices, dtype=np.int64), readLengths[0])
+
+#load a library index once per process; pool workers forked after the library was loaded inherit it without reloading
+def loadLibraryFasta(libraryFasta):
+	if libraryFasta not in parsedLibraries:
+		parsedLibraries[libraryFasta] = loadLibraryIndexFile(libraryFasta)
+
+	return parsedLibraries[libraryFasta]
+
+#load the compiled binary index stored next to the library fasta, parsing the fasta and writing a new index
+#if the index is missing or the fasta has changed since it was compiled
+#a fasta whose modification time changed but whose contents did not (after a touch, copy or checkout) keeps its index,
+#which is written again with the new time so that later loads do not hash the fasta again
+def loadLibraryIndexFile(libraryFasta):
+	indexFileName = libraryFasta + libraryIndexExtension
+	fastaMtime = os.path.getmtime(libraryFasta)
+	fastaMd5 = None
+
+	try:
+		indexHeader, indexArrays = readArrayFile(indexFileName)
+	except (IOError, OSError, ValueError, KeyError):
+		indexHeader = None
+
+	if indexHeader is not None and indexHeader['version'] == libraryIndexVersion:
+		if indexHeader['fasta_mtime'] != fastaMtime:
+			fastaMd5 = getFileMd5(libraryFasta)
+
+		if fastaMd5 is None or indexHeader['fasta_md5'] == fastaMd5:
+			sequences = indexArrays['sequences'].tolist()
+
+			libraryIndex = LibraryIndex(dict(zip(sequences, range(len(sequences)))), indexArrays['element_ids'].tolist(),
+				indexArrays['fanout_elements'], indexArrays['fanout_seqs'], indexHeader['read_length'])
+
+			if fastaMd5 is None:
+				return libraryIndex
+		else:
+			libraryIndex = parseLibraryFasta(libraryFasta)
+	else:
+		libraryIndex = parseLibraryFasta(libraryFasta)
+
+	try:
+		writeLibraryIndexFile(indexFileName, libraryIndex, fastaMtime, getFileMd5(libraryFasta) if fastaMd5 is None else fastaMd5)
+	except (IOError, OSError):
+		printNow('Library index could not be written to %s' % indexFileName)
+
+	return libraryIndex
+
+#the index file is a single line json header followed by the raw bytes of each array, so arrays can be memory-mapped
+def writeLibraryIndexFile(indexFileName, libraryIndex, fastaMtime, fastaMd5):
+	indexArrays = [('sequences', np.array(sorted(libraryIndex.seqToIndex, key=libraryIndex.seqToIndex.get), dtype='S%d' % libraryIndex.readLength)),
+		('element_ids', np.array(libraryIndex.elementIds, dtype=np.string_)),
+		('fanout_elements', np.asarray(libraryIndex.fanoutElements, dtype=np.int64)),
+		('fanout_seqs', np.asarray(libraryIndex.fanoutSeqs, dtype=np.int64))]
+
+	writeArrayFile(indexFileName, {'version':libraryIndexVersion, 'fasta_mtime':fastaMtime, 'fasta_md5':fastaMd5, 
+		'read_length':libraryIndex.readLength}, indexArrays)
+
+#write a json header line and a list of (name, array) pairs, each array starting on a 64 byte boundary
+def writeArrayFile(arrayFileName, header, namedArrays):
+	arrayEntries = []
+	arrayOffset = 0
+	for arrayName, namedArray in namedArrays:
+		arrayEntries.append((arrayName, namedArray.dtype.str, len(namedArray), arrayOffset))
+		arrayOffset += -(-namedArray.nbytes // 64) * 64
+
+	header = dict(header, arrays=arrayEntries)
+	headerLine = json.dumps(header)
+	headerLine += ' ' * (-(len(headerLine) + 1) % 64) + '\n'
+
+	#write to a temporary file first so that concurrent runs never see a partial file
+	tempFileName = '%s.tmp%d' % (arrayFileName, os.getpid())
+	with open(tempFileName, 'wb') as arrayFile:
+		arrayFile.write(headerLine)
+		for (arrayName, namedArray), arrayEntry in zip(namedArrays, arrayEntries):
+			arrayFile.seek(len(headerLine) + arrayEntry[3])
+			arrayFile.write(namedArray.tobytes())
+
+	os.rename(tempFileName, arrayFileName)
+
+def readArrayFile(arrayFileName):
+	with open(arrayFileName, 'rb') as arrayFile:
+		headerLine = arrayFile.readline()
+
+	header = json.loads(headerLine)
+
+	namedArrays = dict()
+	for arrayName, dtypeString, arrayLength, arrayOffset in header['arrays']:
+		namedArrays[arrayName] = np.memmap(arrayFileName, dtype=np.dtype(str(dtypeString)), mode='r', 
+			offset=len(headerLine) + arrayOffset, shape=(arrayLength,))
+
+	return header, namedArrays
+
+#build a lookup of every sequence one substitution away from a library sequence, so that reads with a single
+#sequencing error are assigned with one extra dict lookup; neighbors of more than one library sequence are left out
+#as ambiguous, and neighbors that are themselves library sequences are left to the exact match
+def buildMismatchIndex(libraryIndex):
+	seqToIndexDict = libraryIndex.seqToIndex
+	neighborToIndex = dict()
+	ambiguousNeighbors = set()
+
+	for seq, seqIndex in seqToIndexDict.iteritems():
+		for i in range(len(seq)):
+			for base in mismatchBases:
+				if base == seq[i]:
+					continue
+
+				neighbor = seq[:i] + base + seq[i+1:]
+				if neighborToIndex.setdefault(neighbor, seqIndex) != seqIndex:
+					ambiguousNeighbors.add(neighbor)
+
+	for neighbor in ambiguousNeighbors:
+		del neighborToIndex[neighbor]
+
+	for seq in seqToIndexDict:
+		neighborToIndex.pop(seq, None)
+
+	return neighborToIndex
+
+def loadMismatchIndex(libraryFasta):
+	if libraryFasta not in mismatchIndices:
+		mismatchIndices[libraryFasta] = buildMismatchIndex(loadLibraryFasta(libraryFasta))
+
+	return mismatchIndices[libraryFasta]
+
+#add one count for each entry in a list or array of library sequence indices
+def addSeqCounts(seqCounts, seqIndices):
+	if len(seqIndices) > 0:
+		seqCounts += np.bincount(seqIndices, minlength=len(seqCounts))
+
+#convert counts per library sequence into counts per library element
+def getElementCounts(libraryIndex, seqCounts):
+	elementCounts = np.zeros(len(libraryIndex.elementIds), dtype=np.int64)
+	np.add.at(elementCounts, libraryIndex.fanoutElements, seqCounts[libraryIndex.fanoutSeqs])
+
+	return elementCounts
+
+#write counts per library element as sorted id/count text lines, as a memory-mappable counts array file, or both
+def writeCountsFile(countFileName, libraryIndex, seqCounts):
+	elementCounts = getElementCounts(libraryIndex, seqCounts)
+
+	if countsFormat in ('text','both'):
+		with open(countFileName,'w') as countFile:
+			for countTup in zip(libraryIndex.elementIds, elementCounts):
+				countFile.write('%s\t%d\n' % countTup)
+
+	if countsFormat in ('binary','both'):
+		writeCountsArrayFile(countFileName + countsArrayExtension, libraryIndex.elementIds, elementCounts)
+
+#the counts array file holds the element ids and their counts in the same order, with a fingerprint of the ids in the header
+#so that a reader holding the same library can use the counts directly without looking up any ids
+def writeCountsArrayFile(arrayFileName, elementIds, elementCounts):
+	writeArrayFile(arrayFileName, {'version':countsArrayVersion, 'library_fingerprint':getLibraryFingerprint(elementIds)}, 
+		[('element_ids', np.array(elementIds, dtype=np.string_)), ('counts', np.asarray(elementCounts, dtype=np.int64))])
+
+def readCountsArrayFile(arrayFileName):
+	arrayHeader, countsArrays = readArrayFile(arrayFileName)
+	if arrayHeader['version'] != countsArrayVersion:
+		raise ValueError('counts array file %s was written by an incompatible version' % arrayFileName)
+
+	return arrayHeader['library_fingerprint'], countsArrays['element_ids'], countsArrays['counts']
+
+#the counts array file to read for a counts file name: the name itself if it is a counts array file, otherwise the array
+#written next to the text file if it is at least as new; None if there is only the text file
+def getCountsArrayFileName(countFileName):
+	if countFileName.endswith(countsArrayExtension):
+		return countFileName
+
+	arrayFileName = countFileName + countsArrayExtension
+	if os.path.exists(arrayFileName) and (not os.path.exists(countFileName) or os.path.getmtime(arrayFileName) >= os.path.getmtime(countFileName)):
+		return arrayFileName
+
+	return None
+
+def getLibraryFingerprint(elementIds):
+	return hashlib.md5('\n'.join(elementIds)).hexdigest()
 
 
 ### Utility Functions ###
+def getSeqFileType(infileName):
+	for fileTup in acceptedFileTypes:
+		if fnmatch.fnmatch(infileName,fileTup[0]):
+			fileType = fileTup[1]
+			break
+	else:
+		raise ValueError('Sequencing file type not recognized!')
+
+	if fileType == 'fa':
+		return fileType, 2
+	else:
+		return fileType, 4
+
 def parseSeqFileNames(fileNameList):
 	infileList = []
 	outfileBaseList = []
@@ -146,6 +1375,14 @@ def makeDirectory(path):
 		#printNow(path + ' already exists')
 		pass
 
+def getFileMd5(fileName):
+	fileHash = hashlib.md5()
+	with open(fileName, 'rb') as infile:
+		for block in iter(lambda: infile.read(2**20), ''):
+			fileHash.update(block)
+
+	return fileHash.hexdigest()
+
 def printNow(printInput):
 	print printInput
 	sys.stdout.flush()
@@ -161,6 +1398,42 @@ acceptedFileTypes = [('*.fastq.gz','fqgz'),
 
 testLines = 10000
 
+autoTrimReads = 10000 #reads at the start of each file used to detect trimming
+staggerFraction = 0.01 #other start offsets matching at least this fraction of those reads are also used to count staggered reads
+
+recordBlockSize = 2**22 #bytes of sequencing file read and counted at a time
+renumberBatchRecords = 100000 #unaligned reads renamed at a time when merging the part files of byte range shards
+
+compressedChunkSize = 2**22 #bytes of compressed input read at a time by the zlib and pigz decompression backends
+decompressedBufferSize = 2**20
+bgzfBlocksPerBatch = 256 #blocked gzip blocks (up to 64KB each) decompressed together
+
+#file name endings for each way of handling unaligned reads; off still names the file that would have been written
+unalignedFileSuffixes = {'fasta':'_unaligned.fa',
+						'gzip':'_unaligned.fa.gz',
+						'sample':'_unaligned_sample.fa',
+						'collapsed':'_unaligned_collapsed.txt',
+						'off':'_unaligned.fa'}
+collapsedKeepFactor = 10 #sequences kept while collapsing unaligned reads, as a multiple of the number listed (see pruneUnalignedSeqCounts)
+
+metricsStages = ['decompress', 'parse', 'lookup', 'write'] #decompress includes reading uncompressed files from disk
+progressInterval = 60 #seconds between progress reports from each process counting reads; 0 turns them off
+metricsFileName = 'counting_metrics.json'
+
+parsedLibraries = dict()
+
+mismatchIndices = dict()
+mismatchBases = 'ACGTN'
+
+undeterminedSampleName = 'Undetermined' #counts file name of reads with unrecognized indices when demultiplexing
+
+libraryIndexExtension = '.index'
+libraryIndexVersion = 1
+
+countsFormat = 'both' #write counts files as text, as counts arrays, or both
+countsArrayExtension = '.array' #appended to the counts file name
+countsArrayVersion = 1
+
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='Process raw sequencing data from screens to counts files in parallel')
@@ -171,51 +1444,166 @@ if __name__ == '__main__':
 	parser.add_argument('-p','--processors', type=int, default = 1)
 	parser.add_argument('--trim_start', type=int)
 	parser.add_argument('--trim_end', type=int)
+	parser.add_argument('--auto_trim', action='store_true', default=False, help='Detect trimming for each file before counting by matching its first reads against the library at every offset, instead of using --trim_start and --trim_end. Other offsets matching at least %.0f%% of those reads are also tried for reads that do not match at the best one, as when spacers of different lengths stagger the reads.' % (staggerFraction * 100))
+	parser.add_argument('--auto_trim_reads', type=int, default=autoTrimReads, help='Reads at the start of each file used by --auto_trim. Default is %d.' % autoTrimReads)
 	parser.add_argument('--test', action='store_true', default=False, help='Run the entire script on only the first %d reads of each file. Be sure to delete or move all test files before re-running script as they will not be overwritten.' % testLines)
+	parser.add_argument('--mismatches', type=int, default=0, choices=[0,1], help='Also count reads with this many mismatches to a single library sequence. Reads within one mismatch of more than one library sequence are left unaligned. Default is 0.')
+	parser.add_argument('--unaligned_reads', default='fasta', choices=['fasta','gzip','sample','collapsed','off'], help='How to save reads that do not align to the library: fasta (all reads), gzip (all reads, gzipped fasta), sample (the first N reads), collapsed (a table of the N most frequent unaligned sequences and their read counts, tallying at most %dN distinct sequences at a time so that counts are lower bounds for files with more), or off. Default is fasta.' % (2 * collapsedKeepFactor))
+	parser.add_argument('--unaligned_number', type=int, default=10000, help='N for the sample and collapsed unaligned read modes. Default is 10000.')
+	parser.add_argument('--decompression', default='auto', choices=['auto','pigz','bgzf','zlib','gzip'], help='How to decompress *.fastq.gz files: pigz (pipe from a pigz subprocess), bgzf (parallel decompression of bgzip files), zlib, or gzip (the gzip module). auto picks bgzf for bgzip files, then pigz if it is installed, then zlib. Default is auto.')
+	parser.add_argument('--decompression_threads', type=int, default=4, help='Threads used for each file by the pigz and bgzf decompression backends. Default is 4.')
+	parser.add_argument('--split_files', action='store_true', default=False, help='Process files one at a time, splitting each file across all processors. Faster when there are fewer (or much larger) files than processors.')
+	parser.add_argument('--progress_interval', type=float, default=progressInterval, help='Seconds between progress reports (reads/s, MB/s and time left) from each process while counting. 0 turns them off. Default is %d.' % progressInterval)
+	parser.add_argument('--sample_sheet', help='Tab-delimited file of index sequences and sample names for demultiplexing while counting. Each sequencing file is treated as a raw lane of pooled samples, and one counts file is written per sample (summed over all sequencing files) plus one for reads with unrecognized indices. --split_files is ignored when demultiplexing.')
+	parser.add_argument('--index_reads', nargs='+', help='Index read file(s) holding the index sequence of each read, one per sequencing file and in the same order. By default the index sequence is read from the end of each read header (e.g. 1:N:0:ATCACG).')
+	parser.add_argument('--counts_format', default=countsFormat, choices=['text','binary','both'], help='Write counts as text files of ids and counts, as binary counts arrays (named after the text file with %s appended) that process_experiments.py reads without parsing, or both. process_experiments.py reads the array when it is at least as new as the text file. Default is %s.' % (countsArrayExtension, countsFormat))
+	parser.add_argument('--barcode_mismatches', type=int, default=1, choices=[0,1], help='Assign reads to a sample when their index sequence has up to this many mismatches, unless it is equally close to two samples. Default is 1.')
 
 	args = parser.parse_args()
 	#printNow(args)
 
 	###catch input mistakes###
 	numProcessors = max(args.processors, 1)
+	progressInterval = max(args.progress_interval, 0)
+	countsFormat = args.counts_format
+	runStartTime = time.time()
 
 	infileList, outfileBaseList = parseSeqFileNames(args.Seq_File_Names)
 	if len(infileList) == 0:
 		sys.exit('Input error: no sequencing files found')
 			
 	try:
-		seqToIdDict, idsToReadcountDict, expectedReadLength = parseLibraryFasta(args.Library_Fasta)
+		#loaded before the pool is created so that every worker shares this copy of the index
+		libraryIndex = loadLibraryFasta(args.Library_Fasta)
 			
 		printNow('Library file loaded successfully:\n\t%.2E elements (%.2E unique sequences)\t%dbp reads expected' \
-				% (len(idsToReadcountDict), len(seqToIdDict), expectedReadLength))
+				% (len(libraryIndex.elementIds), len(libraryIndex.seqToIndex), libraryIndex.readLength))
 		
-	except IOError:
+	except (IOError, OSError):
 		sys.exit('Input error: library fasta file not found')
 		
 	except ValueError as err:
 		sys.exit('Input error: ' + err.args[0])
+
+	if args.decompression == 'pigz' and distutils.spawn.find_executable('pigz') is None:
+		sys.exit('Input error: pigz decompression requested but pigz was not found')
+
+	if args.sample_sheet is not None:
+		try:
+			sampleSheet = parseSampleSheet(args.sample_sheet, args.barcode_mismatches)
+		except IOError:
+			sys.exit('Input error: sample sheet not found')
+		except ValueError as err:
+			sys.exit('Input error: ' + err.args[0])
+
+		printNow('Sample sheet loaded successfully:\n\t%d samples\t%dbp indices' % (len(sampleSheet.sampleNames), sampleSheet.barcodeLength))
+
+		if args.index_reads is None:
+			indexFileList = [None] * len(infileList)
+		else:
+			indexFileList = parseSeqFileNames(args.index_reads)[0]
+			if len(indexFileList) != len(infileList):
+				sys.exit('Input error: %d index read files found for %d sequencing files' % (len(indexFileList), len(infileList)))
+
+	elif args.index_reads is not None:
+		sys.exit('Input error: index read files can only be used with a sample sheet')
+
+	if args.mismatches > 0:
+		printNow('Building index of library sequences with %d mismatch' % args.mismatches)
+		mismatchDict = loadMismatchIndex(args.Library_Fasta)
+		printNow('\t%.2E unambiguous mismatched sequences' % len(mismatchDict))
+	
 	
+	trimList = None
+	if args.auto_trim:
+		if args.trim_start is not None or args.trim_end is not None:
+			sys.exit('Input error: --auto_trim cannot be combined with --trim_start or --trim_end')
+
+		printNow('Detecting trimming from the first %d reads of each file' % args.auto_trim_reads)
+
+		try:
+			trimList = []
+			for infileName in infileList:
+				startIndex, stopIndex, staggerStarts, matchFraction = detectTrim(infileName, args.Library_Fasta, args.auto_trim_reads, 
+					args.decompression, args.decompression_threads)
+				trimList.append((startIndex, stopIndex, staggerStarts))
+
+				printNow('\t%s: trim %d to %d (%.2f%% of reads matching)%s' % (infileName, startIndex, stopIndex, matchFraction * 100, 
+					'\tstaggered reads also counted from ' + ', '.join([str(offset) for offset in staggerStarts]) if staggerStarts else ''))
+
+		except (ValueError, IOError) as err:
+			sys.exit('Input error: ' + ' '.join([str(arg) for arg in err.args]))
 	
 	trimmedFastaPath = os.path.join(args.Out_File_Path,'unaligned_reads')
-	makeDirectory(trimmedFastaPath)
+	if args.unaligned_reads != 'off':
+		makeDirectory(trimmedFastaPath)
 	countFilePath = os.path.join(args.Out_File_Path,'count_files')
 	makeDirectory(countFilePath)
 
-	fastaFileNameList = [outfileName + '_unaligned.fa' for outfileName in outfileBaseList] 
+	fastaFileNameList = [outfileName + unalignedFileSuffixes[args.unaligned_reads] for outfileName in outfileBaseList] 
 	fastaFilePathList = [os.path.join(trimmedFastaPath, fastaFileName) for fastaFileName in fastaFileNameList]
 	countFilePathList = [os.path.join(countFilePath,outfileName + '_' + os.path.split(args.Library_Fasta)[-1] + '.counts') for outfileName in outfileBaseList]
 
-	pool = multiprocessing.Pool(min(len(infileList),numProcessors))
+	if args.sample_sheet is not None:
+		sampleCountFilePathList = [os.path.join(countFilePath,sampleName + '_' + os.path.split(args.Library_Fasta)[-1] + '.counts') \
+			for sampleName in sampleSheet.sampleNames + [undeterminedSampleName]]
+
+	splitFiles = args.split_files and numProcessors > 1 and args.sample_sheet is None
+
+	if splitFiles:
+		pool = multiprocessing.Pool(numProcessors)
+	else:
+		pool = multiprocessing.Pool(min(len(infileList),numProcessors))
+
+	sampleResultList = []
 
 	try:
-		resultList = parallelSeqFileToCountsParallel(infileList, fastaFilePathList, countFilePathList, pool, args.Library_Fasta, args.trim_start, args.trim_end, args.test)
-	except ValueError as err:
-		sys.exit('Error while processing sequencing files: ' + ' '.join(err.args))
+		if args.sample_sheet is not None:
+			resultList, sampleResultList = parallelDemuxSeqFileToCounts(infileList, indexFileList, fastaFilePathList, sampleCountFilePathList, pool, args.Library_Fasta, sampleSheet, \
+				args.trim_start, args.trim_end, args.test, args.mismatches, args.unaligned_reads, args.unaligned_number, args.decompression, args.decompression_threads, trimList)
+		elif splitFiles:
+			if trimList is None:
+				trimList = [(args.trim_start, args.trim_end, None)]*len(infileList)
+
+			resultList = [(countFileName, shardedSeqFileToCounts(infileName, fastaFileName, countFileName, pool, numProcessors, args.Library_Fasta, startIndex, stopIndex, args.test, args.mismatches, \
+				args.unaligned_reads, args.unaligned_number, args.decompression, args.decompression_threads, staggerStarts)) \
+				for infileName, fastaFileName, countFileName, (startIndex, stopIndex, staggerStarts) in zip(infileList, fastaFilePathList, countFilePathList, trimList)]
+		else:
+			resultList = parallelSeqFileToCountsParallel(infileList, fastaFilePathList, countFilePathList, pool, args.Library_Fasta, args.trim_start, args.trim_end, args.test, args.mismatches, \
+				args.unaligned_reads, args.unaligned_number, args.decompression, args.decompression_threads, trimList)
+	except (ValueError, IOError) as err:
+		sys.exit('Error while processing sequencing files: ' + ' '.join([str(arg) for arg in err.args]))
 		
 	for filename, result in resultList:
+		print filename + ':\n\t%.2E reads\t%.2E aligning (%.2f%%)' % result[:3]
+		if args.mismatches > 0:
+			print '\t%.2E aligning with mismatches' % result[3]
+		if result[4] != 'none':
+			print '\tdecompressed with %s' % result[4]
+		print '\t%.2E reads/s\t%.1f MB/s\t(%s)' % (result[5]['reads_per_second'], result[5]['megabytes_per_second'], getStageString(result[5]))
+
+	for filename, result in sampleResultList:
 		print filename + ':\n\t%.2E reads\t%.2E aligning (%.2f%%)' % result
 	
 	pool.close()
 	pool.join()
 
+	fileMetricsList = []
+	for infileName, (filename, result) in zip(infileList, resultList):
+		fileMetrics = collections.OrderedDict([('sequencing_file', infileName), 
+											('counts_file', filename if args.sample_sheet is None else None), 
+											('aligning', result[1]), 
+											('mismatched', result[3]), 
+											('decompression', result[4])])
+		fileMetrics.update(result[5])
+		fileMetricsList.append(fileMetrics)
+
+	writeMetricsFile(os.path.join(args.Out_File_Path, metricsFileName), collections.OrderedDict([
+		('started', datetime.datetime.fromtimestamp(runStartTime).isoformat()), 
+		('seconds', time.time() - runStartTime), 
+		('processors', numProcessors), 
+		('split_files', splitFiles), 
+		('library_fasta', args.Library_Fasta), 
+		('files', fileMetricsList)]))
+
 	printNow('Done processing all sequencing files')
\ No newline at end of file
@@ -9,16 +9,23 @@ import scipy as sp
 from scipy import stats
 import fnmatch
 import argparse
+import multiprocessing
+import multiprocessing.pool
+import hashlib
+import json
 
 from expt_config_parser import parseExptConfig, parseLibraryConfig
-from fastqgz_to_counts import makeDirectory, printNow
+from fastqgz_to_counts import makeDirectory, printNow, getCountsArrayFileName, readCountsArrayFile, getLibraryFingerprint
 import screen_analysis
 
 defaultLibConfigName = 'library_config.txt'
+empiricalBatchValues = 2000000 #values resampled at once for calculate_empirical
+countsReadingThreads = 4 #counts files read at once when loading counts
+stageCacheVersion = 1 #change to invalidate all cached stages when stage computations change
 
 #a screen processing pipeline that requires just a config file and a directory of supported libraries
 #error checking in config parser is fairly robust, so not checking for input errors here
-def processExperimentsFromConfig(configFile, libraryDirectory, generatePlots='png'):
+def processExperimentsFromConfig(configFile, libraryDirectory, generatePlots='png', processors=1, binaryOutput='off', useCache=True, plotWorkers=1):
     #load in the supported libraries and sublibraries
     try:
         librariesToSublibraries, librariesToTables = parseLibraryConfig(os.path.join(libraryDirectory, defaultLibConfigName))
@@ -36,43 +43,72 @@ def processExperimentsFromConfig(configFile, libraryDirectory, generatePlots='pn
 
     makeDirectory(exptParameters['output_folder'])
     outbase = os.path.join(exptParameters['output_folder'],exptParameters['experiment_name'])
+    binaryOutput = screen_analysis.getBinaryFormat(binaryOutput)
+
+    #stages and columns whose settings and inputs match the last run are loaded from the cache instead of recomputed
+    stageCache = StageCache(outbase + '_cache' if useCache else None)
     
     if generatePlots != 'off':
         plotDirectory = os.path.join(exptParameters['output_folder'],exptParameters['experiment_name'] + '_plots')
         makeDirectory(plotDirectory)
     
         screen_analysis.changeDisplayFigureSettings(newDirectory=plotDirectory, newImageExtension = generatePlots, newPlotWithPylab = False)
+
+        #figures are drawn while the analysis continues, and plots are only marked as drawn in the cache once all are saved
+        plotScheduler = screen_analysis.PlotScheduler(plotWorkers)
+        drawnPlotKeys = []
     
 
     #load in library table and filter to requested sublibraries
     printNow('Accessing library information')
 
-    libraryTable = pd.read_csv(os.path.join(libraryDirectory, librariesToTables[exptParameters['library']]), sep = '\t', tupleize_cols=False, header=0, index_col=0).sort_index()
-    sublibColumn = libraryTable.apply(lambda row: row['sublibrary'].lower() in exptParameters['sublibraries'], axis=1)
+    libraryFileName = os.path.join(libraryDirectory, librariesToTables[exptParameters['library']])
+    libraryTable = pd.read_csv(libraryFileName, sep = '\t', tupleize_cols=False, header=0, index_col=0).sort_index()
+
+    libraryKey = stageCache.makeKey(stageCache.hashFile(libraryFileName), exptParameters['library'], sorted(exptParameters['sublibraries']))
+    cachedLibrary = stageCache.load('library', libraryKey)
+    if cachedLibrary is None:
+        sublibColumn = screen_analysis.getSublibraryMask(libraryTable, exptParameters['sublibraries'])
+        stageCache.save('library', libraryKey, pd.DataFrame({'in_sublibraries':sublibColumn}, index=libraryTable.index))
+    else:
+        sublibColumn = cachedLibrary['in_sublibraries'].values
 
     if sum(sublibColumn) == 0:
         print 'After limiting analysis to specified sublibraries, no elements are left'
         return
 
-    libraryTable[sublibColumn].to_csv(outbase + '_librarytable.txt', sep='\t', tupleize_cols = False)
+    #the filtered library table, negative control mask and gene codes shared by every later stage and plot
+    libraryView = screen_analysis.LibraryView(libraryTable, inSublibraries=sublibColumn)
+
+    libraryView.table.to_csv(outbase + '_librarytable.txt', sep='\t', tupleize_cols = False)
+    screen_analysis.writeBinaryTable(libraryView.table, outbase + '_librarytable', binaryOutput)
 
     #load in counts, create table of total counts in each and each file as a column
     printNow('Loading counts data')
 
+    countsKeys = {tup:stageCache.makeKey(libraryKey, tup[:2], stageCache.hashFile(getCountsArrayFileName(tup[2]) or tup[2])) 
+        for tup in exptParameters['counts_file_list']}
+    cachedCounts = stageCache.loadColumns('counts', countsKeys.values())
+
+    loadedCounts = loadCountsTable([tup for tup in sorted(set(exptParameters['counts_file_list'])) if countsKeys[tup] not in cachedCounts], 
+        libraryView.table.index)
+
     columnDict = dict()
     for tup in sorted(exptParameters['counts_file_list']):
         if tup in columnDict:
             print 'Asserting that tuples of condition, replicate, and count file should be unique; are the cases where this should not be enforced?'
             raise Exception('condition, replicate, and count file combination already assigned')
-        
-        countSeries = readCountsFile(tup[2]).reset_index().drop_duplicates('id').set_index('id') #for now also dropping duplicate ids in counts for overlapping linc sublibraries
-        countSeries = libraryTable[sublibColumn].align(countSeries, axis=0, join='left', fill_value=0)[1] #expand series to fill 0 for every missing entry
 
-        columnDict[tup] = countSeries['counts'] #[sublibColumn] #then shrink series to only desired sublibraries
+        if countsKeys[tup] in cachedCounts:
+            columnDict[tup] = cachedCounts[countsKeys[tup]].iloc[:,0]
+        else:
+            columnDict[tup] = loadedCounts[tup]
 
     # print columnDict
-    countsTable = pd.DataFrame(columnDict)#, index=libraryTable[sublibColumn].index)
+    countsTable = pd.DataFrame(columnDict)#, index=libraryView.table.index)
+    stageCache.saveColumns('counts', countsTable, [countsKeys[tup] for tup in countsTable.columns])
     countsTable.to_csv(outbase + '_rawcountstable.txt', sep='\t', tupleize_cols = False)
+    screen_analysis.writeBinaryTable(countsTable, outbase + '_rawcountstable', binaryOutput)
     countsTable.sum().to_csv(outbase + '_rawcountstable_summary.txt', sep='\t')
 
     #merge counts for same conditions/replicates, and create summary table
@@ -82,30 +118,41 @@ def processExperimentsFromConfig(configFile, libraryDirectory, generatePlots='pn
     exptGroups = countsTable.groupby(level=[0,1], axis=1)
     mergedCountsTable = exptGroups.aggregate(np.sum)
     mergedCountsTable.to_csv(outbase + '_mergedcountstable.txt', sep='\t', tupleize_cols = False)
+    screen_analysis.writeBinaryTable(mergedCountsTable, outbase + '_mergedcountstable', binaryOutput)
     mergedCountsTable.sum().to_csv(outbase + '_mergedcountstable_summary.txt', sep='\t')
     
-    if generatePlots != 'off' and max(exptGroups.count().iloc[0]) > 1:
+    countsPlotKey = stageCache.makeKey(generatePlots, sorted(countsKeys.values()))
+    plotCounts = generatePlots != 'off' and not stageCache.hasPlots('counts', countsPlotKey, plotDirectory)
+    countsFigures = []
+
+    if plotCounts and max(exptGroups.count().iloc[0]) > 1:
         printNow('-generating scatter plots of counts pre-merger')
     
-        tempDataDict = {'library': libraryTable[sublibColumn],
+        tempDataDict = {'library': libraryView.table,
+                        'library view': libraryView,
                         'premerged counts': countsTable,
                        'counts': mergedCountsTable}
 
+        plotJobs = []
         for (phenotype, replicate), countsCols in exptGroups:
             if len(countsCols.columns) == 1:
                 continue
             
             else:
-                screen_analysis.premergedCountsScatterMatrix(tempDataDict, phenotype, replicate)
+                plotJobs.append((screen_analysis.premergedCountsScatterMatrix, (phenotype, replicate), {}))
 
-    if generatePlots != 'off':
+        countsFigures.append(plotScheduler.submit(tempDataDict, plotJobs))
+
+    if plotCounts:
         printNow('-generating sgRNA read count histograms')
     
-        tempDataDict = {'library': libraryTable[sublibColumn],
+        tempDataDict = {'library': libraryView.table,
+                        'library view': libraryView,
                         'counts': mergedCountsTable}
                     
-        for (phenotype, replicate), countsCol in mergedCountsTable.iteritems():
-            screen_analysis.countsHistogram(tempDataDict, phenotype, replicate)
+        countsFigures.append(plotScheduler.submit(tempDataDict, [(screen_analysis.countsHistogram, (phenotype, replicate), {}) 
+            for (phenotype, replicate) in mergedCountsTable.columns]))
+        drawnPlotKeys.append(('counts', countsPlotKey, countsFigures))
     
     #create pairs of columns for each comparison, filter to na, then generate sgRNA phenotype score
     printNow('Computing sgRNA phenotype scores')
@@ -114,34 +161,52 @@ def processExperimentsFromConfig(configFile, libraryDirectory, generatePlots='pn
     phenotypeList = list(set(zip(*exptParameters['condition_tuples'])[0]))
     replicateList = sorted(list(set(zip(*exptParameters['counts_file_list'])[1])))
 
-    phenotypeScoreDict = dict()
-    for (phenotype, condition1, condition2) in exptParameters['condition_tuples']:
-        for replicate in replicateList:
-            column1 = mergedCountsTable[(condition1,replicate)]
-            column2 = mergedCountsTable[(condition2,replicate)]
-            filtCols = filterLowCounts(pd.concat((column1, column2), axis = 1), exptParameters['filter_type'], exptParameters['minimum_reads'])
-            
-
-            score = computePhenotypeScore(filtCols[(condition1, replicate)], filtCols[(condition2,replicate)], 
-                libraryTable[sublibColumn], growthValueDict[(phenotype,replicate)], 
-                exptParameters['pseudocount_behavior'], exptParameters['pseudocount'])
-
-            phenotypeScoreDict[(phenotype,replicate)] = score
+    comparisonList = [(phenotype, condition1, condition2, replicate, growthValueDict[(phenotype,replicate)]) 
+        for (phenotype, condition1, condition2) in exptParameters['condition_tuples'] for replicate in replicateList]
+
+    #merged counts columns are keyed by the counts columns summed into them
+    mergedKeys = {(condition, replicate):stageCache.makeKey(sorted(countsKeys[tup] for tup in countsKeys if tup[:2] == (condition, replicate))) 
+        for condition, replicate in mergedCountsTable.columns}
+    scoreSettings = (exptParameters['filter_type'], exptParameters['minimum_reads'], exptParameters['pseudocount_behavior'], exptParameters['pseudocount'])
+    comparisonKeys = {comparison:stageCache.makeKey(libraryKey, scoreSettings, comparison, mergedKeys[(comparison[1],comparison[3])], mergedKeys[(comparison[2],comparison[3])]) 
+        for comparison in comparisonList}
+    cachedScores = stageCache.loadColumns('phenotypes', comparisonKeys.values())
+
+    newComparisons = [comparison for comparison in comparisonList if comparisonKeys[comparison] not in cachedScores]
+    scoreTable = computePhenotypeScoreTable(mergedCountsTable, newComparisons, libraryView.table, 
+        exptParameters['filter_type'], exptParameters['minimum_reads'], exptParameters['pseudocount_behavior'], exptParameters['pseudocount'])
+
+    phenotypeScoreDict = {(phenotype,replicate):score for (phenotype,replicate), score in scoreTable.iteritems()}
+    phenotypeKeys = dict()
+    for comparison in comparisonList:
+        phenotypeKeys[(comparison[0],comparison[3])] = comparisonKeys[comparison]
+        if comparisonKeys[comparison] in cachedScores:
+            phenotypeScoreDict[(comparison[0],comparison[3])] = cachedScores[comparisonKeys[comparison]].iloc[:,0]
+
+    scoreTable = pd.DataFrame(phenotypeScoreDict)
+    stageCache.saveColumns('phenotypes', scoreTable, [phenotypeKeys[column] for column in scoreTable.columns])
+    phenotypesPlotKey = stageCache.makeKey(generatePlots, sorted(comparisonKeys.values()))
+    plotPhenotypes = generatePlots != 'off' and not stageCache.hasPlots('phenotypes', phenotypesPlotKey, plotDirectory)
+    phenotypesFigures = []
     
-    if generatePlots  != 'off':
-        tempDataDict = {'library': libraryTable[sublibColumn],
+    if plotPhenotypes:
+        tempDataDict = {'library': libraryView.table,
+                        'library view': libraryView,
                         'counts': mergedCountsTable,
                         'phenotypes': pd.DataFrame(phenotypeScoreDict)}
                         
         printNow('-generating phenotype histograms and scatter plots')
         
+        plotJobs = []
         for (phenotype, condition1, condition2) in exptParameters['condition_tuples']:
             for replicate in replicateList:
-                screen_analysis.countsScatter(tempDataDict, condition1, replicate, condition2, replicate, 
-                    colorByPhenotype_condition = phenotype, colorByPhenotype_replicate = replicate)
+                plotJobs.append((screen_analysis.countsScatter, (condition1, replicate, condition2, replicate), 
+                    {'colorByPhenotype_condition':phenotype, 'colorByPhenotype_replicate':replicate}))
                     
-                screen_analysis.phenotypeHistogram(tempDataDict, phenotype, replicate)
-                screen_analysis.sgRNAsPassingFilterHist(tempDataDict, phenotype, replicate)
+                plotJobs.append((screen_analysis.phenotypeHistogram, (phenotype, replicate), {}))
+                plotJobs.append((screen_analysis.sgRNAsPassingFilterHist, (phenotype, replicate), {}))
+
+        phenotypesFigures.append(plotScheduler.submit(tempDataDict, plotJobs))
     
     #scatterplot sgRNAs for all replicates, then average together and add columns to phenotype score table
     if len(replicateList) > 1:
@@ -150,135 +215,236 @@ def processExperimentsFromConfig(configFile, libraryDirectory, generatePlots='pn
         for phenotype in phenotypeList:
             repCols = pd.DataFrame({(phen,rep):col for (phen,rep), col in phenotypeScoreDict.iteritems() if phen == phenotype})
             phenotypeScoreDict[(phenotype,'ave_' + '_'.join(replicateList))] = repCols.mean(axis=1,skipna=False) #average nan and real to nan; otherwise this could lead to data points with just one rep informing results
+            phenotypeKeys[(phenotype,'ave_' + '_'.join(replicateList))] = stageCache.makeKey([phenotypeKeys[column] for column in repCols.columns])
 
     phenotypeTable = pd.DataFrame(phenotypeScoreDict)
     phenotypeTable.to_csv(outbase + '_phenotypetable.txt', sep='\t', tupleize_cols = False)
+    screen_analysis.writeBinaryTable(phenotypeTable, outbase + '_phenotypetable', binaryOutput)
 
-    if len(replicateList) > 1 and generatePlots != 'off':
-        tempDataDict = {'library': libraryTable[sublibColumn],
+    if len(replicateList) > 1 and plotPhenotypes:
+        tempDataDict = {'library': libraryView.table,
+                        'library view': libraryView,
                         'phenotypes': phenotypeTable}
                     
         printNow('-generating replicate phenotype histograms and scatter plots')
     
+        plotJobs = []
         for phenotype, phengroup in phenotypeTable.groupby(level=0, axis=1):
             for i, ((p, rep1), col1) in enumerate(phengroup.iteritems()):
                 if rep1[:4] == 'ave_':
-                    screen_analysis.phenotypeHistogram(tempDataDict, phenotype, rep1)
+                    plotJobs.append((screen_analysis.phenotypeHistogram, (phenotype, rep1), {}))
             
                 for j, ((p, rep2), col2) in enumerate(phengroup.iteritems()):
                     if rep2[:4] == 'ave_' or j<=i:
                         continue
                     
                     else:
-                        screen_analysis.phenotypeScatter(tempDataDict, phenotype, rep1, phenotype, rep2)                    
-                
+                        plotJobs.append((screen_analysis.phenotypeScatter, (phenotype, rep1, phenotype, rep2), {}))
+
+        phenotypesFigures.append(plotScheduler.submit(tempDataDict, plotJobs))
+
+    if plotPhenotypes:
+        drawnPlotKeys.append(('phenotypes', phenotypesPlotKey, phenotypesFigures))
 
     #generate pseudogenes
-    negTable = phenotypeTable.loc[libraryTable[sublibColumn].loc[:,'gene'] == 'negative_control',:]
+    negTable = phenotypeTable.loc[libraryView.negativeMask,:]
 
     if exptParameters['generate_pseudogene_dist'] != 'off' and len(exptParameters['analyses']) > 0:
         print 'Generating a pseudogene distribution from negative controls'
         sys.stdout.flush()
 
-        pseudoTableList = []
-        pseudoLibTables = []
-        negValues = negTable.values
-        negColumns = negTable.columns
-
-        if exptParameters['generate_pseudogene_dist'].lower() == 'manual':
-            for pseudogene in range(exptParameters['num_pseudogenes']):
-                randIndices = np.random.randint(0, len(negTable), exptParameters['pseudogene_size'])
-                pseudoTable = negValues[randIndices,:]
-                pseudoIndex = ['pseudo_%d_%d' % (pseudogene,i) for i in range(exptParameters['pseudogene_size'])]
-                pseudoSeqs = ['seq_%d_%d' % (pseudogene,i) for i in range(exptParameters['pseudogene_size'])] #so pseudogenes aren't treated as duplicates
-                pseudoTableList.append(pd.DataFrame(pseudoTable,index=pseudoIndex,columns=negColumns))
-                pseudoLib = pd.DataFrame({'gene':['pseudo_%d'%pseudogene]*exptParameters['pseudogene_size'],
-                    'transcripts':['na']*exptParameters['pseudogene_size'],
-                    'sequence':pseudoSeqs},index=pseudoIndex)
-                pseudoLibTables.append(pseudoLib)
-
-        elif exptParameters['generate_pseudogene_dist'].lower() == 'auto':
-            for pseudogene, (gene, group) in enumerate(libraryTable[sublibColumn].drop_duplicates(['gene','sequence']).groupby('gene')):
-                if gene == 'negative_control':
-                    continue 
-                for transcript, (transcriptName, transcriptGroup) in enumerate(group.groupby('transcripts')):
-                    randIndices = np.random.randint(0, len(negTable), len(transcriptGroup))
-                    pseudoTable = negValues[randIndices,:]
-                    pseudoIndex = ['pseudo_%d_%d_%d' % (pseudogene, transcript, i) for i in range(len(transcriptGroup))]
-                    pseudoSeqs = ['seq_%d_%d_%d' % (pseudogene, transcript, i) for i in range(len(transcriptGroup))]
-                    pseudoTableList.append(pd.DataFrame(pseudoTable,index=pseudoIndex,columns=negColumns))
-                    pseudoLib = pd.DataFrame({'gene':['pseudo_%d'%pseudogene]*len(transcriptGroup),
-                        'transcripts':['pseudo_transcript_%d'%transcript]*len(transcriptGroup),
-                        'sequence':pseudoSeqs},index=pseudoIndex)
-                    pseudoLibTables.append(pseudoLib)
+        pseudogeneSettings = (libraryKey, exptParameters['generate_pseudogene_dist'], exptParameters.get('num_pseudogenes'), 
+            exptParameters.get('pseudogene_size'), exptParameters['pseudogene_seed'])
 
+        if exptParameters['pseudogene_seed'] is None:
+            #without a seed, pseudogenes are drawn anew from numpy's global random state on every run and never loaded from the
+            #cache; their key includes the negative controls drawn, so gene scores are only reused for the same pseudogenes
+            pseudoLib, pseudoSources = generatePseudogenes(negTable, libraryView.table, exptParameters['generate_pseudogene_dist'].lower(), 
+                exptParameters.get('num_pseudogenes'), exptParameters.get('pseudogene_size'), np.random)
+            pseudogeneKey = stageCache.makeKey(pseudogeneSettings, pseudoSources.tolist())
         else:
-            print 'generate_pseudogene_dist parameter not recognized, defaulting to off'
+            #the negative controls drawn for each seeded pseudogene sgRNA are cached, so cached and new columns share pseudogenes
+            pseudogeneKey = stageCache.makeKey(*pseudogeneSettings)
+            cachedPseudogenes = stageCache.load('pseudogenes', pseudogeneKey)
+            if cachedPseudogenes is None:
+                pseudoLib, pseudoSources = generatePseudogenes(negTable, libraryView.table, exptParameters['generate_pseudogene_dist'].lower(), 
+                    exptParameters.get('num_pseudogenes'), exptParameters.get('pseudogene_size'), np.random.RandomState(exptParameters['pseudogene_seed']))
+                stageCache.save('pseudogenes', pseudogeneKey, pseudoLib.assign(negative_control=pseudoSources))
+            else:
+                pseudoLib = cachedPseudogenes.drop('negative_control', axis=1)
+                pseudoSources = cachedPseudogenes['negative_control']
 
-        phenotypeTable = phenotypeTable.append(pd.concat(pseudoTableList))
-        libraryTableGeneAnalysis = libraryTable[sublibColumn].append(pd.concat(pseudoLibTables))
+        phenotypeTable = phenotypeTable.append(pd.DataFrame(negTable.loc[pseudoSources.values].values, index=pseudoLib.index, columns=negTable.columns))
+        geneLibraryView = libraryView.append(pseudoLib)
     else:
-        libraryTableGeneAnalysis = libraryTable[sublibColumn]
+        pseudogeneKey = None
+        geneLibraryView = libraryView
 
     #compute gene scores for replicates, averaged reps, and pseudogenes
+    geneScoreKeys = []
     if len(exptParameters['analyses']) > 0:
         print 'Computing gene scores'
         sys.stdout.flush()
 
-        phenotypeTable_deduplicated = phenotypeTable.loc[libraryTableGeneAnalysis.drop_duplicates(['gene','sequence']).index]
-        if exptParameters['collapse_to_transcripts'] == True:
-            geneGroups = phenotypeTable_deduplicated.loc[libraryTableGeneAnalysis.loc[:,'gene'] != 'negative_control',:].groupby([libraryTableGeneAnalysis['gene'],libraryTableGeneAnalysis['transcripts']])
+        phenotypeTable_deduplicated = phenotypeTable.loc[geneLibraryView.table.drop_duplicates(['gene','sequence']).index]
+        genePhenotypeTable = phenotypeTable_deduplicated.loc[~geneLibraryView.negativeMask,:]
+        geneGroups = groupByGene(genePhenotypeTable, geneLibraryView, exptParameters['collapse_to_transcripts'] == True)
+
+        if 'calculate_empirical' in exptParameters['analyses'] and processors > 1:
+            processPool = multiprocessing.Pool(min(processors, len(phenotypeTable.columns)))
         else:
-            geneGroups = phenotypeTable_deduplicated.loc[libraryTableGeneAnalysis.loc[:,'gene'] != 'negative_control',:].groupby(libraryTableGeneAnalysis['gene'])
+            processPool = None
 
         analysisTables = []
         for analysis in exptParameters['analyses']:
             print '--' + analysis
             sys.stdout.flush()
 
-            analysisTables.append(applyGeneScoreFunction(geneGroups, negTable, analysis, exptParameters['analyses'][analysis]))
+            #each column's empirical resampling seed comes from pseudogene_seed, or without it is drawn anew on every run;
+            #the seeds are part of the keys, so unseeded empirical scores are never reused
+            if analysis == 'calculate_empirical':
+                columnSeeds = {column:getEmpiricalSeed(exptParameters['pseudogene_seed'], column) for column in phenotypeTable.columns}
+            else:
+                columnSeeds = {column:None for column in phenotypeTable.columns}
+
+            geneKeys = {column:stageCache.makeKey(phenotypeKeys[column], pseudogeneKey, exptParameters['collapse_to_transcripts'], analysis, exptParameters['analyses'][analysis], columnSeeds[column]) 
+                for column in phenotypeTable.columns}
+            cachedGeneScores = stageCache.loadColumns('genes_' + analysis, geneKeys.values())
+
+            #only phenotype columns without cached scores are scored; each gives a column for each of the analysis' scores
+            newColumns = [column for column in phenotypeTable.columns if geneKeys[column] not in cachedGeneScores]
+            columnTables = [cachedGeneScores[geneKeys[column]] for column in phenotypeTable.columns if geneKeys[column] in cachedGeneScores]
+            if len(newColumns) > 0:
+                columnTables.append(applyGeneScoreFunction(geneGroups.select(newColumns), negTable, analysis, exptParameters['analyses'][analysis], processPool, 
+                    [columnSeeds[column] for column in newColumns]))
+
+            analysisTable = pd.concat(columnTables, axis=1)
+            stageCache.saveColumns('genes_' + analysis, analysisTable, [geneKeys[column[1:]] for column in analysisTable.columns])
+            analysisTables.append(analysisTable)
+            geneScoreKeys.extend(geneKeys.values())
+
+        if processPool is not None:
+            processPool.close()
+            processPool.join()
 
         geneTable = pd.concat(analysisTables, axis=1).reorder_levels([1,2,0],axis=1).sort_index(axis=1)
         geneTable.to_csv(outbase + '_genetable.txt',sep='\t', tupleize_cols = False)
+        screen_analysis.writeBinaryTable(geneTable, outbase + '_genetable', binaryOutput)
 
         ### collapse the gene-transcript indices into a single score for a gene by best MW p-value, where applicable
         if exptParameters['collapse_to_transcripts'] == True and 'calculate_mw' in exptParameters['analyses']:
             print 'Collapsing transcript scores to gene scores'
             sys.stdout.flush()
 
-            geneTableCollapsed = scoreGeneByBestTranscript(geneTable)
+            collapsedKey = stageCache.makeKey(sorted(geneScoreKeys))
+            geneTableCollapsed = stageCache.load('genes_collapsed', collapsedKey)
+            if geneTableCollapsed is None:
+                geneTableCollapsed = scoreGeneByBestTranscript(geneTable)
+                stageCache.save('genes_collapsed', collapsedKey, geneTableCollapsed)
             geneTableCollapsed.to_csv(outbase + '_genetable_collapsed.txt',sep='\t', tupleize_cols = False)
+            screen_analysis.writeBinaryTable(geneTableCollapsed, outbase + '_genetable_collapsed', binaryOutput)
     
-    if generatePlots != 'off':
+    genesPlotKey = stageCache.makeKey(generatePlots, sorted(geneScoreKeys))
+    if generatePlots != 'off' and not stageCache.hasPlots('genes', genesPlotKey, plotDirectory):
+        genesFigures = []
         if 'calculate_ave' in exptParameters['analyses'] and 'calculate_mw' in exptParameters['analyses']:
-            tempDataDict = {'library': libraryTable[sublibColumn],
+            tempDataDict = {'library': libraryView.table,
+                            'library view': libraryView,
                             'gene scores': geneTableCollapsed if exptParameters['collapse_to_transcripts'] else geneTable}
                             
+            plotJobs = []
             for (phenotype, replicate), gtable in geneTableCollapsed.groupby(level=[0,1], axis=1):
                 if len(replicateList) == 1 or replicate[:4] == 'ave_': #just plot averaged reps where available
-                    screen_analysis.volcanoPlot(tempDataDict, phenotype, replicate, labelHits=True)
+                    plotJobs.append((screen_analysis.volcanoPlot, (phenotype, replicate), {'labelHits':True}))
+
+            genesFigures.append(plotScheduler.submit(tempDataDict, plotJobs))
+
+        drawnPlotKeys.append(('genes', genesPlotKey, genesFigures))
+
+    if generatePlots != 'off':
+        printNow('Waiting for figures to be saved')
+        plotScheduler.close()
+
+        #each stage's plots are recorded with the files of its figures, so they are redrawn if any go missing
+        for stage, plotKey, figureFileLists in drawnPlotKeys:
+            stageCache.setPlots(stage, plotKey, [fileName for figureFiles in figureFileLists for fileName in figureFiles])
 
     print 'Done!'
 
-#given a gene table indexed by both gene and transcript, score genes by the best m-w p-value per phenotype/replicate
+#build pseudogenes from negative control phenotypes sampled with replacement, as a library table and a Series of the
+#negative control drawn for each pseudogene sgRNA
+#manual: numPseudogenes pseudogenes of pseudogeneSize sgRNAs each
+#auto: one pseudogene for each gene and transcript of the library, with the same number of sgRNAs
+#every sgRNA is drawn with a single call to randomState.randint, in the same order as drawing one pseudogene at a time
+def generatePseudogenes(negTable, libraryTable, pseudogeneDist, numPseudogenes=None, pseudogeneSize=None, randomState=np.random):
+    if pseudogeneDist == 'manual':
+        pseudogeneNumbers = np.repeat(np.arange(numPseudogenes), pseudogeneSize)
+        guideNumbers = np.tile(np.arange(pseudogeneSize), numPseudogenes)
+
+        pseudoIndex = ['pseudo_%d_%d' % tup for tup in zip(pseudogeneNumbers, guideNumbers)]
+        pseudoSeqs = ['seq_%d_%d' % tup for tup in zip(pseudogeneNumbers, guideNumbers)] #so pseudogenes aren't treated as duplicates
+        pseudoTranscripts = ['na'] * len(pseudoIndex)
+
+    elif pseudogeneDist == 'auto':
+        #pseudogenes are numbered by the position of their gene in the sorted genes, negative controls included
+        dedupTable = libraryTable.drop_duplicates(['gene','sequence'])
+        geneIndex = dedupTable.groupby('gene').size().index
+        transcriptSizes = dedupTable.groupby(['gene','transcripts']).size()
+        transcriptSizes = transcriptSizes[transcriptSizes.index.get_level_values(0) != 'negative_control']
+
+        transcriptGenes = geneIndex.get_indexer(transcriptSizes.index.get_level_values(0))
+        geneStarts = np.r_[True, transcriptGenes[1:] != transcriptGenes[:-1]]
+        transcriptNumbers = np.arange(len(transcriptGenes)) - np.maximum.accumulate(np.where(geneStarts, np.arange(len(transcriptGenes)), 0))
+
+        sizes = transcriptSizes.values
+        pseudogeneNumbers = np.repeat(transcriptGenes, sizes)
+        transcriptNumbers = np.repeat(transcriptNumbers, sizes)
+        guideNumbers = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+
+        pseudoIndex = ['pseudo_%d_%d_%d' % tup for tup in zip(pseudogeneNumbers, transcriptNumbers, guideNumbers)]
+        pseudoSeqs = ['seq_%d_%d_%d' % tup for tup in zip(pseudogeneNumbers, transcriptNumbers, guideNumbers)]
+        pseudoTranscripts = ['pseudo_transcript_%d' % transcript for transcript in transcriptNumbers]
+
+    else:
+        raise ValueError('Pseudogene distribution %s not recognized' % pseudogeneDist)
+
+    randIndices = randomState.randint(0, len(negTable), len(pseudoIndex))
+    pseudoSources = pd.Series(negTable.index[randIndices], index=pseudoIndex)
+    pseudoLib = pd.DataFrame({'gene':['pseudo_%d' % pseudogene for pseudogene in pseudogeneNumbers], 
+        'transcripts':pseudoTranscripts, 
+        'sequence':pseudoSeqs}, index=pseudoIndex)
+
+    return pseudoLib, pseudoSources
+
+#given a gene table indexed by both gene and transcript, score genes by the best m-w p-value per phenotype/replicate;
+#the rows of every column are sorted at once by gene, then p-value (nans last), then table order, so the first row of
+#each gene is its transcript with the lowest p-value (the first such transcript on ties), and genes without a p-value
+#get a row of nans
 def scoreGeneByBestTranscript(geneTable):
-    geneTableTransGroups = geneTable.reorder_levels([2,0,1],axis=1)['Mann-Whitney p-value'].reset_index().groupby('gene')
+    geneCodes, geneNames = pd.factorize(geneTable.index.get_level_values('gene'), sort=True)
+    geneIndex = pd.Index(geneNames, name='gene')
+
+    tupList = sorted(set(column[:2] for column in geneTable.columns))
+    pvals = geneTable[[tup + ('Mann-Whitney p-value',) for tup in tupList]].values
+
+    rowNumbers = np.arange(len(geneTable))[:,np.newaxis].repeat(len(tupList), axis=1)
+    sortOrder = np.lexsort((rowNumbers, np.where(np.isnan(pvals), np.inf, pvals), geneCodes[:,np.newaxis].repeat(len(tupList), axis=1)), axis=0)
 
-    bestTranscriptFrame = geneTableTransGroups.apply(getBestTranscript)
+    geneSizes = np.bincount(geneCodes, minlength=len(geneIndex))
+    bestRows = sortOrder[np.cumsum(geneSizes) - geneSizes]
+    hasBest = ~np.isnan(pvals[bestRows, np.arange(len(tupList))])
 
-    tupList = []
+    transcripts = geneTable.index.get_level_values('transcripts')
     bestTransList = []
-    for tup, group in geneTable.groupby(level=range(2),axis=1):
-        tupList.append(tup)
-        curFrame = geneTable.loc[zip(bestTranscriptFrame.index,bestTranscriptFrame[tup]),tup]
-        bestTransList.append(curFrame.reset_index().set_index('gene'))
+    for i, tup in enumerate(tupList):
+        rows = bestRows[hasBest[:,i],i]
+        curFrame = geneTable[tup].iloc[rows]
+        curFrame.index = geneIndex[hasBest[:,i]]
+        curFrame.insert(0, 'transcripts', transcripts[rows])
+        bestTransList.append(curFrame.reindex(geneIndex))
 
     return pd.concat(bestTransList, axis=1, keys=tupList)
 
-def getBestTranscript(group):
-    #set the index to be transcripts and then get the index with the lowest p-value for each cell
-    return group.set_index('transcripts').drop(('gene',''),axis=1).idxmin() 
-
 
 #return Series of counts from a counts file indexed by element id
 def readCountsFile(countsFileName):
@@ -287,6 +453,73 @@ def readCountsFile(countsFileName):
     return countsTable['counts']
 
 
+#read counts files into a table of the library's elements with a column per (condition, replicate, counts file) tuple,
+#giving the same counts as readCountsFile aligned to the library: ids missing from a file are 0, ids not in the library
+#are dropped, and only the first count of a repeated id is kept (for overlapping linc sublibraries); ids are mapped to
+#rows once for all files listing the same ids (as files counted against the same library do), and files are read in a
+#thread pool into the columns of one preallocated int64 matrix (as pandas reads counts)
+#counts array files written by fastqgz_to_counts are memory-mapped instead of parsed, and their ids are only looked up
+#once per library fingerprint, or not at all when the fingerprint is that of the library table's own ids
+#as with the aligned counts files, the index is named by the counts files ('id') when every file lists exactly the
+#library's ids, keeps the library's name when none do, and is unnamed otherwise
+def loadCountsTable(countsFileTuples, libraryIndex, threads=countsReadingThreads):
+    countsMatrix = np.zeros((len(libraryIndex), len(countsFileTuples)), dtype=np.int64, order='F')
+    idMappings = [] #(ids, positions of the first count of each id in the library, library rows of those counts, whether the ids are the library's)
+    fingerprintMappings = dict() #library fingerprint of counts array files: (positions, rows, whether the ids are the library's)
+    libraryFingerprint = getLibraryFingerprint(libraryIndex)
+    libraryRows = np.arange(len(libraryIndex))
+    matchesLibrary = [False] * len(countsFileTuples)
+
+    def readCountsColumn(column):
+        arrayFileName = getCountsArrayFileName(countsFileTuples[column][2])
+        if arrayFileName is not None:
+            fingerprint, ids, counts = readCountsArrayFile(arrayFileName)
+
+            if fingerprint == libraryFingerprint:
+                countsMatrix[:, column] = counts
+                matchesLibrary[column] = True
+                return
+
+            if fingerprint not in fingerprintMappings:
+                rows = libraryIndex.get_indexer(ids.tolist())
+                fingerprintMappings[fingerprint] = (np.flatnonzero(rows >= 0), rows[rows >= 0], np.array_equal(rows, libraryRows))
+
+            positions, rows, matchesLibrary[column] = fingerprintMappings[fingerprint]
+            countsMatrix[rows, column] = counts[positions]
+            return
+
+        countsTable = pd.read_csv(countsFileTuples[column][2], header=None, delimiter='\t', names=['id','counts'])
+        ids = countsTable['id'].values
+
+        for mappedIds, positions, rows, isLibrary in list(idMappings):
+            if len(ids) == len(mappedIds) and len(ids) > 0 and ids[0] == mappedIds[0] and ids[-1] == mappedIds[-1] and np.array_equal(ids, mappedIds):
+                break
+        else:
+            positions = np.flatnonzero(~countsTable['id'].duplicated().values)
+            rows = libraryIndex.get_indexer(ids[positions])
+            isLibrary = np.array_equal(rows, libraryRows) #the ids without repeats are the library's, in its order
+            positions, rows = positions[rows >= 0], rows[rows >= 0]
+            idMappings.append((ids, positions, rows, isLibrary))
+
+        countsMatrix[rows, column] = countsTable['counts'].values[positions]
+        matchesLibrary[column] = isLibrary
+
+    if len(countsFileTuples) > 0:
+        threadPool = multiprocessing.pool.ThreadPool(min(threads, len(countsFileTuples)))
+        try:
+            threadPool.map(readCountsColumn, range(len(countsFileTuples)))
+        finally:
+            threadPool.close()
+            threadPool.join()
+
+    countsIndex = libraryIndex.copy()
+    if len(countsFileTuples) > 0 and all(matchesLibrary):
+        countsIndex.name = 'id'
+    elif any(matchesLibrary):
+        countsIndex.name = None
+
+    return pd.DataFrame(countsMatrix, index=countsIndex, columns=pd.MultiIndex.from_tuples(countsFileTuples) if len(countsFileTuples) > 0 else None)
+
 #return DataFrame of library features indexed by element id
 def readLibraryFile(libraryFastaFileName, elementTypeFunc, geneNameFunc, miscFuncList=None):
     elementList = []
@@ -396,9 +629,9 @@ def filterCountsPerExperiment(min_reads, exptsTable,libraryTable):
 #in other words, mask if any column is below threshold or only if all columns are below
 def filterLowCounts(countsColumns, filterType, filterThreshold):
     if filterType == 'both' or filterType == 'all':
-        failFilterColumn = countsColumns.apply(lambda row: min(row) < filterThreshold, axis = 1)
+        failFilterColumn = rowMin(countsColumns) < filterThreshold
     elif filterType == 'either' or filterType == 'any':
-        failFilterColumn = countsColumns.apply(lambda row: max(row) < filterThreshold, axis = 1)
+        failFilterColumn = rowMax(countsColumns) < filterThreshold
     else:
         raise ValueError('filter type not recognized or not implemented')
 
@@ -414,13 +647,13 @@ def computePhenotypeScore(counts1, counts2, libraryTable, growthValue, pseudocou
 
     #pseudocount
     if pseudocountBehavior == 'default' or pseudocountBehavior == 'zeros only':
-        defaultBehavior = lambda row: row if min(row) != 0 else row + pseudocountValue
-        combinedCountsPseudo = combinedCounts.apply(defaultBehavior, axis = 1)
+        zeroRows = rowMin(combinedCounts) == 0
+        combinedCountsPseudo = combinedCounts.add(np.where(zeroRows, pseudocountValue, 0), axis = 0)
     elif pseudocountBehavior == 'all values':
-        combinedCountsPseudo = combinedCounts.apply(lambda row: row + pseudocountValue, axis = 1)
+        combinedCountsPseudo = combinedCounts + pseudocountValue
     elif pseudocountBehavior == 'filter out':
         combinedCountsPseudo = combinedCounts.copy()
-        zeroRows = combinedCounts.apply(lambda row: min(row) <= 0, axis = 1)
+        zeroRows = rowMin(combinedCounts) <= 0
         combinedCountsPseudo.loc[zeroRows,:] = np.nan
     else:
         raise ValueError('Pseudocount behavior not recognized or not implemented')
@@ -434,17 +667,107 @@ def computePhenotypeScore(counts1, counts2, libraryTable, growthValue, pseudocou
         #print negCounts
     else:
         negCounts = combinedCountsPseudo
-    neglog2e = negCounts.apply(calcLog2e, countsRatio=countsRatio, growthValue=1, wtLog2E=0, axis=1).median()
+    neglog2e = pd.Series(calcLog2e(negCounts.values.T, countsRatio=countsRatio, growthValue=1, wtLog2E=0)).median()
     #print neglog2e
 
     #compute phenotype scores
-    scores = combinedCountsPseudo.apply(calcLog2e, countsRatio=countsRatio, growthValue=growthValue, wtLog2E=neglog2e, axis=1)
+    scores = pd.Series(calcLog2e(combinedCountsPseudo.values.T, countsRatio=countsRatio, growthValue=growthValue, wtLog2E=neglog2e), 
+        index=combinedCountsPseudo.index)
 
     return scores
 
+#filter and score every comparison at once, giving the same scores as filterLowCounts and computePhenotypeScore on each
+#pair of columns; comparisonList holds (phenotype, condition1, condition2, replicate, growth value) tuples and the
+#result has one (phenotype, replicate) column per comparison
+def computePhenotypeScoreTable(countsTable, comparisonList, libraryTable, filterType, filterThreshold, pseudocountBehavior, pseudocountValue, normToNegs=True):
+    if len(comparisonList) == 0:
+        return pd.DataFrame(index=countsTable.index, columns=pd.MultiIndex(levels=[[],[]], labels=[[],[]]))
+    phenotypeColumns = pd.MultiIndex.from_tuples([(phenotype, replicate) for phenotype, condition1, condition2, replicate, growthValue in comparisonList])
+
+    #one row per comparison so that each row is summed like a single column
+    counts1 = countsTable[[(condition1, replicate) for phenotype, condition1, condition2, replicate, growthValue in comparisonList]].values.T.astype(float)
+    counts2 = countsTable[[(condition2, replicate) for phenotype, condition1, condition2, replicate, growthValue in comparisonList]].values.T.astype(float)
+    growthValues = np.array([growthValue for phenotype, condition1, condition2, replicate, growthValue in comparisonList], dtype=float)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        #filter
+        if filterType == 'both' or filterType == 'all':
+            failFilter = np.where(counts2 < counts1, counts2, counts1) < filterThreshold
+        elif filterType == 'either' or filterType == 'any':
+            failFilter = np.where(counts2 > counts1, counts2, counts1) < filterThreshold
+        else:
+            raise ValueError('filter type not recognized or not implemented')
+
+        counts1[failFilter] = np.nan
+        counts2[failFilter] = np.nan
+
+        #pseudocount
+        countsMin = np.where(counts2 < counts1, counts2, counts1)
+        if pseudocountBehavior == 'default' or pseudocountBehavior == 'zeros only':
+            pseudocounts = np.where(countsMin == 0, pseudocountValue, 0)
+            counts1 = counts1 + pseudocounts
+            counts2 = counts2 + pseudocounts
+        elif pseudocountBehavior == 'all values':
+            counts1 = counts1 + pseudocountValue
+            counts2 = counts2 + pseudocountValue
+        elif pseudocountBehavior == 'filter out':
+            counts1[countsMin <= 0] = np.nan
+            counts2[countsMin <= 0] = np.nan
+        else:
+            raise ValueError('Pseudocount behavior not recognized or not implemented')
+
+        countsTotals = sumCountsPairs(counts1, counts2)
+        countsRatios = countsTotals[:,0] / countsTotals[:,1]
+
+        #compute neg control log2 enrichment
+        if normToNegs == True:
+            negRows = countsTable.index.isin(libraryTable.index[libraryTable['gene'] == 'negative_control'])
+        else:
+            negRows = np.ones(len(countsTable), dtype=bool)
+        neglog2es = pd.DataFrame(calcLog2e((counts1[:,negRows], counts2[:,negRows]), countsRatios[:,np.newaxis], 1, 0).T).median().values
+
+        #compute phenotype scores
+        scores = calcLog2e((counts1, counts2), countsRatios[:,np.newaxis], growthValues[:,np.newaxis], neglog2es[:,np.newaxis])
+
+    return pd.DataFrame(scores.T, index=countsTable.index, columns=phenotypeColumns)
+
+#column totals of the pair of counts columns of each comparison, summed as pandas sums a two column frame of them (adding
+#the rows in order) so the totals are exactly those of computePhenotypeScore; nans are skipped, but a column of only
+#nans totals nan
+def sumCountsPairs(counts1, counts2):
+    countsTotals = np.empty((len(counts1), 2))
+    for i in range(len(counts1)):
+        pairCounts = np.column_stack((counts1[i], counts2[i]))
+        isValid = ~np.isnan(pairCounts)
+        countsTotals[i] = np.where(isValid, pairCounts, 0).sum(axis=0)
+        countsTotals[i, ~isValid.any(axis=0)] = np.nan
+
+    return countsTotals
+
+#row can be a single pair of counts or, to score many sgRNAs at once, a pair of counts arrays
 def calcLog2e(row, countsRatio, growthValue, wtLog2E):
     return (np.log2(countsRatio*row[1]/row[0]) - wtLog2E) / growthValue
 
+#smallest/largest value in each row, matching the builtin min/max of the row: as those only replace the running
+#value with a smaller/larger one, a NaN in the first column is kept and NaNs in later columns are skipped
+def rowMin(table):
+    values = table.values
+    result = values[:,0].copy()
+    with np.errstate(invalid='ignore'):
+        for i in range(1, values.shape[1]):
+            result = np.where(values[:,i] < result, values[:,i], result)
+
+    return pd.Series(result, index=table.index)
+
+def rowMax(table):
+    values = table.values
+    result = values[:,0].copy()
+    with np.errstate(invalid='ignore'):
+        for i in range(1, values.shape[1]):
+            result = np.where(values[:,i] > result, values[:,i], result)
+
+    return pd.Series(result, index=table.index)
+
 #average replicate phenotype scores
 def averagePhenotypeScores(scoreTable):
 
@@ -490,32 +813,246 @@ def computeGeneScores(libraryTable, scoreTable, normToNegs = True):
     #return scoredColumns
     return pd.concat(scoredColumns, axis = 1, keys=scoreTable.columns)
 
-#apply gene scoring functions to pre-grouped tables of phenotypes
-def applyGeneScoreFunction(groupedPhenotypeTable, negativeTable, analysis, analysisParamList):
+#phenotypes grouped by gene, or by gene and transcript, with integer group codes taken from the library view, so every
+#gene analysis shares one grouping instead of regrouping the table by gene names; groupCodes gives the group of each
+#row of obj (-1 for rows in no group), groupIndex names the groups in the sorted order a pandas groupby on the same keys
+#gives them, and groupGenes maps each group to its gene's code in the library view
+class GeneGroups(object):
+    def __init__(self, phenotypeTable, groupCodes, groupIndex, groupGenes):
+        self.obj = phenotypeTable
+        self.groupCodes = groupCodes
+        self.groupIndex = groupIndex
+        self.groupGenes = groupGenes
+
+    #the same groups for some of the phenotype columns
+    def select(self, columns):
+        return GeneGroups(self.obj[columns], self.groupCodes, self.groupIndex, self.groupGenes)
+
+    #non-nan values of each group in each column, as from groupby count
+    def count(self):
+        return pd.DataFrame(self.sumByGroup()[1], index=self.groupIndex, columns=self.obj.columns)
+
+    #mean of the non-nan values of each group in each column, summed in table order as groupby mean sums them
+    def mean(self):
+        sums, counts = self.sumByGroup()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return pd.DataFrame(sums / counts, index=self.groupIndex, columns=self.obj.columns)
+
+    #sums and counts of the non-nan values of each group in each column, from one bincount over all columns
+    def sumByGroup(self):
+        values = self.obj.values.astype(np.float64)
+        numGroups = len(self.groupIndex)
+
+        cellCodes = self.groupCodes[:,np.newaxis] + numGroups * np.arange(values.shape[1])
+        isValid = np.logical_and(~np.isnan(values), (self.groupCodes >= 0)[:,np.newaxis])
+        sums = np.bincount(cellCodes[isValid], weights=values[isValid], minlength=numGroups * values.shape[1])
+        counts = np.bincount(cellCodes[isValid], minlength=numGroups * values.shape[1])
+
+        return sums.reshape(values.shape[1], numGroups).T, counts.reshape(values.shape[1], numGroups).T
+
+#group the rows of a phenotype table by the gene codes of a library view holding its rows, or by its transcript codes
+#when byTranscript; only groups with rows in the table are kept, renumbered in order
+def groupByGene(phenotypeTable, libraryView, byTranscript):
+    if byTranscript:
+        libraryCodes, groupNames, groupGenes = libraryView.transcriptCodes, libraryView.transcriptNames, libraryView.transcriptGenes
+    else:
+        libraryCodes, groupNames, groupGenes = libraryView.geneCodes, libraryView.geneNames, np.arange(len(libraryView.geneNames))
+
+    rows = libraryView.table.index.get_indexer(phenotypeTable.index)
+    rowCodes = np.where(rows >= 0, libraryCodes[rows], -1)
+    usedCodes = np.unique(rowCodes[rowCodes >= 0])
+
+    return GeneGroups(phenotypeTable, np.where(rowCodes >= 0, np.searchsorted(usedCodes, rowCodes), -1), 
+        groupNames[usedCodes], groupGenes[usedCodes])
+
+#apply gene scoring functions to pre-grouped tables of phenotypes; columnSeeds holds the resampling seed of each column
+#for calculate_empirical
+def applyGeneScoreFunction(groupedPhenotypeTable, negativeTable, analysis, analysisParamList, processPool=None, columnSeeds=None):
     if analysis == 'calculate_ave':
         numToAverage = analysisParamList[0]
         if numToAverage <= 0:
-            means = groupedPhenotypeTable.aggregate(np.mean)
+            means = groupedPhenotypeTable.mean()
             counts = groupedPhenotypeTable.count()
             result = pd.concat([means,counts],axis=1,keys=['average of all phenotypes','average of all phenotypes_sgRNAcount'])
         else:
-            means = groupedPhenotypeTable.apply(lambda x: averageBestN(x, numToAverage))
-            counts = groupedPhenotypeTable.count()
+            means, counts = groupedAverageBestN(groupedPhenotypeTable, numToAverage)
             result = pd.concat([means,counts],axis=1,keys=['average phenotype of strongest %d'%numToAverage, 'sgRNA count_avg'])
     elif analysis == 'calculate_mw':
-        pvals = groupedPhenotypeTable.apply(lambda x: applyMW(x, negativeTable))
+        pvals = groupedMannWhitney(groupedPhenotypeTable, negativeTable)
         counts = groupedPhenotypeTable.count()
         result = pd.concat([pvals,counts],axis=1,keys=['Mann-Whitney p-value','sgRNA count_MW'])
     elif analysis == 'calculate_nth':
         nth = analysisParamList[0]
-        pvals = groupedPhenotypeTable.aggregate(lambda x: sorted(x, key=abs, reverse=True)[nth-1] if nth <= len(x) else np.nan)
-        counts = groupedPhenotypeTable.count()
+        pvals, counts = groupedNthBest(groupedPhenotypeTable, nth)
         result = pd.concat([pvals,counts],axis=1,keys=['%dth best score' % nth,'sgRNA count_nth best'])
+    elif analysis == 'calculate_empirical':
+        numToAverage, numDraws = analysisParamList
+        pvals, fdrs = groupedEmpiricalAverageBestN(groupedPhenotypeTable, negativeTable, numToAverage, numDraws, processPool, columnSeeds)
+        if numToAverage <= 0:
+            result = pd.concat([pvals,fdrs],axis=1,keys=['empirical p-value_average of all phenotypes','empirical FDR_average of all phenotypes'])
+        else:
+            result = pd.concat([pvals,fdrs],axis=1,keys=['empirical p-value_strongest %d' % numToAverage,'empirical FDR_strongest %d' % numToAverage])
     else:
         raise ValueError('Analysis %s not recognized or not implemented' % analysis)
 
     return result
 
+#grouped versions of averageBestN and the calculate_nth aggregation that give the same scores for every group and
+#column of a grouped phenotype table, along with the sgRNA count of each group as from count()
+def groupedAverageBestN(groupedPhenotypeTable, numToAverage):
+    phenotypeTable = groupedPhenotypeTable.obj
+    groupCodes = groupedPhenotypeTable.groupCodes
+    groupIndex = groupedPhenotypeTable.groupIndex
+
+    means = np.empty((len(groupIndex), len(phenotypeTable.columns)))
+    counts = np.empty((len(groupIndex), len(phenotypeTable.columns)), dtype=np.int64)
+    for i, column in enumerate(phenotypeTable.columns):
+        sortedValues, sortedCodes, ranks, counts[:,i] = sortGroupsByMagnitude(phenotypeTable[column].values, groupCodes, len(groupIndex))
+
+        #groups averaging the same number of values are averaged together, so each mean sums its values in the same order as np.mean
+        isTop = ranks < numToAverage
+        topValues = sortedValues[isTop]
+        numTop = np.minimum(counts[:,i], numToAverage)
+        topStarts = np.cumsum(numTop) - numTop
+
+        means[:,i] = np.nan
+        for k in np.unique(numTop[numTop > 0]):
+            kGroups = np.flatnonzero(numTop == k)
+            means[kGroups,i] = topValues[topStarts[kGroups][:,np.newaxis] + np.arange(k)].mean(axis=1)
+
+    return pd.DataFrame(means, index=groupIndex, columns=phenotypeTable.columns), pd.DataFrame(counts, index=groupIndex, columns=phenotypeTable.columns)
+
+def groupedNthBest(groupedPhenotypeTable, nth):
+    phenotypeTable = groupedPhenotypeTable.obj
+    groupCodes = groupedPhenotypeTable.groupCodes
+    groupIndex = groupedPhenotypeTable.groupIndex
+    groupSizes = np.bincount(groupCodes[groupCodes >= 0], minlength=len(groupIndex))
+
+    #rows of each group in table order
+    groupedRows = np.flatnonzero(groupCodes >= 0)[np.argsort(groupCodes[groupCodes >= 0], kind='mergesort')]
+    groupStarts = np.cumsum(groupSizes) - groupSizes
+
+    nthScores = np.empty((len(groupIndex), len(phenotypeTable.columns)))
+    counts = np.empty((len(groupIndex), len(phenotypeTable.columns)), dtype=np.int64)
+    for i, column in enumerate(phenotypeTable.columns):
+        values = phenotypeTable[column].values
+        sortedValues, sortedCodes, ranks, counts[:,i] = sortGroupsByMagnitude(values, groupCodes, len(groupIndex))
+
+        nthScores[:,i] = np.nan
+        isNth = ranks == nth - 1
+        nthScores[sortedCodes[isNth],i] = sortedValues[isNth]
+
+        #nans are not dropped before sorting and are counted as values, so those groups are scored as they always were
+        for group in np.flatnonzero(counts[:,i] < groupSizes):
+            groupValues = values[groupedRows[groupStarts[group]:groupStarts[group] + groupSizes[group]]]
+            nthScores[group,i] = sorted(groupValues, key=abs, reverse=True)[nth-1] if nth <= len(groupValues) else np.nan
+
+    return pd.DataFrame(nthScores, index=groupIndex, columns=phenotypeTable.columns), pd.DataFrame(counts, index=groupIndex, columns=phenotypeTable.columns)
+
+#order the non-nan values by group and then by decreasing magnitude, keeping table order between equal magnitudes like
+#a stable sort; returns the sorted values and group codes, the rank of each value in its group and the values per group
+def sortGroupsByMagnitude(values, groupCodes, numGroups):
+    positions = np.flatnonzero(np.logical_and(~np.isnan(values), groupCodes >= 0))
+    order = positions[np.lexsort((positions, -np.abs(values[positions]), groupCodes[positions]))]
+
+    sortedCodes = groupCodes[order]
+    counts = np.bincount(sortedCodes, minlength=numGroups)
+    ranks = np.arange(len(order)) - (np.cumsum(counts) - counts)[sortedCodes]
+
+    return values[order], sortedCodes, ranks, counts
+
+#empirical p-values and Benjamini-Hochberg FDRs of the average of best n score of every group in each column, against
+#the scores of numDraws groups of the same size resampled (with replacement) from the negative controls; columns are
+#scored in processPool when given, each with its seed from columnSeeds, or without them drawn from numpy's global
+#random state
+def groupedEmpiricalAverageBestN(groupedPhenotypeTable, negativeTable, numToAverage, numDraws, processPool=None, columnSeeds=None):
+    phenotypeTable = groupedPhenotypeTable.obj
+    if numToAverage <= 0:
+        scores = groupedPhenotypeTable.mean()
+        counts = groupedPhenotypeTable.count()
+    else:
+        scores, counts = groupedAverageBestN(groupedPhenotypeTable, numToAverage)
+
+    if columnSeeds is None:
+        columnSeeds = np.random.randint(0, 2**31 - 1, len(phenotypeTable.columns))
+
+    arglist = [(scores[column].values, counts[column].values, negativeTable[column].dropna().values, numToAverage, numDraws, seed) 
+        for column, seed in zip(phenotypeTable.columns, columnSeeds)]
+
+    if processPool is None:
+        pvalList = map(empiricalPvaluesWrapper, arglist)
+    else:
+        pvalList = processPool.map(empiricalPvaluesWrapper, arglist)
+
+    pvals = pd.DataFrame(np.array(pvalList).T, index=scores.index, columns=phenotypeTable.columns)
+    fdrs = pvals.apply(lambda column: pd.Series(benjaminiHochberg(column.values), index=column.index))
+
+    return pvals, fdrs
+
+#the resampling seed of a phenotype column, derived from the configured seed and the column so that a column's empirical
+#scores do not depend on the other columns scored with it, or drawn from numpy's global random state without a seed
+def getEmpiricalSeed(seed, column):
+    if seed is None:
+        return int(np.random.randint(0, 2**31 - 1))
+
+    return int(hashlib.sha1(json.dumps([seed, list(column)])).hexdigest()[:8], 16)
+
+def empiricalPvaluesWrapper(arg):
+    return empiricalPvalues(*arg)
+
+#two-sided empirical p-value of each score among the resampled null scores of its group size, (k + 1)/(numDraws + 1)
+#for k null scores at least as large in magnitude; the null scores of each group size are drawn once and shared by all
+#groups of that size
+def empiricalPvalues(scores, counts, negValues, numToAverage, numDraws, seed):
+    randomState = np.random.RandomState(seed)
+
+    pvals = np.empty(len(scores))
+    pvals[:] = np.nan
+    isScored = ~np.isnan(scores)
+    for groupSize in np.unique(counts[isScored]):
+        nullScores = np.sort(np.abs(resampledAverageBestN(negValues, groupSize, numToAverage, numDraws, randomState)))
+
+        sizeGroups = np.flatnonzero(np.logical_and(isScored, counts == groupSize))
+        numAsLarge = len(nullScores) - np.searchsorted(nullScores, np.abs(scores[sizeGroups]), side='left')
+        pvals[sizeGroups] = (numAsLarge + 1.0) / (numDraws + 1.0)
+
+    return pvals
+
+#average of best n scores of numDraws groups of groupSize values drawn with replacement from negValues, drawn in
+#batches of about empiricalBatchValues values
+def resampledAverageBestN(negValues, groupSize, numToAverage, numDraws, randomState):
+    numTop = groupSize if numToAverage <= 0 else min(groupSize, numToAverage)
+    drawsPerBatch = max(empiricalBatchValues // groupSize, 1)
+
+    nullScores = np.empty(numDraws)
+    for batchStart in range(0, numDraws, drawsPerBatch):
+        batchDraws = min(drawsPerBatch, numDraws - batchStart)
+        drawnValues = negValues[randomState.randint(0, len(negValues), (batchDraws, groupSize))]
+
+        if numTop < groupSize:
+            topColumns = np.argpartition(-np.abs(drawnValues), numTop - 1, axis=1)[:,:numTop]
+            drawnValues = drawnValues[np.arange(batchDraws)[:,np.newaxis], topColumns]
+
+        nullScores[batchStart:batchStart + batchDraws] = drawnValues.mean(axis=1)
+
+    return nullScores
+
+#Benjamini-Hochberg adjusted p-values, ignoring nans
+def benjaminiHochberg(pvals):
+    fdrs = np.empty(len(pvals))
+    fdrs[:] = np.nan
+
+    isValid = ~np.isnan(pvals)
+    order = np.argsort(pvals[isValid])
+    rankedFdrs = pvals[isValid][order] * len(order) / np.arange(1.0, len(order) + 1)
+    rankedFdrs = np.minimum(np.minimum.accumulate(rankedFdrs[::-1])[::-1], 1.0)
+
+    validFdrs = np.empty(len(order))
+    validFdrs[order] = rankedFdrs
+    fdrs[isValid] = validFdrs
+
+    return fdrs
+
 def averageBestN(group, numToAverage):
     return group.apply(lambda column: np.mean(sorted(column.dropna(),key=abs,reverse=True)[:numToAverage]) if len(column.dropna()) > 0 else np.nan)
 
@@ -525,6 +1062,189 @@ def applyMW(group, negativeTable):
     else:
         return group.apply(lambda column: stats.mannwhitneyu(column.dropna().values, negativeTable[column.name].dropna().values)[1] * 2 if len(column.dropna()) > 0 else np.nan) #pre v0.17 stats.mannwhitneyu is one-tailed!!
 
+#Mann-Whitney p-values of every group against the negative controls in each column, equal to those from applyMW
+#(scipy's two-sided mannwhitneyu with tie and continuity corrections and the normal approximation); the negative
+#controls are sorted once per column and the rank sums of all groups are found by searchsorted instead of reranking
+#the combined values for each group
+def groupedMannWhitney(groupedPhenotypeTable, negativeTable):
+    phenotypeTable = groupedPhenotypeTable.obj
+    groupCodes = groupedPhenotypeTable.groupCodes
+    groupIndex = groupedPhenotypeTable.groupIndex
+
+    pvals = np.empty((len(groupIndex), len(phenotypeTable.columns)))
+    for i, column in enumerate(phenotypeTable.columns):
+        pvals[:,i] = mannWhitneyByGroup(phenotypeTable[column].values, groupCodes, len(groupIndex), negativeTable[column].dropna().values)
+
+    return pd.DataFrame(pvals, index=groupIndex, columns=phenotypeTable.columns)
+
+#two-sided Mann-Whitney p-value of the values in each group (numbered 0 to numGroups-1 by groupCodes) against negValues,
+#computed step for step as in scipy.stats.mannwhitneyu; groups without values are nan
+def mannWhitneyByGroup(values, groupCodes, numGroups, negValues):
+    isValid = np.logical_and(~np.isnan(values), groupCodes >= 0)
+    order = np.lexsort((values[isValid], groupCodes[isValid]))
+    values = values[isValid][order]
+    groupCodes = groupCodes[isValid][order]
+    if values.size == 0:
+        return np.full(numGroups, np.nan)
+
+    negValues = np.sort(negValues)
+    negTieCounts = np.diff(np.flatnonzero(np.r_[True, negValues[1:] != negValues[:-1], True])).astype(np.float64)
+    negTieSum = (negTieCounts**3 - negTieCounts).sum()
+
+    #runs of equal values within a group share a midrank in the combined ranking of the group and negative controls
+    runStarts = np.flatnonzero(np.r_[True, np.logical_or(groupCodes[1:] != groupCodes[:-1], values[1:] != values[:-1])])
+    runLengths = np.diff(np.r_[runStarts, len(values)])
+    runCodes = groupCodes[runStarts]
+    runValues = values[runStarts]
+
+    n1 = np.bincount(groupCodes, minlength=numGroups)
+    n2 = len(negValues)
+    groupStarts = np.cumsum(n1) - n1
+
+    negLess = np.searchsorted(negValues, runValues, side='left')
+    negEqual = np.searchsorted(negValues, runValues, side='right') - negLess
+    tieCounts = (negEqual + runLengths).astype(np.float64)
+    negEqual = negEqual.astype(np.float64)
+
+    runRanks = negLess + (runStarts - groupStarts[runCodes]) + (tieCounts + 1) / 2.0
+    rankSums = np.bincount(runCodes, weights=runRanks * runLengths, minlength=numGroups)
+
+    #tie correction, replacing the negative control ties by the combined ties at each of the group's values
+    tieSums = negTieSum + np.bincount(runCodes, weights=(tieCounts**3 - tieCounts) - (negEqual**3 - negEqual), minlength=numGroups)
+    size = (n1 + n2).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        T = np.where(size < 2, 1.0, 1.0 - tieSums / (size**3 - size))
+    if np.any(np.logical_and(T == 0, n1 > 0)):
+        raise ValueError('All numbers are identical in mannwhitneyu')
+
+    u1 = n1*n2 + (n1*(n1+1))/2.0 - rankSums
+    u2 = n1*n2 - u1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sd = np.sqrt(T * n1 * n2 * (n1+n2+1) / 12.0)
+        z = (np.maximum(u1, u2) - (n1*n2/2.0 + 0.5)) / sd
+    pvals = 2 * stats.norm.sf(np.abs(z))
+
+    return np.where(n1 > 0, pvals, np.nan)
+
+
+#cache of stage results for processExperimentsFromConfig in a directory next to the output tables, or a cache that
+#stores nothing if cacheDirectory is None; each stage stores one table, either under a single key or with a key for each
+#column so that cached columns are reused and only new columns computed, and keys are hashes of the settings and input
+#file hashes that the stage depends on
+class StageCache(object):
+    def __init__(self, cacheDirectory):
+        self.cacheDirectory = cacheDirectory
+        self.index = {'version':stageCacheVersion, 'stages':dict(), 'files':dict(), 'plots':dict()}
+
+        if cacheDirectory is not None:
+            makeDirectory(cacheDirectory)
+
+            try:
+                with open(os.path.join(cacheDirectory, 'cache_index.json')) as indexFile:
+                    cachedIndex = json.load(indexFile)
+
+                if cachedIndex.get('version') == stageCacheVersion:
+                    self.index = cachedIndex
+            except (IOError, ValueError):
+                pass
+
+    def makeKey(self, *keyParts):
+        return hashlib.sha1(json.dumps([stageCacheVersion] + list(keyParts), sort_keys=True)).hexdigest()
+
+    #sha1 of a file's contents, reused from the cache while the file's size and modification time are unchanged
+    def hashFile(self, fileName):
+        if self.cacheDirectory is None:
+            return None
+
+        fileName = os.path.abspath(fileName)
+        fileStats = [os.path.getsize(fileName), os.path.getmtime(fileName)]
+        if fileName in self.index['files'] and self.index['files'][fileName][:2] == fileStats:
+            return self.index['files'][fileName][2]
+
+        fileHash = hashlib.sha1()
+        with open(fileName, 'rb') as infile:
+            for chunk in iter(lambda: infile.read(2**20), ''):
+                fileHash.update(chunk)
+
+        self.index['files'][fileName] = fileStats + [fileHash.hexdigest()]
+        self.writeIndex()
+
+        return fileHash.hexdigest()
+
+    #the stage's table if it was saved with this key, otherwise None
+    def load(self, stage, key):
+        if self.cacheDirectory is None or self.index['stages'].get(stage, dict()).get('key') != key:
+            return None
+
+        return self.readStageTable(stage)
+
+    def save(self, stage, key, table):
+        self.writeStageTable(stage, table, {'key':key})
+
+    #a dict of the cached columns (as a table, since a key may cover several columns) for each key in keyList that the
+    #stage has cached; keys without cached columns are left out
+    def loadColumns(self, stage, keyList):
+        if self.cacheDirectory is None or 'column_keys' not in self.index['stages'].get(stage, dict()):
+            return dict()
+
+        columnPositions = dict()
+        for i, columnKey in enumerate(self.index['stages'][stage]['column_keys']):
+            columnPositions.setdefault(columnKey, []).append(i)
+
+        cachedKeys = set(keyList).intersection(columnPositions)
+        if len(cachedKeys) == 0:
+            return dict()
+
+        table = self.readStageTable(stage)
+        if table is None:
+            return dict()
+
+        return {key:table.iloc[:,columnPositions[key]] for key in cachedKeys}
+
+    #columnKeys holds the key of each column of table
+    def saveColumns(self, stage, table, columnKeys):
+        self.writeStageTable(stage, table, {'column_keys':list(columnKeys)})
+
+    #plots of a stage are keyed by the image extension and the keys of the results plotted, and are only redrawn when
+    #those change or any of the figure files the stage drew is missing from the plot directory or its figure index
+    def hasPlots(self, stage, plotKey, plotDirectory):
+        plotEntry = self.index['plots'].get(stage)
+        if plotEntry is None or plotEntry[0] != plotKey:
+            return False
+
+        indexedFiles = set(entry['file'] for entry in screen_analysis.findFigures(plotDirectory))
+        return all(fileName in indexedFiles and os.path.exists(os.path.join(plotDirectory, fileName)) for fileName in plotEntry[1])
+
+    def setPlots(self, stage, plotKey, figureFiles):
+        if self.cacheDirectory is not None:
+            self.index['plots'][stage] = [plotKey, figureFiles]
+            self.writeIndex()
+
+    def readStageTable(self, stage):
+        try:
+            return screen_analysis.readBinaryTable(os.path.join(self.cacheDirectory, stage + '.npz'), 'npz')
+        except (IOError, KeyError, ValueError):
+            return None
+
+    #the stage is dropped from the index while its table is written, so an interrupted write is never loaded
+    def writeStageTable(self, stage, table, stageEntry):
+        if self.cacheDirectory is None:
+            return
+
+        self.index['stages'].pop(stage, None)
+        self.writeIndex()
+
+        screen_analysis.writeBinaryTable(table, os.path.join(self.cacheDirectory, stage), 'npz')
+
+        self.index['stages'][stage] = stageEntry
+        self.writeIndex()
+
+    def writeIndex(self):
+        indexFileName = os.path.join(self.cacheDirectory, 'cache_index.json')
+        with open(indexFileName + '.tmp', 'w') as indexFile:
+            json.dump(self.index, indexFile)
+
+        os.rename(indexFileName + '.tmp', indexFileName)
 
 #parse a tab-delimited file with column headers: experiment, replicate_id, G_value, K_value (calculated with martin's parse_growthdata.py)
 def parseGKFile(gkFileName):
@@ -548,9 +1268,13 @@ if __name__ == '__main__':
     parser.add_argument('Library_File_Directory', help='Directory containing reference library tables and the library_config.txt file.')
 
     parser.add_argument('--plot_extension', default='png', help='Image extension for plot files, or \"off\". Default is png.')
+    parser.add_argument('--plot_workers', type=int, default=1, help='Processes used to draw and save figures while the analysis runs. Default is 1 (figures are drawn in the main process as they come up).')
+    parser.add_argument('--binary_output', default='off', choices=['off','auto'] + screen_analysis.binaryTableFormats, help='Also write each table in a columnar binary format (parquet, feather, or npz), which screen_analysis.loadData reads in place of the text table. auto picks the first installed format; npz needs only numpy and is used when the chosen format is not installed. Default is off.')
+    parser.add_argument('--no_cache', action='store_true', default=False, help='Recompute every stage instead of reusing stages and columns cached by an earlier run with the same settings and input files (in the [experiment name]_cache folder of the output folder).')
+    parser.add_argument('-p','--processors', type=int, default = 1, help='Processes used to score phenotype columns for calculate_empirical. Default is 1.')
 
     args = parser.parse_args()
     # print args
 
-    processExperimentsFromConfig(args.Config_File, args.Library_File_Directory, args.plot_extension.lower())
+    processExperimentsFromConfig(args.Config_File, args.Library_File_Directory, args.plot_extension.lower(), max(args.processors, 1), args.binary_output, not args.no_cache, max(args.plot_workers, 1))
 
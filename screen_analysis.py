@@ -5,6 +5,10 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import os
 import sys
+import json
+import multiprocessing
+import time
+import tempfile
 import numpy as np
 import scipy as sp
 
@@ -13,6 +17,11 @@ plotDirectory = None ##set to a directory to save figures
 imageExtension = 'png'
 plotWithPylab = True ##call plt.show when figures are done
 figureScale = 1
+unnumberedFigures = None ##while a plot worker renders, the figures it saved under temporary names, numbered later by PlotScheduler
+figureRegistry = None ##numbers and records the figures saved to plotDirectory, set by changeDisplayFigureSettings
+figureIndexFileName = 'figure_index.txt'
+unnumberedFigurePrefix = '.unnumbered_fig_' ##temporary file names of figures saved by plot workers before they are numbered
+binaryTableFormats = ['parquet', 'feather', 'npz'] ##columnar binary table formats, in order of preference
 
 ##Matplotlib settings
 almost_black = '#111111'
@@ -64,21 +73,205 @@ plt.rcParams['xtick.color'] = almost_black
 plt.rcParams['xtick.major.width'] = axisLineWidth
 
 def loadData(experimentName, collapsedToTranscripts = True, premergedCounts = False):
-    dataDict = {'library': pd.read_csv(experimentName + '_librarytable.txt',sep='\t',header=0,index_col=0),
-    'counts': pd.read_csv(experimentName + '_mergedcountstable.txt',sep='\t',header=range(2),index_col=range(1)),
-    'phenotypes': pd.read_csv(experimentName + '_phenotypetable.txt',sep='\t',header=range(2),index_col=range(1))}
+    dataDict = {'library': readTable(experimentName + '_librarytable',header=0,index_col=0),
+    'counts': readTable(experimentName + '_mergedcountstable',header=range(2),index_col=range(1)),
+    'phenotypes': readTable(experimentName + '_phenotypetable',header=range(2),index_col=range(1))}
+    dataDict['library view'] = LibraryView(dataDict['library'])
     
     if premergedCounts:
-        dataDict['premerged counts'] = pd.read_csv(experimentName + '_rawcountstable.txt',sep='\t',header=range(3),index_col=range(1))
+        dataDict['premerged counts'] = readTable(experimentName + '_rawcountstable',header=range(3),index_col=range(1))
     
     if collapsedToTranscripts:
-        dataDict['transcript scores'] = pd.read_csv(experimentName + '_genetable.txt',sep='\t',header=range(3),index_col=range(2))
-        dataDict['gene scores'] = pd.read_csv(experimentName + '_genetable_collapsed.txt',sep='\t',header=range(3),index_col=range(1))
+        dataDict['transcript scores'] = readTable(experimentName + '_genetable',header=range(3),index_col=range(2))
+        dataDict['gene scores'] = readTable(experimentName + '_genetable_collapsed',header=range(3),index_col=range(1))
     else:
-        dataDict['gene scores'] = pd.read_csv(experimentName + '_genetable.txt',sep='\t',header=range(3),index_col=range(1))
+        dataDict['gene scores'] = readTable(experimentName + '_genetable',header=range(3),index_col=range(1))
     
     return dataDict
 
+#read an output table, from its columnar binary copy when there is one at least as new as the text table
+def readTable(tableName, header, index_col):
+    for binaryFormat in binaryTableFormats:
+        binaryFileName = tableName + '.' + binaryFormat
+        if os.path.exists(binaryFileName) and (not os.path.exists(tableName + '.txt') or os.path.getmtime(binaryFileName) >= os.path.getmtime(tableName + '.txt')):
+            try:
+                return readBinaryTable(binaryFileName, binaryFormat)
+            except ImportError:
+                continue
+
+    return pd.read_csv(tableName + '.txt',sep='\t',header=header,index_col=index_col)
+
+##columnar binary tables
+#tables are stored as flat columns named by json keys of the index level names and column tuples, so multi-level
+#columns and indices come back unchanged in any format
+
+#the binary format to write for a requested format: auto is the first installed format, and formats that are not
+#installed fall back to npz; both parquet and feather tables are written and read through pyarrow (pandas' feather
+#functions use pyarrow.feather, not the feather-format package)
+def getBinaryFormat(binaryFormat):
+    if binaryFormat in ('off', None):
+        return None
+
+    for candidateFormat in binaryTableFormats:
+        if binaryFormat in ('auto', candidateFormat):
+            try:
+                if candidateFormat == 'parquet':
+                    import pyarrow.parquet
+                elif candidateFormat == 'feather':
+                    import pyarrow.feather
+                return candidateFormat
+            except ImportError:
+                if binaryFormat != 'auto':
+                    print '%s not installed, writing npz tables' % candidateFormat
+
+    return 'npz'
+
+#write a columnar binary copy of a table next to its text table (tableName without extension)
+def writeBinaryTable(table, tableName, binaryFormat):
+    binaryFormat = getBinaryFormat(binaryFormat)
+    if binaryFormat is None:
+        return
+
+    flatTable = flattenTable(table)
+    binaryFileName = tableName + '.' + binaryFormat
+
+    if binaryFormat == 'parquet':
+        import pyarrow
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(pyarrow.Table.from_pandas(flatTable, preserve_index=False), binaryFileName)
+    elif binaryFormat == 'feather':
+        flatTable.to_feather(binaryFileName)
+    else:
+        arrayDict = {'keys': np.array(flatTable.columns.values, dtype=str)}
+        for i, key in enumerate(flatTable.columns):
+            values = flatTable[key].values
+            if values.dtype == object:
+                isNull = pd.isnull(values)
+                if isNull.any():
+                    arrayDict['null_%d' % i] = isNull
+                values = np.array([value if not null else '' for value, null in zip(values, isNull)], dtype=str)
+            arrayDict['column_%d' % i] = values
+
+        #write through a file object so numpy doesn't add .npz to the name
+        with open(binaryFileName, 'wb') as binaryFile:
+            np.savez(binaryFile, **arrayDict)
+
+def readBinaryTable(binaryFileName, binaryFormat):
+    if binaryFormat == 'parquet':
+        import pyarrow.parquet
+        flatTable = pyarrow.parquet.read_table(binaryFileName).to_pandas()
+    elif binaryFormat == 'feather':
+        flatTable = pd.read_feather(binaryFileName)
+    else:
+        with np.load(binaryFileName) as arrayFile:
+            keys = arrayFile['keys']
+            columnList = []
+            for i in range(len(keys)):
+                values = arrayFile['column_%d' % i]
+                if values.dtype.kind in 'SU':
+                    values = values.astype(object)
+                    if 'null_%d' % i in arrayFile.files:
+                        values[arrayFile['null_%d' % i]] = np.nan
+                columnList.append(pd.Series(values))
+
+        flatTable = pd.concat(columnList, axis=1, keys=[str(key) for key in keys]) if len(columnList) > 0 else pd.DataFrame()
+
+    return unflattenTable(flatTable)
+
+def flattenTable(table):
+    keyList = [json.dumps(['index', name]) for name in table.index.names]
+    columnList = [pd.Series(table.index.get_level_values(i).values) for i in range(table.index.nlevels)]
+
+    for i, column in enumerate(table.columns):
+        keyList.append(json.dumps(['column', list(table.columns.names), list(column) if table.columns.nlevels > 1 else [column]]))
+        columnList.append(pd.Series(table.iloc[:,i].values))
+
+    return pd.concat(columnList, axis=1, keys=keyList)
+
+def unflattenTable(flatTable):
+    keyList = [json.loads(key) for key in flatTable.columns]
+    numIndexLevels = sum(1 for key in keyList if key[0] == 'index')
+
+    indexArrays = [flatTable.iloc[:,i].values for i in range(numIndexLevels)]
+    indexNames = [keyList[i][1] for i in range(numIndexLevels)]
+    if numIndexLevels > 1:
+        index = pd.MultiIndex.from_arrays(indexArrays, names=indexNames)
+    else:
+        index = pd.Index(indexArrays[0], name=indexNames[0])
+
+    columnKeys = keyList[numIndexLevels:]
+    if len(columnKeys) > 0 and len(columnKeys[0][2]) > 1:
+        columns = pd.MultiIndex.from_tuples([tuple(key[2]) for key in columnKeys], names=columnKeys[0][1])
+    else:
+        columns = pd.Index([key[2][0] for key in columnKeys], name=columnKeys[0][1][0] if len(columnKeys) > 0 else None)
+
+    table = flatTable.iloc[:,numIndexLevels:].copy()
+    table.index = index
+    table.columns = columns
+
+    return table
+
+
+
+##library view
+#a library table filtered to the analyzed sublibraries, with the negative control mask and the integer gene and
+#transcript codes that the gene analyses and plots reuse instead of comparing gene names row by row; codes follow the
+#sorted order of gene names and (gene, transcripts) pairs as groupby does, and rows with a missing name are coded -1
+class LibraryView(object):
+    def __init__(self, libraryTable, sublibraries=None, inSublibraries=None):
+        if inSublibraries is None and sublibraries is not None:
+            inSublibraries = getSublibraryMask(libraryTable, sublibraries)
+
+        if inSublibraries is None or np.all(inSublibraries):
+            self.table = libraryTable
+        else:
+            self.table = libraryTable[np.asarray(inSublibraries)]
+
+        self.negativeMask = pd.Series(self.table['gene'].values == 'negative_control', index=self.table.index)
+
+        self.geneCodes, geneNames = pd.factorize(self.table['gene'].values, sort=True)
+        self.geneNames = pd.Index(geneNames, name='gene')
+        if 'transcripts' in self.table.columns:
+            transcriptCodes, transcriptNames = pd.factorize(self.table['transcripts'].values, sort=True)
+            pairCodes = np.where((self.geneCodes >= 0) & (transcriptCodes >= 0), self.geneCodes * len(transcriptNames) + transcriptCodes, -1)
+            uniquePairs, self.transcriptCodes = np.unique(pairCodes, return_inverse=True)
+
+            if len(uniquePairs) > 0 and uniquePairs[0] == -1:
+                uniquePairs = uniquePairs[1:]
+                self.transcriptCodes -= 1
+
+            self.transcriptGenes = uniquePairs // len(transcriptNames) #gene code of each transcript
+            self.transcriptNames = pd.MultiIndex.from_arrays([self.geneNames[self.transcriptGenes], 
+                transcriptNames[uniquePairs % len(transcriptNames)]], names=['gene','transcripts'])
+        else:
+            self.transcriptCodes, self.transcriptNames, self.transcriptGenes = None, None, None
+
+    #boolean Series of the sgRNAs targeting a gene, or any of a list or set of genes
+    def geneMask(self, genes):
+        if isinstance(genes, str):
+            genes = [genes]
+
+        geneCodes = self.geneNames.get_indexer(list(genes))
+        return pd.Series(np.in1d(self.geneCodes, geneCodes[geneCodes >= 0]), index=self.table.index)
+
+    #the view of this library with more elements (such as pseudogenes) appended
+    def append(self, extraTable):
+        return LibraryView(self.table.append(extraTable))
+
+#boolean array of the library elements in any of the sublibraries, matched case-insensitively; each distinct
+#sublibrary name is only lowercased and looked up once
+def getSublibraryMask(libraryTable, sublibraries):
+    sublibraryCodes, sublibraryNames = pd.factorize(libraryTable['sublibrary'].values)
+    namesKept = np.array([name.lower() in sublibraries for name in sublibraryNames] + [False], dtype=bool)
+
+    return namesKept[sublibraryCodes]
+
+#the library view of a data dict, made from its library table if the dict does not have one
+def getLibraryView(data):
+    if 'library view' in data:
+        return data['library view']
+
+    return LibraryView(data['library'])
 
 ##read counts-level plotting functions
 def countsHistogram(data, condition=None, replicate=None):
@@ -107,7 +300,7 @@ def countsHistogram(data, condition=None, replicate=None):
     axis.set_ylabel('Number of sgRNAs')
     
     plt.tight_layout()
-    return displayFigure(fig, 'counts_hist')
+    return displayFigure(fig, 'counts_hist', {'condition':condition, 'replicate':replicate})
     
 def countsScatter(data, condition_x = None, replicate_x = None,
                         condition_y = None, replicate_y = None,
@@ -140,9 +333,11 @@ def countsScatter(data, condition_x = None, replicate_x = None,
                 
             plt.colorbar(result)
     
+    libraryView = getLibraryView(data)
+
     if showNegatives:
-        axis.scatter(np.log2(data['counts'].loc[data['library']['gene'] == 'negative_control', (condition_x, replicate_x)] + 1), 
-            np.log2(data['counts'].loc[data['library']['gene'] == 'negative_control', (condition_y, replicate_y)] + 1), 
+        axis.scatter(np.log2(data['counts'].loc[libraryView.negativeMask, (condition_x, replicate_x)] + 1), 
+            np.log2(data['counts'].loc[libraryView.negativeMask, (condition_y, replicate_y)] + 1), 
             s=1.5, c='#BFBFBF', label='non-targeting sgRNAs',
                      rasterized=True)
             
@@ -150,13 +345,13 @@ def countsScatter(data, condition_x = None, replicate_x = None,
         if isinstance(showGenes,str):
             showGenes = [showGenes]
             
-        geneSet = set(data['library']['gene'])
         for i, gene in enumerate(showGenes):
-            if gene not in geneSet:
+            if gene not in libraryView.geneNames:
                 print '{0} not in dataset'.format(gene)
             else:
-                axis.scatter(np.log2(data['counts'].loc[data['library']['gene'] == gene, (condition_x, replicate_x)] + 1), 
-                    np.log2(data['counts'].loc[data['library']['gene'] == gene, (condition_y, replicate_y)] + 1), 
+                geneMask = libraryView.geneMask(gene)
+                axis.scatter(np.log2(data['counts'].loc[geneMask, (condition_x, replicate_x)] + 1), 
+                    np.log2(data['counts'].loc[geneMask, (condition_y, replicate_y)] + 1), 
                     s=3, c=dark2[i], label=gene)
                     
     plt.legend(loc='best', fontsize=6, handletextpad=0.005)
@@ -168,7 +363,8 @@ def countsScatter(data, condition_x = None, replicate_x = None,
     axis.set_ylabel('{0} {1} sgRNA read counts (log2)'.format(condition_y, replicate_y), fontsize=8)
     
     plt.tight_layout()
-    return displayFigure(fig, 'counts_scatter')
+    return displayFigure(fig, 'counts_scatter', {'condition_x':condition_x, 'replicate_x':replicate_x, 'condition_y':condition_y, 'replicate_y':replicate_y, 
+        'colorByPhenotype_condition':colorByPhenotype_condition, 'colorByPhenotype_replicate':colorByPhenotype_replicate})
     
 def premergedCountsScatterMatrix(data, condition=None, replicate=None):
     if not checkOptions(data, 'counts', (condition,replicate)):
@@ -215,7 +411,7 @@ def premergedCountsScatterMatrix(data, condition=None, replicate=None):
         
         
     plt.tight_layout(pad=.05)
-    return displayFigure(fig, 'premerged_counts_scatter')
+    return displayFigure(fig, 'premerged_counts_scatter', {'condition':condition, 'replicate':replicate})
 
 
 ##phenotype-level plotting functions
@@ -231,7 +427,7 @@ def phenotypeHistogram(data, phenotype=None, replicate=None):
     axis.semilogy()
     
     axis.hist([data['phenotypes'].loc[:, (phenotype, replicate)].dropna(), 
-                data['phenotypes'].loc[data['library']['gene'] == 'negative_control', (phenotype, replicate)].dropna()],
+                data['phenotypes'].loc[getLibraryView(data).negativeMask, (phenotype, replicate)].dropna()],
         bins=int(len(data['phenotypes']) ** .3), 
         histtype='step', color=[almost_black, '#BFBFBF'], label=['all sgRNAs', 'non-targeting sgRNAs'], lw=1)
         
@@ -243,7 +439,7 @@ def phenotypeHistogram(data, phenotype=None, replicate=None):
     axis.set_ylabel('Number of sgRNAs')
     
     plt.tight_layout()
-    return displayFigure(fig, 'phenotype_hist')
+    return displayFigure(fig, 'phenotype_hist', {'phenotype':phenotype, 'replicate':replicate})
 
 def phenotypeScatter(data, phenotype_x = None, replicate_x = None,
                         phenotype_y = None, replicate_y = None,
@@ -264,9 +460,11 @@ def phenotypeScatter(data, phenotype_x = None, replicate_x = None,
             s=1.5, c=almost_black, label='all sgRNAs',
              rasterized=True)
     
+    libraryView = getLibraryView(data)
+
     if showNegatives:
-        axis.scatter(data['phenotypes'].loc[data['library']['gene'] == 'negative_control', (phenotype_x, replicate_x)], 
-            data['phenotypes'].loc[data['library']['gene'] == 'negative_control', (phenotype_y, replicate_y)], 
+        axis.scatter(data['phenotypes'].loc[libraryView.negativeMask, (phenotype_x, replicate_x)], 
+            data['phenotypes'].loc[libraryView.negativeMask, (phenotype_y, replicate_y)], 
             s=1.5, c='#BFBFBF', label='non-targeting sgRNAs',
              rasterized=True)
             
@@ -275,13 +473,13 @@ def phenotypeScatter(data, phenotype_x = None, replicate_x = None,
         if isinstance(showGenes,str):
             showGenes = [showGenes]
             
-        geneSet = set(data['library']['gene'])
         for i, gene in enumerate(showGenes):
-            if gene not in geneSet:
+            if gene not in libraryView.geneNames:
                 print '{0} not in dataset'.format(gene)
             else:
-                axis.scatter(data['phenotypes'].loc[data['library']['gene'] == gene, (phenotype_x, replicate_x)], 
-                    data['phenotypes'].loc[data['library']['gene'] == gene, (phenotype_y, replicate_y)], 
+                geneMask = libraryView.geneMask(gene)
+                axis.scatter(data['phenotypes'].loc[geneMask, (phenotype_x, replicate_x)], 
+                    data['phenotypes'].loc[geneMask, (phenotype_y, replicate_y)], 
                     s=3, c=dark2[i], label=gene,
                      rasterized=True)
                     
@@ -292,7 +490,7 @@ def phenotypeScatter(data, phenotype_x = None, replicate_x = None,
             
         else:
             for j, gs in enumerate(showGeneSets):
-                sgsTargetingSet = data['library']['gene'].apply(lambda gene: gene in showGeneSets[gs])
+                sgsTargetingSet = libraryView.geneMask(showGeneSets[gs])
                 axis.scatter(data['phenotypes'].loc[sgsTargetingSet, (phenotype_x, replicate_x)], 
                     data['phenotypes'].loc[sgsTargetingSet, (phenotype_y, replicate_y)], 
                     s=3, c=dark2[i+j], label=gs,
@@ -306,7 +504,7 @@ def phenotypeScatter(data, phenotype_x = None, replicate_x = None,
     axis.set_ylabel('sgRNA {0} {1}'.format(phenotype_y, replicate_y), fontsize=8)
     
     plt.tight_layout()
-    return displayFigure(fig, 'phenotype_scatter')
+    return displayFigure(fig, 'phenotype_scatter', {'phenotype_x':phenotype_x, 'replicate_x':replicate_x, 'phenotype_y':phenotype_y, 'replicate_y':replicate_y})
 
 def sgRNAsPassingFilterHist(data, phenotype, replicate, transcripts=False):
     if not checkOptions(data, 'phenotypes', (phenotype,replicate)):
@@ -317,10 +515,13 @@ def sgRNAsPassingFilterHist(data, phenotype, replicate, transcripts=False):
     
     axis.semilogy()
     
+    libraryView = getLibraryView(data)
     if transcripts:
-        sgRNAsPerGene = data['phenotypes'].loc[data['library']['gene'] != 'negative_control', (phenotype, replicate)].groupby([data['library']['gene'],data['library']['transcripts']]).count()
+        groupCodes = pd.Series(libraryView.transcriptCodes, index=libraryView.table.index)
     else:
-        sgRNAsPerGene = data['phenotypes'].loc[data['library']['gene'] != 'negative_control', (phenotype, replicate)].groupby(data['library']['gene']).count()
+        groupCodes = pd.Series(libraryView.geneCodes, index=libraryView.table.index)
+
+    sgRNAsPerGene = data['phenotypes'].loc[~libraryView.negativeMask, (phenotype, replicate)].groupby(groupCodes[groupCodes >= 0]).count()
     
     axis.hist(sgRNAsPerGene,
         bins=np.arange(min(sgRNAsPerGene), max(sgRNAsPerGene) + 1, 1), 
@@ -332,7 +533,7 @@ def sgRNAsPassingFilterHist(data, phenotype, replicate, transcripts=False):
     axis.set_ylabel('Number of sgRNAs')
     
     plt.tight_layout()
-    return displayFigure(fig, 'sgRNAs_passing_filter_hist')
+    return displayFigure(fig, 'sgRNAs_passing_filter_hist', {'phenotype':phenotype, 'replicate':replicate, 'transcripts':transcripts})
     
 ##gene-level plotting functions
 def volcanoPlot(data, phenotype=None, replicate=None, transcripts=False, showPseudo=True,
@@ -415,7 +616,6 @@ def volcanoPlot(data, phenotype=None, replicate=None, transcripts=False, showPse
             
         else:
             for i, gs in enumerate(showGeneSets):
-                sgsTargetingSet = data['library']['gene'].apply(lambda gene: gene in showGeneSets[gs])
                 axis.scatter(table.loc[showGeneSets[gs], effectSizeLabel], 
                     -1*np.log10(table.loc[showGeneSets[gs],pvalueLabel]), 
                     s=6, c=dark2[i], label=gs)
@@ -445,7 +645,7 @@ def volcanoPlot(data, phenotype=None, replicate=None, transcripts=False, showPse
     plt.legend(loc='best', fontsize=6, handletextpad=0.005)
 
     plt.tight_layout()
-    return displayFigure(fig, 'volcano_plot')
+    return displayFigure(fig, 'volcano_plot', {'phenotype':phenotype, 'replicate':replicate, 'transcripts':transcripts, 'hitThreshold':hitThreshold})
 
 ##utility functions
 def checkOptions(data, graphType, optionTuple):
@@ -515,21 +715,39 @@ def getPvalueLabel(table):
     else:
         return pvalColLabels[0]
         
-def displayFigure(fig, savetitle=''):
+def displayFigure(fig, savetitle='', parameters=None):
+    global figureRegistry
+
     if plotWithPylab:
         plt.show(fig)
         
     if plotDirectory != None:
-        figNums = [int(fileName.split('_fig_')[0]) for fileName in os.listdir(plotDirectory) if len(fileName.split('_fig_')) >= 2]
-        if len(figNums) == 0:
-            nextFigNum = 0
-        else:
-            nextFigNum = max(figNums) + 1
+        #figures rendered for PlotScheduler are saved under a temporary name, and numbered once every earlier figure is saved
+        if unnumberedFigures is not None:
+            tempFile, tempFileName = tempfile.mkstemp(suffix='.' + imageExtension, prefix=unnumberedFigurePrefix, dir=plotDirectory)
+            os.close(tempFile)
+
+            startTime = time.time()
+            fig.savefig(tempFileName, dpi=1000)
+            plt.close(fig)
+
+            unnumberedFigures.append((tempFileName, savetitle, parameters, time.time() - startTime))
+
+            return tempFileName
+
+        #plotDirectory may be set directly instead of through changeDisplayFigureSettings
+        if figureRegistry is None or figureRegistry.plotDirectory != plotDirectory:
+            figureRegistry = FigureRegistry(plotDirectory)
+
+        nextFigNum = figureRegistry.reserveNumbers()
 
         fullTitle =  os.path.join(plotDirectory,'{0:03d}_fig_{1}.{2}'.format(nextFigNum, savetitle, imageExtension))
         print fullTitle
+        startTime = time.time()
         fig.savefig(fullTitle, dpi=1000)
         plt.close(fig) 
+
+        figureRegistry.recordFigure(nextFigNum, fullTitle, savetitle, parameters, time.time() - startTime)
         
         return fullTitle
         
@@ -541,6 +759,12 @@ def displayFigure(fig, savetitle=''):
 def changeDisplayFigureSettings(newDirectory=None, newImageExtension = 'png', newPlotWithPylab = True, newFigureScale = 1):
     global plotDirectory
     plotDirectory = newDirectory
+
+    global figureRegistry
+    if newDirectory is None:
+        figureRegistry = None
+    elif figureRegistry is None or figureRegistry.plotDirectory != newDirectory:
+        figureRegistry = FigureRegistry(newDirectory)
     
     global imageExtension
     imageExtension = newImageExtension
@@ -551,6 +775,145 @@ def changeDisplayFigureSettings(newDirectory=None, newImageExtension = 'png', ne
     global figureScale
     figureScale = newFigureScale
     
+##figure registry
+#hands out figure numbers for a plot directory and records the number, file, title, parameters and render (savefig)
+#time of each saved figure as a line of json in figure_index.txt, so figures are numbered and found without listing
+#the directory; the number counter and index file lock are shared with processes forked after the registry is made
+class FigureRegistry(object):
+    def __init__(self, plotDirectory):
+        self.plotDirectory = plotDirectory
+        self.indexFileName = os.path.join(plotDirectory, figureIndexFileName)
+        self.lock = multiprocessing.Lock()
+
+        #plot directories without an index (from earlier versions) are listed once
+        if os.path.exists(self.indexFileName):
+            figNums = [entry['number'] for entry in readFigureIndex(plotDirectory)]
+        else:
+            figNums = [int(fileName.split('_fig_')[0]) for fileName in os.listdir(plotDirectory) 
+                if len(fileName.split('_fig_')) >= 2 and not fileName.startswith(unnumberedFigurePrefix)]
+
+        self.nextNumber = multiprocessing.Value('i', max(figNums) + 1 if len(figNums) > 0 else 0, lock=False)
+
+    #reserve count consecutive figure numbers, returning the first
+    def reserveNumbers(self, count=1):
+        with self.lock:
+            firstNumber = self.nextNumber.value
+            self.nextNumber.value += count
+
+        return firstNumber
+
+    def recordFigure(self, number, fileName, title, parameters, renderTime):
+        entry = json.dumps({'number':number, 'file':os.path.basename(fileName), 'title':title, 'parameters':parameters, 
+            'render_time':round(renderTime, 3), 'saved':time.strftime('%Y-%m-%d %H:%M:%S')}, sort_keys=True, default=str)
+
+        with self.lock:
+            with open(self.indexFileName, 'a') as indexFile:
+                indexFile.write(entry + '\n')
+
+#the figure index of a plot directory as a list of dicts, in the order figures were saved
+def readFigureIndex(plotDirectory):
+    indexFileName = os.path.join(plotDirectory, figureIndexFileName)
+    if not os.path.exists(indexFileName):
+        return []
+
+    with open(indexFileName) as indexFile:
+        return [json.loads(line) for line in indexFile if len(line.strip()) > 0]
+
+#figures in a plot directory's index with the given title (e.g. volcano_plot) and parameter values, latest first
+def findFigures(plotDirectory, title=None, **parameters):
+    return [entry for entry in reversed(readFigureIndex(plotDirectory)) if (title is None or entry['title'] == title) 
+        and all((entry['parameters'] or dict()).get(key) == value for key, value in parameters.items())]
+
+##parallel figure rendering
+#renders figures with the plotting functions above in a pool of plotWorkers processes, each with the Agg backend, or in
+#this process if plotWorkers is 1; figures are saved under temporary names and numbered from the figures actually
+#saved, in submission order, so the numbers, files and index entries are those of drawing the jobs one at a time
+#(jobs that save no figure, such as plots skipped for too few points, take no number), whatever order the workers
+#finish them in; figures drawn in workers are numbered when the scheduler is closed
+class PlotScheduler(object):
+    def __init__(self, plotWorkers=1):
+        self.plotWorkers = plotWorkers
+        self.pendingSubmissions = []
+
+        if plotWorkers > 1:
+            self.pool = multiprocessing.Pool(plotWorkers, initializer=initPlotWorker, initargs=(plotDirectory, imageExtension, figureScale))
+        else:
+            self.pool = None
+
+    #jobList holds (plotting function, args, kwargs) tuples, each drawn as plotFunction(data, *args, **kwargs); returns
+    #a list that holds the file names of the jobs' figures once they are numbered
+    def submit(self, data, jobList):
+        figureFiles = []
+
+        if self.pool is None:
+            numberFigures(renderFigures(data, jobList), figureFiles)
+        else:
+            #each worker gets every plotWorkers-th job, so the data is sent to each worker once per submission
+            workerResults = [self.pool.apply_async(renderFigures, (data, jobList[i::self.plotWorkers])) for i in range(min(self.plotWorkers, len(jobList)))]
+            self.pendingSubmissions.append((len(jobList), workerResults, figureFiles))
+
+        return figureFiles
+
+    #wait for every submitted figure and number them in submission order, raising the first error from a worker; on an
+    #error the workers are stopped and the figures not yet numbered are deleted
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            try:
+                for numJobs, workerResults, figureFiles in self.pendingSubmissions:
+                    jobFigures = [None] * numJobs
+                    for i, workerResult in enumerate(workerResults):
+                        jobFigures[i::self.plotWorkers] = workerResult.get()
+
+                    numberFigures(jobFigures, figureFiles)
+            except:
+                self.pool.terminate()
+                self.pool.join()
+
+                for fileName in os.listdir(plotDirectory):
+                    if fileName.startswith(unnumberedFigurePrefix):
+                        os.remove(os.path.join(plotDirectory, fileName))
+                raise
+
+            self.pool.join()
+
+def initPlotWorker(newDirectory, newImageExtension, newFigureScale):
+    plt.switch_backend('Agg')
+    changeDisplayFigureSettings(newDirectory=newDirectory, newImageExtension=newImageExtension, newPlotWithPylab=False, newFigureScale=newFigureScale)
+
+#draw each job, returning the unnumbered figures (temporary file name, title, parameters, render time) each job saved
+def renderFigures(data, jobList):
+    global unnumberedFigures
+
+    jobFigures = []
+    try:
+        for plotFunction, args, kwargs in jobList:
+            unnumberedFigures = []
+            plotFunction(data, *args, **kwargs)
+            jobFigures.append(unnumberedFigures)
+    finally:
+        unnumberedFigures = None
+
+    return jobFigures
+
+#give the unnumbered figures of each job the next numbers of the figure registry, renaming their files and recording
+#them in the figure index, and add the numbered file names to figureFiles
+def numberFigures(jobFigures, figureFiles):
+    global figureRegistry
+
+    if figureRegistry is None or figureRegistry.plotDirectory != plotDirectory:
+        figureRegistry = FigureRegistry(plotDirectory)
+
+    for savedFigures in jobFigures:
+        for tempFileName, savetitle, parameters, renderTime in savedFigures:
+            figNum = figureRegistry.reserveNumbers()
+            fullTitle = os.path.join(plotDirectory, '{0:03d}_fig_{1}.{2}'.format(figNum, savetitle, imageExtension))
+            os.rename(tempFileName, fullTitle)
+            print fullTitle
+
+            figureRegistry.recordFigure(figNum, fullTitle, savetitle, parameters, renderTime)
+            figureFiles.append(os.path.basename(fullTitle))
+
 def plotGrid(axis, vert_origin = True, horiz_origin=True, unity=True):
     ylim = axis.get_ylim()
     xlim = axis.get_xlim()
@@ -0,0 +1,95 @@
+# Tests for range checks in expt_config_parser.py
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import expt_config_parser
+
+packageDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+class EmpiricalDrawsTest(unittest.TestCase):
+    def setUp(self):
+        self.configDirectory = tempfile.mkdtemp()
+        self.librariesToSublibraries = expt_config_parser.parseLibraryConfig(os.path.join(packageDirectory, 'library_tables', 'library_config.txt'))[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.configDirectory)
+
+    #the Demo config with the empirical analysis on and the given empirical_draws
+    def parseConfig(self, empiricalDraws):
+        with open(os.path.join(packageDirectory, 'Demo', 'Step2', 'experiment_config_file_DEMO.txt')) as demoFile:
+            configText = demoFile.read()
+
+        configText = configText.replace('calculate_empirical = False', 'calculate_empirical = True')
+        configText = configText.replace('empirical_draws = 100000', 'empirical_draws = %s' % empiricalDraws)
+
+        configFileName = os.path.join(self.configDirectory, 'config.txt')
+        with open(configFileName, 'w') as configFile:
+            configFile.write(configText)
+
+        return expt_config_parser.parseExptConfig(configFileName, self.librariesToSublibraries)
+
+    def testPositiveDrawsAccepted(self):
+        paramDict, exitStatus, warningString = self.parseConfig(1)
+
+        self.assertEqual(paramDict['analyses']['calculate_empirical'][-1], 1)
+        self.assertNotIn('Empirical draws', warningString)
+
+    def testDrawsBelowOneRejected(self):
+        acceptedStatus = self.parseConfig(1)[1]
+
+        for empiricalDraws in [0, -5]:
+            paramDict, exitStatus, warningString = self.parseConfig(empiricalDraws)
+
+            self.assertEqual(exitStatus, acceptedStatus + 1)
+            self.assertIn('Empirical draws must be at least 1', warningString)
+            self.assertNotIn(empiricalDraws, paramDict['analyses']['calculate_empirical'][1:])
+
+
+class PseudogeneSeedTest(unittest.TestCase):
+    def setUp(self):
+        self.configDirectory = tempfile.mkdtemp()
+        self.librariesToSublibraries = expt_config_parser.parseLibraryConfig(os.path.join(packageDirectory, 'library_tables', 'library_config.txt'))[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.configDirectory)
+
+    #the Demo config with the given pseudogene_seed
+    def parseConfig(self, pseudogeneSeed):
+        with open(os.path.join(packageDirectory, 'Demo', 'Step2', 'experiment_config_file_DEMO.txt')) as demoFile:
+            configText = demoFile.read()
+
+        configText = configText.replace('#pseudogene_seed = 0', 'pseudogene_seed = %s' % pseudogeneSeed)
+
+        configFileName = os.path.join(self.configDirectory, 'config.txt')
+        with open(configFileName, 'w') as configFile:
+            configFile.write(configText)
+
+        return expt_config_parser.parseExptConfig(configFileName, self.librariesToSublibraries)
+
+    def testSeedsInRangeAccepted(self):
+        for pseudogeneSeed in [0, 2**32 - 1]:
+            paramDict, exitStatus, warningString = self.parseConfig(pseudogeneSeed)
+
+            self.assertEqual(paramDict['pseudogene_seed'], pseudogeneSeed)
+            self.assertNotIn('Pseudogene seed', warningString)
+
+    #seeds numpy's RandomState cannot take are rejected while parsing instead of failing once pseudogenes are drawn
+    def testSeedsOutOfRangeRejected(self):
+        acceptedStatus = self.parseConfig(0)[1]
+
+        for pseudogeneSeed in [-1, 2**32]:
+            paramDict, exitStatus, warningString = self.parseConfig(pseudogeneSeed)
+
+            self.assertEqual(exitStatus, acceptedStatus + 1)
+            self.assertIn('Pseudogene seed must be between 0 and 2**32 - 1', warningString)
+            self.assertNotIn('pseudogene_seed', paramDict)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,700 @@
+# Tests for counting reads in fastqgz_to_counts.py
+#
+# each test writes a small library fasta and fastq file of random sequences; reads are the library sequence after one
+# base, and quality lines start with @ now and then as they can in real files
+
+import os
+import sys
+import gzip
+import zlib
+import json
+import struct
+import shutil
+import StringIO
+import tempfile
+import unittest
+import collections
+import multiprocessing
+import distutils.spawn
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fastqgz_to_counts
+
+readLength = 20
+
+
+class CountingTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.randomState = np.random.RandomState(0)
+        self.savedSettings = (fastqgz_to_counts.recordBlockSize, fastqgz_to_counts.progressInterval, fastqgz_to_counts.countsFormat, fastqgz_to_counts.testLines, 
+            fastqgz_to_counts.renumberBatchRecords)
+
+        fastqgz_to_counts.progressInterval = 0
+        fastqgz_to_counts.countsFormat = 'text'
+
+        self.librarySeqs = sorted(set([self.randomSeq(readLength) for i in range(60)]))
+        self.libraryFasta = os.path.join(self.directory, 'library.fa')
+        with open(self.libraryFasta, 'w') as libraryFile:
+            for i, seq in enumerate(self.librarySeqs):
+                libraryFile.write('>sg_%d\n%s\n' % (i, seq))
+
+    def tearDown(self):
+        fastqgz_to_counts.recordBlockSize, fastqgz_to_counts.progressInterval, fastqgz_to_counts.countsFormat, fastqgz_to_counts.testLines, \
+            fastqgz_to_counts.renumberBatchRecords = self.savedSettings
+        fastqgz_to_counts.parsedLibraries.clear()
+        fastqgz_to_counts.mismatchIndices.clear()
+        shutil.rmtree(self.directory)
+
+    def randomSeq(self, length):
+        return ''.join(self.randomState.choice(list('ACGT'), length))
+
+    #reads of library sequences, with every fifth read unaligned (of ten distinct sequences, so they repeat); the last
+    #record of a library fasta is not read by parseLibraryFasta, so its sequence is left out
+    def makeReads(self, numReads):
+        unalignedSeqs = [self.randomSeq(readLength) for i in range(10)]
+        return ['G' + (unalignedSeqs[i % 10] if i % 5 == 0 else self.librarySeqs[self.randomState.randint(len(self.librarySeqs) - 1)]) + 'TTT'
+            for i in range(numReads)]
+
+    def writeFastq(self, fileName, reads, compressed=False):
+        fastqFileName = os.path.join(self.directory, fileName)
+        with (gzip.open(fastqFileName, 'wb') if compressed else open(fastqFileName, 'w')) as fastqFile:
+            for i, read in enumerate(reads):
+                fastqFile.write('@read_%d 1:N:0:ACGT\n%s\n+\n%s\n' % (i, read, ('@' if i % 7 == 0 else 'I') + 'I' * (len(read) - 1)))
+
+        return fastqFileName
+
+    def readFile(self, fileName):
+        with (gzip.open(fileName) if fileName.endswith('.gz') else open(fileName)) as infile:
+            return infile.read()
+
+
+class ShardingTest(CountingTest):
+    #every shard boundary is the start of a record, even where a quality line starts with @
+    def testShardsStartAtRecords(self):
+        fastqFileName = self.writeFastq('reads.fastq', self.makeReads(500))
+        with open(fastqFileName) as fastqFile:
+            fileText = fastqFile.read()
+
+        lineStarts = np.cumsum([0] + [len(line) + 1 for line in fileText.split('\n')])
+        recordStarts = set(lineStarts[::4].tolist())
+
+        byteRanges = fastqgz_to_counts.getShardByteRanges(fastqFileName, 4, 7)
+        self.assertEqual(len(byteRanges), 7)
+        self.assertEqual(byteRanges[0][0], 0)
+        self.assertEqual(byteRanges[-1][1], len(fileText))
+
+        for (byteStart, byteEnd), (nextStart, nextEnd) in zip(byteRanges[:-1], byteRanges[1:]):
+            self.assertEqual(byteEnd, nextStart)
+            self.assertIn(nextStart, recordStarts)
+
+    #records split between blocks are carried over to the next block, and a last record without a newline is kept
+    def testRecordBlocksHoldWholeRecords(self):
+        reads = self.makeReads(300)
+        fastqFileName = self.writeFastq('reads.fastq', reads)
+        with open(fastqFileName, 'a') as fastqFile:
+            fastqFile.write('@last\n%s\n+\n%s' % (reads[0], 'I' * len(reads[0])))
+
+        with open(fastqFileName) as fastqFile:
+            recordBlocks = list(fastqgz_to_counts.readRecordBlocks(fastqFile, 4, blockSize=1000))
+
+        self.assertGreater(len(recordBlocks), 10)
+        self.assertTrue(all(recordBlock.startswith('@') for recordBlock in recordBlocks))
+        self.assertEqual(sum([fastqgz_to_counts.countBlockReads(recordBlock, 4) for recordBlock in recordBlocks]), 301)
+        self.assertEqual(sum([fastqgz_to_counts.getBlockSeqs(recordBlock, 4) for recordBlock in recordBlocks], []), reads + [reads[0]])
+
+    #counting a file with --split_files gives the same counts and unaligned reads, in the same order, as counting it whole,
+    #in test runs as well; shard part files are renamed in several batches
+    def testShardedCountsMatchSerial(self):
+        fastqgz_to_counts.recordBlockSize = 2000
+        fastqgz_to_counts.renumberBatchRecords = 7
+        fastqgz_to_counts.testLines = 1234
+        reads = self.makeReads(3000)
+        fastqFileNames = [self.writeFastq('reads.fastq', reads), self.writeFastq('reads.fastq.gz', reads, compressed=True)]
+
+        processPool = multiprocessing.Pool(3)
+        try:
+            for unalignedMode in ['fasta', 'gzip', 'sample', 'collapsed']:
+                for fastqFileName in fastqFileNames:
+                    for test in [False, True]:
+                        outputs = []
+                        for sharded in [False, True]:
+                            outbase = os.path.join(self.directory, '%s_%s' % (os.path.basename(fastqFileName), 'sharded' if sharded else 'serial'))
+                            unalignedFileName = outbase + fastqgz_to_counts.unalignedFileSuffixes[unalignedMode]
+
+                            if sharded:
+                                result = fastqgz_to_counts.shardedSeqFileToCounts(fastqFileName, unalignedFileName, outbase + '.counts', processPool, 3,
+                                    self.libraryFasta, 1, 1 + readLength, test, unalignedMode=unalignedMode, unalignedNumber=240)
+                            else:
+                                result = fastqgz_to_counts.seqFileToCounts(fastqFileName, unalignedFileName, outbase + '.counts',
+                                    self.libraryFasta, 1, 1 + readLength, test, unalignedMode=unalignedMode, unalignedNumber=240)
+
+                            outputs.append((result[:4], self.readFile(outbase + '.counts'), self.readFile(unalignedFileName)))
+
+                        self.assertEqual(outputs[0], outputs[1])
+                        self.assertEqual(outputs[1][0][0], 1234 if test else 3000)
+
+                    if unalignedMode == 'sample':
+                        self.assertEqual(outputs[1][2].count('>'), 240)
+        finally:
+            processPool.terminate()
+            processPool.join()
+
+    #unaligned reads are named by the line number of their sequence (counting from 0), as in the serial output
+    def testShardedUnalignedReadNames(self):
+        fastqgz_to_counts.recordBlockSize = 2000
+        reads = self.makeReads(1000)
+        fastqFileName = self.writeFastq('reads.fastq', reads)
+
+        processPool = multiprocessing.Pool(3)
+        try:
+            fastqgz_to_counts.shardedSeqFileToCounts(fastqFileName, fastqFileName + '_unaligned.fa', fastqFileName + '.counts', processPool, 3,
+                self.libraryFasta, 1, 1 + readLength)
+        finally:
+            processPool.terminate()
+            processPool.join()
+
+        unalignedLines = self.readFile(fastqFileName + '_unaligned.fa').split('\n')[:-1]
+        self.assertEqual([int(line[1:]) for line in unalignedLines[0::2]], [i * 4 + 1 for i in range(0, 1000, 5)])
+        self.assertEqual(unalignedLines[1::2], [reads[i][1:1 + readLength] for i in range(0, 1000, 5)])
+
+
+class CollapsedUnalignedTest(CountingTest):
+    #reads of frequent unaligned sequences spread through many distinct unaligned reads, so tallies are cut many times;
+    #each frequent sequence is more than a fiftieth of the unaligned reads, the most kept when listing five
+    def makeCollapsedReads(self):
+        self.frequentSeqs = [(self.randomSeq(readLength), numReads) for numReads in [600, 450, 300, 240, 180]]
+        reads = ['G' + self.randomSeq(readLength) + 'TTT' for i in range(4000)]
+        for seq, numReads in self.frequentSeqs:
+            for position in np.linspace(0, len(reads), numReads, endpoint=False).astype(int)[::-1]:
+                reads.insert(position, 'G' + seq + 'TTT')
+
+        return reads
+
+    def testTalliesAreCut(self):
+        unalignedSeqCounts = collections.Counter(dict(('seq_%04d' % i, i % 7) for i in range(1000)))
+        fastqgz_to_counts.pruneUnalignedSeqCounts(unalignedSeqCounts, 50)
+        self.assertEqual(len(unalignedSeqCounts), 1000)
+
+        fastqgz_to_counts.pruneUnalignedSeqCounts(unalignedSeqCounts, 5)
+        self.assertEqual(len(unalignedSeqCounts), 5 * fastqgz_to_counts.collapsedKeepFactor)
+        self.assertEqual(set(unalignedSeqCounts.values()), set([6]))
+
+    #the most frequent unaligned sequences are listed with their exact counts, serially and with --split_files, while
+    #every tally and every block result stays within the bound
+    def testTopUnalignedSeqs(self):
+        fastqgz_to_counts.recordBlockSize = 5000
+        fastqFileName = self.writeFastq('reads.fastq', self.makeCollapsedReads())
+        expectedLines = ''.join(['%s\t%d\n' % seqTup for seqTup in self.frequentSeqs])
+
+        with open(fastqFileName) as fastqFile:
+            for recordBlock in fastqgz_to_counts.readRecordBlocks(fastqFile, 4):
+                blockUnaligned = fastqgz_to_counts.countRecordBlock(recordBlock, 0, fastqFileName + '.part', 4, self.libraryFasta, 1, 1 + readLength,
+                    unalignedMode='collapsed', unalignedNumber=len(self.frequentSeqs))[4]
+                self.assertLessEqual(len(blockUnaligned), len(self.frequentSeqs) * fastqgz_to_counts.collapsedKeepFactor)
+
+        processPool = multiprocessing.Pool(3)
+        try:
+            for sharded in [False, True]:
+                collapsedFileName = os.path.join(self.directory, 'collapsed_%s.txt' % sharded)
+                if sharded:
+                    fastqgz_to_counts.shardedSeqFileToCounts(fastqFileName, collapsedFileName, fastqFileName + '.counts', processPool, 3,
+                        self.libraryFasta, 1, 1 + readLength, unalignedMode='collapsed', unalignedNumber=len(self.frequentSeqs))
+                else:
+                    fastqgz_to_counts.seqFileToCounts(fastqFileName, collapsedFileName, fastqFileName + '.counts',
+                        self.libraryFasta, 1, 1 + readLength, unalignedMode='collapsed', unalignedNumber=len(self.frequentSeqs))
+
+                self.assertEqual(self.readFile(collapsedFileName), expectedLines)
+        finally:
+            processPool.terminate()
+            processPool.join()
+
+
+class LibraryIndexTest(CountingTest):
+    def failingCall(self, *args):
+        raise AssertionError('not expected to be called')
+
+    #a fasta touched without changing its contents keeps its index, which then records the new time so that the next
+    #load neither parses nor hashes the fasta
+    def testTouchedFastaKeepsIndex(self):
+        libraryIndex = fastqgz_to_counts.loadLibraryIndexFile(self.libraryFasta)
+        fastaTime = os.path.getmtime(self.libraryFasta) + 100
+        os.utime(self.libraryFasta, (fastaTime, fastaTime))
+
+        savedFunctions = (fastqgz_to_counts.parseLibraryFasta, fastqgz_to_counts.getFileMd5)
+        fastqgz_to_counts.parseLibraryFasta = self.failingCall
+        try:
+            touchedIndex = fastqgz_to_counts.loadLibraryIndexFile(self.libraryFasta)
+            self.assertEqual(touchedIndex.seqToIndex, libraryIndex.seqToIndex)
+            self.assertEqual(touchedIndex.elementIds, libraryIndex.elementIds)
+            self.assertEqual(fastqgz_to_counts.readArrayFile(self.libraryFasta + fastqgz_to_counts.libraryIndexExtension)[0]['fasta_mtime'],
+                os.path.getmtime(self.libraryFasta))
+
+            fastqgz_to_counts.getFileMd5 = self.failingCall
+            self.assertEqual(fastqgz_to_counts.loadLibraryIndexFile(self.libraryFasta).seqToIndex, libraryIndex.seqToIndex)
+        finally:
+            fastqgz_to_counts.parseLibraryFasta, fastqgz_to_counts.getFileMd5 = savedFunctions
+
+    #a fasta whose contents changed is parsed again
+    def testChangedFastaIsParsed(self):
+        fastqgz_to_counts.loadLibraryIndexFile(self.libraryFasta)
+        with open(self.libraryFasta, 'a') as libraryFile:
+            libraryFile.write('>sg_new\n%s\n>sg_last\n%s\n' % (self.randomSeq(readLength), self.randomSeq(readLength)))
+        fastaTime = os.path.getmtime(self.libraryFasta) + 100
+        os.utime(self.libraryFasta, (fastaTime, fastaTime))
+
+        self.assertIn('sg_new', fastqgz_to_counts.loadLibraryIndexFile(self.libraryFasta).elementIds)
+
+
+class CountsArrayTest(CountingTest):
+    #counts arrays hold the ids and counts of the text counts file, in the same order, and either can be written alone
+    def testArrayMatchesText(self):
+        fastqFileName = self.writeFastq('reads.fastq', self.makeReads(500))
+
+        for countsFormat in ['both', 'text', 'binary']:
+            fastqgz_to_counts.countsFormat = countsFormat
+            countFileName = os.path.join(self.directory, countsFormat + '.counts')
+            fastqgz_to_counts.seqFileToCounts(fastqFileName, fastqFileName + '_unaligned.fa', countFileName, self.libraryFasta, 1, 1 + readLength)
+
+            self.assertEqual(os.path.exists(countFileName), countsFormat != 'binary')
+            self.assertEqual(os.path.exists(countFileName + fastqgz_to_counts.countsArrayExtension), countsFormat != 'text')
+
+        fingerprint, elementIds, elementCounts = fastqgz_to_counts.readCountsArrayFile(os.path.join(self.directory, 'both.counts.array'))
+        self.assertEqual(fingerprint, fastqgz_to_counts.getLibraryFingerprint(elementIds.tolist()))
+        self.assertEqual(''.join(['%s\t%d\n' % tup for tup in zip(elementIds, elementCounts)]), self.readFile(os.path.join(self.directory, 'both.counts')))
+        self.assertEqual(elementCounts.sum(), 400)
+
+        binaryCounts = fastqgz_to_counts.readCountsArrayFile(os.path.join(self.directory, 'binary.counts.array'))[2]
+        self.assertTrue(np.array_equal(binaryCounts, elementCounts))
+
+    #the array next to a text counts file is read only if it is at least as new, so an edited text file is not shadowed
+    def testArrayFileChoice(self):
+        countFileName = os.path.join(self.directory, 'sample.counts')
+        arrayFileName = countFileName + fastqgz_to_counts.countsArrayExtension
+        self.assertIsNone(fastqgz_to_counts.getCountsArrayFileName(countFileName))
+
+        fastqgz_to_counts.writeCountsArrayFile(arrayFileName, ['sg_0', 'sg_1'], [3, 4])
+        self.assertEqual(fastqgz_to_counts.getCountsArrayFileName(countFileName), arrayFileName)
+        self.assertEqual(fastqgz_to_counts.getCountsArrayFileName(arrayFileName), arrayFileName)
+
+        with open(countFileName, 'w') as countFile:
+            countFile.write('sg_0\t3\nsg_1\t4\n')
+
+        for textTime, expectedFileName in [(1000000000, arrayFileName), (1000000001, None)]:
+            os.utime(arrayFileName, (1000000000, 1000000000))
+            os.utime(countFileName, (textTime, textTime))
+            self.assertEqual(fastqgz_to_counts.getCountsArrayFileName(countFileName), expectedFileName)
+
+
+class SharedSequenceTest(CountingTest):
+    #a library where sg_dup_a and sg_dup_b share a sequence and sg_two is listed with two sequences, one of them its own;
+    #the last record is only there because parseLibraryFasta does not read it
+    def setUp(self):
+        CountingTest.setUp(self)
+
+        self.extraSeq = self.randomSeq(readLength)
+        self.libraryRecords = [('sg_%d' % i, seq) for i, seq in enumerate(self.librarySeqs[3:-1])] + [('sg_dup_a', self.librarySeqs[0]), 
+            ('sg_dup_b', self.librarySeqs[0]), ('sg_two', self.librarySeqs[1]), ('sg_two', self.extraSeq), ('sg_last', self.librarySeqs[-1])]
+        with open(self.libraryFasta, 'w') as libraryFile:
+            libraryFile.write(''.join(['>%s\n%s\n' % record for record in self.libraryRecords]))
+
+    #counts files as written by counting with the baseline seqToIdDict and idsToReadcountDict, where each read adds one to
+    #every id listed with its sequence
+    def countByIds(self, seqs):
+        seqToIdDict, idsToReadcountDict = dict(), dict()
+        for seqId, seq in self.libraryRecords[:-1]:
+            seqToIdDict.setdefault(seq, []).append(seqId)
+            idsToReadcountDict[seqId] = 0
+
+        for seq in seqs:
+            if seq in seqToIdDict:
+                for seqId in seqToIdDict[seq]:
+                    idsToReadcountDict[seqId] += 1
+
+        return ''.join(['%s\t%d\n' % countTup for countTup in sorted(zip(idsToReadcountDict.keys(), idsToReadcountDict.values()))])
+
+    #counts of shared sequences are written out to each of their ids, and the counts of an id's sequences are summed
+    def testCountsFannedOutToIds(self):
+        reads = self.makeReads(1000) + ['G' + seq + 'TTT' for seq in [self.extraSeq] * 7 + [self.librarySeqs[0]] * 5 + [self.librarySeqs[1]] * 3]
+        fastqFileName = self.writeFastq('reads.fastq', reads)
+
+        result = fastqgz_to_counts.seqFileToCounts(fastqFileName, fastqFileName + '_unaligned.fa', fastqFileName + '.counts', self.libraryFasta, 1, 1 + readLength)
+        countsText = self.readFile(fastqFileName + '.counts')
+
+        self.assertEqual(countsText, self.countByIds([read[1:1 + readLength] for read in reads]))
+        librarySeqSet = set(seq for seqId, seq in self.libraryRecords[:-1])
+        self.assertEqual(result[1], sum(read[1:1 + readLength] in librarySeqSet for read in reads))
+
+        countsDict = dict(line.split('\t') for line in countsText.split('\n')[:-1])
+        self.assertEqual(countsDict['sg_dup_a'], countsDict['sg_dup_b'])
+        self.assertGreater(int(countsDict['sg_two']), 7)
+
+
+class MismatchTest(CountingTest):
+    #a library of three sequences, two of them two substitutions apart, so a read halfway between them is one mismatch
+    #from both; the last record is only there because parseLibraryFasta does not read it
+    def setUp(self):
+        CountingTest.setUp(self)
+
+        seqA, seqC = self.librarySeqs[:2]
+        self.librarySeqs = [seqA, self.substitute(self.substitute(seqA, 3), 7), seqC]
+        with open(self.libraryFasta, 'w') as libraryFile:
+            for i, seq in enumerate(self.librarySeqs + [self.librarySeqs[0]]):
+                libraryFile.write('>sg_%d\n%s\n' % (i, seq))
+
+    def substitute(self, seq, position):
+        return seq[:position] + 'ACGT'[('ACGT'.index(seq[position]) + 1) % 4] + seq[position + 1:]
+
+    #reads exactly matching, one substitution from a single sequence, one substitution from two sequences, and two
+    #substitutions from any sequence, with the library sequence index expected for each with one mismatch allowed
+    def makeMismatchReads(self):
+        seqA, seqB, seqC = self.librarySeqs
+        return [(seqA, 0), (self.substitute(seqA, 10), 0), (seqA[:3] + seqB[3] + seqA[4:], -1), 
+            (self.substitute(self.substitute(seqA, 10), 12), -1), (self.substitute(seqC, 0), 2), (self.substitute(seqB, 19), 1)]
+
+    def testSingleSubstitutionsRescued(self):
+        seqIndexDict = fastqgz_to_counts.loadLibraryFasta(self.libraryFasta).seqToIndex
+        reads, expectedSeqs = zip(*self.makeMismatchReads())
+        expectedIndices = [seqIndexDict[self.librarySeqs[seqNum]] if seqNum >= 0 else -1 for seqNum in expectedSeqs]
+
+        seqIndices, numMismatched = fastqgz_to_counts.alignSeqBatch(list(reads), self.libraryFasta, 1)
+        self.assertEqual(seqIndices.tolist(), expectedIndices)
+        self.assertEqual(numMismatched, 3)
+
+        seqIndices, numMismatched = fastqgz_to_counts.alignSeqBatch(list(reads), self.libraryFasta, 0)
+        self.assertEqual(seqIndices.tolist(), [expectedIndices[0]] + [-1] * 5)
+        self.assertEqual(numMismatched, 0)
+
+    #ambiguous neighbors and library sequences themselves are not in the neighbor index
+    def testMismatchIndex(self):
+        libraryIndex = fastqgz_to_counts.loadLibraryFasta(self.libraryFasta)
+        mismatchIndex = fastqgz_to_counts.loadMismatchIndex(self.libraryFasta)
+        seqA, seqB, seqC = self.librarySeqs
+
+        self.assertNotIn(seqA[:3] + seqB[3] + seqA[4:], mismatchIndex)
+        self.assertNotIn(seqA[:7] + seqB[7] + seqA[8:], mismatchIndex)
+        self.assertTrue(all(seq not in mismatchIndex for seq in self.librarySeqs))
+        self.assertEqual(len(mismatchIndex), 3 * readLength * (len(fastqgz_to_counts.mismatchBases) - 1) - 2 * 2)
+        self.assertEqual(mismatchIndex[self.substitute(seqC, 5)], libraryIndex.seqToIndex[seqC])
+
+    #counting a file with --mismatches 1 adds the rescued reads to the counts and reports them as mismatched
+    def testMismatchedReadsCounted(self):
+        reads, expectedSeqs = zip(*self.makeMismatchReads())
+        fastqFileName = self.writeFastq('reads.fastq', ['G' + read + 'TTT' for read in reads])
+
+        for mismatches, expectedCounts in [(0, [1, 0, 0]), (1, [2, 1, 1])]:
+            result = fastqgz_to_counts.seqFileToCounts(fastqFileName, fastqFileName + '_unaligned.fa', fastqFileName + '.counts',
+                self.libraryFasta, 1, 1 + readLength, mismatches=mismatches)
+
+            self.assertEqual(result[:2], (6, sum(expectedCounts)))
+            self.assertEqual(result[3], sum(expectedCounts) - 1)
+            self.assertEqual(self.readFile(fastqFileName + '.counts'), ''.join(['sg_%d\t%d\n' % tup for tup in enumerate(expectedCounts)]))
+            self.assertEqual(self.readFile(fastqFileName + '_unaligned.fa').count('>'), 6 - sum(expectedCounts))
+
+
+class DecompressionTest(CountingTest):
+    def setUp(self):
+        CountingTest.setUp(self)
+        self.savedBatchSettings = (fastqgz_to_counts.bgzfBlocksPerBatch, fastqgz_to_counts.compressedChunkSize)
+
+        #small batches and chunks, so the files are read in many pieces
+        fastqgz_to_counts.bgzfBlocksPerBatch = 3
+        fastqgz_to_counts.compressedChunkSize = 1000
+
+    def tearDown(self):
+        fastqgz_to_counts.bgzfBlocksPerBatch, fastqgz_to_counts.compressedChunkSize = self.savedBatchSettings
+        CountingTest.tearDown(self)
+
+    #a blocked gzip file as bgzip writes it: gzip members of at most blockSize bytes, each with its size in a BC extra
+    #subfield, followed by an empty end of file block
+    def writeBgzf(self, fileName, text, blockSize=3000):
+        bgzfFileName = os.path.join(self.directory, fileName)
+        with open(bgzfFileName, 'wb') as bgzfFile:
+            for blockStart in range(0, len(text), blockSize) + [len(text)]:
+                blockText = text[blockStart:blockStart + blockSize]
+                compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+                deflateData = compressor.compress(blockText) + compressor.flush()
+
+                bgzfFile.write('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff' + struct.pack('<H', 6) + 'BC' + struct.pack('<HH', 2, 25 + len(deflateData)))
+                bgzfFile.write(deflateData + struct.pack('<II', zlib.crc32(blockText) & 0xffffffff, len(blockText)))
+
+        return bgzfFileName
+
+    #a gzip file of two members, as from concatenating gzip files
+    def writeMultiMemberGzip(self, fileName, text):
+        gzipFileName = os.path.join(self.directory, fileName)
+        for memberText in [text[:len(text) // 3], text[len(text) // 3:]]:
+            with gzip.GzipFile(gzipFileName, 'ab') as gzipFile:
+                gzipFile.write(memberText)
+
+        return gzipFileName
+
+    def getBackends(self, isBgzf):
+        return ['gzip', 'zlib'] + (['bgzf'] if isBgzf else []) + (['pigz'] if distutils.spawn.find_executable('pigz') is not None else [])
+
+    #every backend gives the file's exact text, and auto picks bgzf for blocked gzip files
+    def testBackendsGiveSameText(self):
+        fastqText = self.readFile(self.writeFastq('reads.fastq', self.makeReads(1000)))
+        gzipFileNames = [(self.writeMultiMemberGzip('reads.fastq.gz', fastqText), False), (self.writeBgzf('reads_bgzf.fastq.gz', fastqText), True)]
+
+        for gzipFileName, isBgzf in gzipFileNames:
+            self.assertEqual(fastqgz_to_counts.isBgzfFile(gzipFileName), isBgzf)
+
+            for decompression in self.getBackends(isBgzf) + ['auto']:
+                infile, usedDecompression = fastqgz_to_counts.openSeqFile(gzipFileName, 'fqgz', decompression, 2)
+                with infile:
+                    self.assertEqual(infile.read(), fastqText)
+
+                if decompression != 'auto':
+                    self.assertEqual(usedDecompression, decompression)
+                elif isBgzf:
+                    self.assertEqual(usedDecompression, 'bgzf')
+                else:
+                    self.assertIn(usedDecompression, ['pigz', 'zlib'])
+
+    #counting with each backend gives the same counts and unaligned reads
+    def testBackendsGiveSameCounts(self):
+        fastqFileName = self.writeFastq('reads.fastq', self.makeReads(1000))
+        bgzfFileName = self.writeBgzf('reads.fastq.gz', self.readFile(fastqFileName))
+
+        serialResult = fastqgz_to_counts.seqFileToCounts(fastqFileName, fastqFileName + '_unaligned.fa', fastqFileName + '.counts',
+            self.libraryFasta, 1, 1 + readLength)
+        expectedOutput = (serialResult[:4], self.readFile(fastqFileName + '.counts'), self.readFile(fastqFileName + '_unaligned.fa'))
+
+        for decompression in self.getBackends(True):
+            result = fastqgz_to_counts.seqFileToCounts(bgzfFileName, bgzfFileName + '_unaligned.fa', bgzfFileName + '.counts',
+                self.libraryFasta, 1, 1 + readLength, decompression=decompression, decompressionThreads=2)
+
+            self.assertEqual(result[4], decompression)
+            self.assertEqual((result[:4], self.readFile(bgzfFileName + '.counts'), self.readFile(bgzfFileName + '_unaligned.fa')), expectedOutput)
+
+    def testBgzfRejectsOtherGzip(self):
+        gzipFileName = self.writeMultiMemberGzip('reads.fastq.gz', self.readFile(self.writeFastq('reads.fastq', self.makeReads(100))))
+
+        infile = fastqgz_to_counts.openSeqFile(gzipFileName, 'fqgz', 'bgzf', 2)[0]
+        with infile:
+            self.assertRaises(IOError, infile.read)
+
+
+class BlockParsingTest(CountingTest):
+    #trimmed sequences as found by iterating over every line of the file, as seqFileToCounts once read them
+    def iterateLines(self, fileName, linesPerRead):
+        with open(fileName) as infile:
+            return [line.strip()[1:1 + readLength] for i, line in enumerate(infile) if i % linesPerRead == 1]
+
+    def readBlockSeqs(self, fileName, linesPerRead, blockSize):
+        with open(fileName) as infile:
+            return sum(fastqgz_to_counts.readSeqBatches(infile, linesPerRead, 1, 1 + readLength, blockSize=blockSize), [])
+
+    #reads from blocks of any size, of fastq files with unix or windows line endings and of fasta files, are those of
+    #iterating over the lines
+    def testSeqsMatchLineIteration(self):
+        reads = self.makeReads(500)
+        fastqFileName = self.writeFastq('reads.fastq', reads)
+
+        windowsFileName = os.path.join(self.directory, 'reads_windows.fastq')
+        with open(windowsFileName, 'wb') as windowsFile:
+            windowsFile.write(self.readFile(fastqFileName).replace('\n', '\r\n'))
+
+        fastaFileName = os.path.join(self.directory, 'reads.fa')
+        with open(fastaFileName, 'w') as fastaFile:
+            fastaFile.write(''.join(['>read_%d\n%s\n' % tup for tup in enumerate(reads)]))
+
+        for fileName, linesPerRead in [(fastqFileName, 4), (windowsFileName, 4), (fastaFileName, 2)]:
+            expectedSeqs = self.iterateLines(fileName, linesPerRead)
+            self.assertEqual(expectedSeqs, [read[1:1 + readLength] for read in reads])
+
+            for blockSize in [7, 100, 1000, 10**6]:
+                self.assertEqual(self.readBlockSeqs(fileName, linesPerRead, blockSize), expectedSeqs)
+
+    #reading stops after maxBytes, as at the end of a shard
+    def testMaxBytes(self):
+        reads = self.makeReads(100)
+        fastqFileName = self.writeFastq('reads.fastq', reads)
+        shardBytes = len(''.join(self.readFile(fastqFileName).splitlines(True)[:30 * 4]))
+
+        with open(fastqFileName) as fastqFile:
+            recordBlocks = list(fastqgz_to_counts.readRecordBlocks(fastqFile, 4, blockSize=50, maxBytes=shardBytes))
+
+        self.assertEqual(sum([fastqgz_to_counts.getBlockSeqs(recordBlock, 4) for recordBlock in recordBlocks], []), reads[:30])
+
+
+class DemuxTest(CountingTest):
+    #sample1 has two index sequences; AAAG is one substitution from both AAAA and AAAC, so it is left undetermined
+    sampleSheetText = 'index\tsample\nAAAA\tsample1\nCCCC\tsample1\n#a comment\nAAAC\tsample2\n'
+    barcodeSamples = [('AAAA', 0), ('CCCC', 0), ('AAAC', 1), ('ACCC', 0), ('AAAT', None), ('AAAG', None), ('TTTT', None)]
+
+    def setUp(self):
+        CountingTest.setUp(self)
+        self.sampleSheetName = os.path.join(self.directory, 'samples.txt')
+        with open(self.sampleSheetName, 'w') as sampleSheetFile:
+            sampleSheetFile.write(self.sampleSheetText)
+
+    def writeDemuxFiles(self, fileName, reads, barcodes):
+        fastqFileName = os.path.join(self.directory, fileName)
+        with open(fastqFileName, 'w') as fastqFile:
+            for i, (read, barcode) in enumerate(zip(reads, barcodes)):
+                fastqFile.write('@read_%d 1:N:0:%sTT\n%s\n+\n%s\n' % (i, barcode, read, 'I' * len(read)))
+
+        indexFileName = os.path.join(self.directory, 'index_' + fileName)
+        with open(indexFileName, 'w') as indexFile:
+            for i, barcode in enumerate(barcodes):
+                indexFile.write('@read_%d 2:N:0:\n%sTT\n+\n%s\n' % (i, barcode, 'I' * (len(barcode) + 2)))
+
+        return fastqFileName, indexFileName
+
+    #with barcodeMismatches of 1, index sequences one substitution from a single sample are added; AAAT is one from
+    #both samples
+    def testSampleSheet(self):
+        sampleSheet = fastqgz_to_counts.parseSampleSheet(self.sampleSheetName)
+        self.assertEqual(sampleSheet.sampleNames, ['sample1', 'sample2'])
+        self.assertEqual(sampleSheet.barcodeLength, 4)
+        self.assertEqual(sampleSheet.barcodeToSample, {'AAAA':0, 'CCCC':0, 'AAAC':1})
+
+        sampleSheet = fastqgz_to_counts.parseSampleSheet(self.sampleSheetName, 1)
+        for barcode, sampleNum in self.barcodeSamples:
+            self.assertEqual(sampleSheet.barcodeToSample.get(barcode), sampleNum)
+
+    #a sample named as the undetermined reads would have its counts file overwritten by theirs
+    def testUndeterminedSampleNameRejected(self):
+        for sampleName in ['Undetermined', 'undetermined']:
+            with open(self.sampleSheetName, 'w') as sampleSheetFile:
+                sampleSheetFile.write(self.sampleSheetText + 'GGGG\t%s\n' % sampleName)
+
+            self.assertRaises(ValueError, fastqgz_to_counts.parseSampleSheet, self.sampleSheetName)
+
+    #demultiplexed counts of each sample, and of undetermined reads, match counting the reads of that sample alone,
+    #with index sequences from the read headers or from index read files
+    def testDemuxCountsMatchSampleFiles(self):
+        fastqgz_to_counts.recordBlockSize = 2000
+        reads = self.makeReads(1400)
+        barcodeSamples = [self.barcodeSamples[i] for i in self.randomState.randint(len(self.barcodeSamples), size=len(reads))]
+        sampleSheet = fastqgz_to_counts.parseSampleSheet(self.sampleSheetName, 1)
+
+        barcodes = [barcode for barcode, sampleNum in barcodeSamples]
+        fileNames = [self.writeDemuxFiles('reads_%d.fastq' % i, reads[i * 700:(i + 1) * 700], barcodes[i * 700:(i + 1) * 700]) for i in range(2)]
+
+        expectedOutputs = []
+        for sampleNum in [0, 1, None]:
+            sampleReads = [read for read, (barcode, readSample) in zip(reads, barcodeSamples) if readSample == sampleNum]
+            sampleFileName = self.writeFastq('sample_%s.fastq' % sampleNum, sampleReads)
+            result = fastqgz_to_counts.seqFileToCounts(sampleFileName, sampleFileName + '_unaligned.fa', sampleFileName + '.counts',
+                self.libraryFasta, 1, 1 + readLength)
+            expectedOutputs.append((result[:3], self.readFile(sampleFileName + '.counts')))
+
+        self.assertGreater(min(result[0][0] for result in expectedOutputs), 100)
+
+        processPool = multiprocessing.Pool(2)
+        try:
+            for useIndexFiles in [False, True]:
+                countFileNames = [os.path.join(self.directory, '%s_%s.counts' % (sampleName, useIndexFiles)) for sampleName in sampleSheet.sampleNames + ['undetermined']]
+                fileResults, sampleResults = fastqgz_to_counts.parallelDemuxSeqFileToCounts([fastqFileName for fastqFileName, indexFileName in fileNames],
+                    [indexFileName if useIndexFiles else None for fastqFileName, indexFileName in fileNames], 
+                    [fastqFileName + '_unaligned.fa' for fastqFileName, indexFileName in fileNames], countFileNames, processPool,
+                    self.libraryFasta, sampleSheet, 1, 1 + readLength)
+
+                self.assertEqual([fileResult[0] for fastqFileName, fileResult in fileResults], [700, 700])
+                self.assertEqual([(sampleResult, self.readFile(countFileName)) for countFileName, sampleResult in sampleResults], expectedOutputs)
+        finally:
+            processPool.terminate()
+            processPool.join()
+
+
+class MetricsTest(CountingTest):
+    def countFile(self, fastqFileName, processPool):
+        if processPool is None:
+            return fastqgz_to_counts.seqFileToCounts(fastqFileName, fastqFileName + '_unaligned.fa', fastqFileName + '.counts',
+                self.libraryFasta, 1, 1 + readLength)
+        else:
+            return fastqgz_to_counts.shardedSeqFileToCounts(fastqFileName, fastqFileName + '_unaligned.fa', fastqFileName + '.counts', processPool, 3,
+                self.libraryFasta, 1, 1 + readLength)
+
+    #the reads and uncompressed bytes in the metrics summary are those of the whole file, whether it is counted whole or
+    #in shards, and each stage has a time
+    def testSummaryTotals(self):
+        fastqgz_to_counts.recordBlockSize = 2000
+        reads = self.makeReads(1000)
+        fastqFileNames = [self.writeFastq('reads.fastq', reads), self.writeFastq('reads.fastq.gz', reads, compressed=True)]
+        fileBytes = len(self.readFile(fastqFileNames[0]))
+
+        processPool = multiprocessing.Pool(3)
+        try:
+            for fastqFileName in fastqFileNames:
+                for pool in [None, processPool]:
+                    metricsSummary = self.countFile(fastqFileName, pool)[5]
+
+                    self.assertEqual(metricsSummary['reads'], 1000)
+                    self.assertEqual(metricsSummary['bytes'], fileBytes)
+                    self.assertEqual(list(metricsSummary['stage_seconds']), fastqgz_to_counts.metricsStages)
+                    self.assertTrue(all(seconds >= 0 for seconds in metricsSummary['stage_seconds'].values()))
+                    self.assertGreater(metricsSummary['reads_per_second'], 0)
+        finally:
+            processPool.terminate()
+            processPool.join()
+
+    #summaries are written as json, and the stage breakdown names every stage
+    def testMetricsFile(self):
+        metricsSummary = self.countFile(self.writeFastq('reads.fastq', self.makeReads(100)), None)[5]
+
+        metricsFileName = os.path.join(self.directory, fastqgz_to_counts.metricsFileName)
+        fastqgz_to_counts.writeMetricsFile(metricsFileName, collections.OrderedDict([('files', [metricsSummary])]))
+        with open(metricsFileName) as metricsFile:
+            self.assertEqual(json.load(metricsFile), json.loads(json.dumps({'files':[metricsSummary]})))
+
+        stageString = fastqgz_to_counts.getStageString(metricsSummary)
+        self.assertEqual([stagePercent.split(' ')[0] for stagePercent in stageString.split(', ')], fastqgz_to_counts.metricsStages)
+
+    #with a progress interval set, throughput and the fraction of the file done are printed while counting
+    def testProgressPrinted(self):
+        fastqgz_to_counts.recordBlockSize = 2000
+        fastqgz_to_counts.progressInterval = 1e-9
+        fastqFileName = self.writeFastq('reads.fastq', self.makeReads(1000))
+
+        savedStdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            self.countFile(fastqFileName, None)
+            progressLines = [line for line in sys.stdout.getvalue().split('\n') if 'reads/s' in line]
+        finally:
+            sys.stdout = savedStdout
+
+        self.assertGreater(len(progressLines), 5)
+        self.assertTrue(all(line.startswith(fastqFileName + ':') for line in progressLines))
+        self.assertIn('100.0% done', progressLines[-1])
+
+
+class TrimDetectionTest(CountingTest):
+    #library sequences one base into the reads are found, with the fraction of reads they are found in
+    def testDetectsOffset(self):
+        fastqFileName = self.writeFastq('reads.fastq.gz', self.makeReads(1000), compressed=True)
+
+        self.assertEqual(fastqgz_to_counts.detectTrim(fastqFileName, self.libraryFasta), (1, 1 + readLength, [], 0.8))
+        self.assertEqual(fastqgz_to_counts.detectTrim(fastqFileName, self.libraryFasta, numReads=6)[3], 4 / 6.0)
+
+    #reads with the library sequence at a second offset give that offset as a stagger start, and counting with it finds
+    #the same library sequences as counting reads all at the first offset
+    def testStaggeredReads(self):
+        reads = self.makeReads(1000)
+        staggeredReads = [read[0] + 'A' + read[1:-1] if i % 3 == 0 else read for i, read in enumerate(reads)]
+        fastqFileName = self.writeFastq('reads.fastq', reads)
+        staggeredFileName = self.writeFastq('staggered.fastq', staggeredReads)
+
+        startIndex, stopIndex, staggerStarts, fraction = fastqgz_to_counts.detectTrim(staggeredFileName, self.libraryFasta)
+        self.assertEqual((startIndex, stopIndex, staggerStarts), (1, 1 + readLength, [2]))
+
+        for fileName, fileStaggerStarts in [(fastqFileName, None), (staggeredFileName, staggerStarts)]:
+            result = fastqgz_to_counts.seqFileToCounts(fileName, fileName + '_unaligned.fa', fileName + '.counts',
+                self.libraryFasta, startIndex, stopIndex, staggerStarts=fileStaggerStarts)
+            self.assertEqual(result[1], 800)
+
+        self.assertEqual(self.readFile(staggeredFileName + '.counts'), self.readFile(fastqFileName + '.counts'))
+
+    def testNoMatchingTrim(self):
+        fastqFileName = self.writeFastq('reads.fastq', [read for i, read in enumerate(self.makeReads(100)) if i % 5 == 0])
+        self.assertRaises(ValueError, fastqgz_to_counts.detectTrim, fastqFileName, self.libraryFasta)
+
+
+if __name__ == '__main__':
+    unittest.main()
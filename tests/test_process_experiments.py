@@ -0,0 +1,592 @@
+# Regression tests for phenotype scoring in process_experiments.py
+#
+# data/demo_mergedcountstable.txt holds merged counts of the Demo sequencing files, counted against a library of their
+# 3000 most frequent read sequences (the first 300 as negative controls, genes in data/demo_librarygenes.txt);
+# data/demo_phenotypescores_baseline.txt.gz holds the phenotype scores of the row-by-row filterLowCounts and
+# computePhenotypeScore for each pseudocount behavior and filter type, with minimum_reads = 1 and pseudocount = 0.1
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import process_experiments
+import fastqgz_to_counts
+import screen_analysis
+
+dataDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+baselineComparisons = [('gamma', 'T0', 'untreated', replicate, 5.0) for replicate in ['Rep1', 'Rep2']] + \
+    [('rho', 'untreated', 'treated', replicate, 3.0) for replicate in ['Rep1', 'Rep2']]
+baselineMinimumReads = 1
+baselinePseudocount = 0.1
+
+
+class PhenotypeScoreTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.countsTable = pd.read_csv(os.path.join(dataDirectory, 'demo_mergedcountstable.txt'), sep='\t', header=range(2), index_col=0)
+        cls.libraryTable = pd.read_csv(os.path.join(dataDirectory, 'demo_librarygenes.txt'), sep='\t', header=0, index_col=0)
+        cls.baselineTable = pd.read_csv(os.path.join(dataDirectory, 'demo_phenotypescores_baseline.txt.gz'), sep='\t', header=range(4),
+            index_col=0, compression='gzip', float_precision='round_trip')
+
+    #scores of one comparison from filterLowCounts and computePhenotypeScore, as processExperimentsFromConfig once computed them
+    def scoreComparison(self, comparison, filterType, pseudocountBehavior, pseudocount, minimumReads=baselineMinimumReads):
+        phenotype, condition1, condition2, replicate, growthValue = comparison
+        filteredCounts = process_experiments.filterLowCounts(pd.concat([self.countsTable[(condition1, replicate)],
+            self.countsTable[(condition2, replicate)]], axis=1), filterType, minimumReads)
+
+        return process_experiments.computePhenotypeScore(filteredCounts.iloc[:,0], filteredCounts.iloc[:,1], self.libraryTable,
+            growthValue, pseudocountBehavior, pseudocount)
+
+    def assertScoresEqual(self, scores, expectedScores):
+        scores, expectedScores = np.asarray(scores, dtype=float), np.asarray(expectedScores, dtype=float)
+        self.assertTrue(np.array_equal(np.isnan(scores), np.isnan(expectedScores)))
+        self.assertTrue(np.array_equal(scores[~np.isnan(scores)], expectedScores[~np.isnan(expectedScores)]))
+
+    def testScoresMatchBaseline(self):
+        for pseudocountBehavior, baselineBehavior in [('default', 'default'), ('zeros only', 'default'), ('all values', 'all values'), ('filter out', 'filter out')]:
+            for filterType in ['both', 'either']:
+                for comparison in baselineComparisons:
+                    expectedScores = self.baselineTable[(baselineBehavior, filterType, comparison[0], comparison[3])]
+                    scores = self.scoreComparison(comparison, filterType, pseudocountBehavior, baselinePseudocount)
+
+                    self.assertTrue(scores.index.equals(expectedScores.index))
+                    self.assertScoresEqual(scores.values, expectedScores.values)
+
+    #the batched scores of computePhenotypeScoreTable equal those of each comparison scored alone, whether the comparisons
+    #are scored together or one at a time, with fractional and whole pseudocounts
+    def testScoreTableMatchesComparisonScores(self):
+        for pseudocountBehavior in ['default', 'zeros only', 'all values', 'filter out']:
+            for filterType in ['both', 'either']:
+                for pseudocount in [baselinePseudocount, 1]:
+                    for comparisonList in [baselineComparisons] + [[comparison] for comparison in baselineComparisons]:
+                        scoreTable = process_experiments.computePhenotypeScoreTable(self.countsTable, comparisonList, self.libraryTable,
+                            filterType, baselineMinimumReads, pseudocountBehavior, pseudocount)
+
+                        for comparison in comparisonList:
+                            self.assertScoresEqual(scoreTable[(comparison[0], comparison[3])].values,
+                                self.scoreComparison(comparison, filterType, pseudocountBehavior, pseudocount).values)
+
+    #the baseline covers rows filtered to nan by minimum_reads and by the filter out pseudocount behavior
+    def testBaselineHasFilteredRows(self):
+        for pseudocountBehavior in ['default', 'all values', 'filter out']:
+            for filterType in ['both', 'either']:
+                self.assertTrue(self.baselineTable[pseudocountBehavior][filterType].isnull().any().all())
+
+        self.assertTrue((self.baselineTable['filter out']['either'].isnull().sum() > self.baselineTable['default']['either'].isnull().sum()).all())
+
+
+class CountsLoadingTest(unittest.TestCase):
+    def setUp(self):
+        self.countsDirectory = tempfile.mkdtemp()
+        self.libraryIndex = pd.Index(['sg_a', 'sg_b', 'sg_c', 'sg_d'], name='sgId')
+
+    def tearDown(self):
+        shutil.rmtree(self.countsDirectory)
+
+    def writeCountsFile(self, fileName, idList):
+        countsFileName = os.path.join(self.countsDirectory, fileName)
+        with open(countsFileName, 'w') as countsFile:
+            for i, elementId in enumerate(idList):
+                countsFile.write('%s\t%d\n' % (elementId, 10 * i + 1))
+
+        return countsFileName
+
+    #counts read and aligned to the library one file at a time, as processExperimentsFromConfig once loaded them
+    def alignCountsFiles(self, countsFileTuples):
+        libraryColumn = pd.Series(True, index=self.libraryIndex)
+        columnDict = dict()
+        for tup in countsFileTuples:
+            countSeries = process_experiments.readCountsFile(tup[2]).reset_index().drop_duplicates('id').set_index('id')
+            columnDict[tup] = libraryColumn.align(countSeries, axis=0, join='left', fill_value=0)[1]['counts']
+
+        return pd.DataFrame(columnDict)
+
+    def assertCountsMatchAligned(self, countsFileTuples):
+        countsTable = process_experiments.loadCountsTable(countsFileTuples, self.libraryIndex)
+        alignedTable = self.alignCountsFiles(countsFileTuples)
+
+        self.assertEqual(countsTable.index.name, alignedTable.index.name)
+        self.assertTrue(countsTable.index.equals(alignedTable.index))
+        self.assertTrue(np.array_equal(countsTable[alignedTable.columns].values, alignedTable.values))
+
+    #the index is named 'id' by the counts files when their ids are exactly the library's, even with repeated ids
+    def testIndexNamedByMatchingCountsFiles(self):
+        countsFileTuples = [('T0', 'Rep1', self.writeCountsFile('exact.counts', self.libraryIndex)),
+            ('T0', 'Rep2', self.writeCountsFile('repeated.counts', ['sg_a', 'sg_b', 'sg_b', 'sg_c', 'sg_d']))]
+
+        self.assertCountsMatchAligned(countsFileTuples)
+        self.assertEqual(process_experiments.loadCountsTable(countsFileTuples, self.libraryIndex).index.name, 'id')
+
+    def testIndexNamedByLibrary(self):
+        self.assertCountsMatchAligned([('T0', 'Rep1', self.writeCountsFile('reordered.counts', ['sg_b', 'sg_a', 'sg_c', 'sg_d'])),
+            ('T0', 'Rep2', self.writeCountsFile('partial.counts', ['sg_a', 'sg_c', 'sg_e']))])
+
+    def testIndexUnnamedForMixedCountsFiles(self):
+        self.assertCountsMatchAligned([('T0', 'Rep1', self.writeCountsFile('exact.counts', self.libraryIndex)),
+            ('T0', 'Rep2', self.writeCountsFile('partial.counts', ['sg_a', 'sg_c', 'sg_e']))])
+
+    #counts array files of the library's own ids name the index as their text counts files do
+    def testCountsArrayFileOfLibrary(self):
+        countsFileName = os.path.join(self.countsDirectory, 'exact.counts')
+        fastqgz_to_counts.writeCountsArrayFile(countsFileName + fastqgz_to_counts.countsArrayExtension, list(self.libraryIndex), [5, 0, 3, 1])
+
+        countsTable = process_experiments.loadCountsTable([('T0', 'Rep1', countsFileName)], self.libraryIndex)
+
+        self.assertEqual(countsTable.index.name, 'id')
+        self.assertEqual(countsTable.iloc[:,0].tolist(), [5, 0, 3, 1])
+
+    #counts array files of other ids, and of other ids in another order, load as their text counts files do; an array
+    #older than its text file is not read
+    def testCountsArrayFileOfOtherIds(self):
+        for fileName, idList in [('reordered.counts', ['sg_b', 'sg_a', 'sg_c', 'sg_d']), ('partial.counts', ['sg_a', 'sg_c', 'sg_e'])]:
+            textFileName = self.writeCountsFile(fileName, idList)
+            arrayFileName = os.path.join(self.countsDirectory, 'array_' + fileName)
+            fastqgz_to_counts.writeCountsArrayFile(arrayFileName + fastqgz_to_counts.countsArrayExtension, idList, [10 * i + 1 for i in range(len(idList))])
+
+            countsTable = process_experiments.loadCountsTable([('T0', 'Rep1', textFileName), ('T0', 'Rep2', arrayFileName)], self.libraryIndex)
+            self.assertTrue(np.array_equal(countsTable.iloc[:,0].values, countsTable.iloc[:,1].values))
+            self.assertTrue(np.array_equal(countsTable.values, self.alignCountsFiles([('T0', 'Rep1', textFileName)]).values[:,[0,0]]))
+
+        staleFileName = self.writeCountsFile('stale.counts', self.libraryIndex)
+        fastqgz_to_counts.writeCountsArrayFile(staleFileName + fastqgz_to_counts.countsArrayExtension, list(self.libraryIndex), [0, 0, 0, 0])
+        os.utime(staleFileName + fastqgz_to_counts.countsArrayExtension, (1000000000, 1000000000))
+
+        self.assertEqual(process_experiments.loadCountsTable([('T0', 'Rep1', staleFileName)], self.libraryIndex).iloc[:,0].tolist(), [1, 11, 21, 31])
+
+    #counts beyond the int32 range are kept whole, from text and array files
+    def testLargeCounts(self):
+        largeCounts = [2**31 + 5, 0, 2**33, 1]
+        textFileName = os.path.join(self.countsDirectory, 'large.counts')
+        with open(textFileName, 'w') as countsFile:
+            countsFile.write(''.join(['%s\t%d\n' % tup for tup in zip(self.libraryIndex, largeCounts)]))
+
+        arrayFileName = os.path.join(self.countsDirectory, 'large_array.counts')
+        fastqgz_to_counts.writeCountsArrayFile(arrayFileName + fastqgz_to_counts.countsArrayExtension, list(self.libraryIndex), largeCounts)
+
+        countsTable = process_experiments.loadCountsTable([('T0', 'Rep1', textFileName), ('T0', 'Rep2', arrayFileName)], self.libraryIndex)
+
+        self.assertEqual(countsTable.iloc[:,0].tolist(), largeCounts)
+        self.assertEqual(countsTable.iloc[:,1].tolist(), largeCounts)
+
+
+class GeneScoringTest(unittest.TestCase):
+    #a library of genes with one to four transcripts of one to six sgRNAs, and phenotypes rounded so that values tie, with
+    #nans now and then and one gene whose phenotypes are all nan
+    def setUp(self):
+        self.randomState = np.random.RandomState(0)
+
+        libraryRows = [('sg_neg_%d' % i, 'negative_control', 'na') for i in range(200)]
+        for gene in range(40):
+            for transcript in range(self.randomState.randint(1, 5)):
+                libraryRows.extend(('sg_%d_%d_%d' % (gene, transcript, i), 'gene_%02d' % gene, 'P%d' % transcript)
+                    for i in range(self.randomState.randint(1, 7)))
+
+        self.libraryTable = pd.DataFrame([row[1:] for row in libraryRows], index=[row[0] for row in libraryRows], columns=['gene','transcripts'])
+        self.libraryTable['sequence'] = ['seq_%d' % i for i in range(len(libraryRows))]
+        self.libraryView = screen_analysis.LibraryView(self.libraryTable)
+
+        phenotypes = np.round(self.randomState.normal(0, 1, (len(libraryRows), 3)), 1)
+        phenotypes[self.randomState.uniform(size=phenotypes.shape) < 0.1] = np.nan
+        phenotypes[self.libraryTable['gene'].values == 'gene_00'] = np.nan
+        self.phenotypeTable = pd.DataFrame(phenotypes, index=self.libraryTable.index, columns=[('gamma','Rep1'), ('gamma','Rep2'), ('rho','Rep1')])
+
+        self.negativeTable = self.phenotypeTable.loc[self.libraryView.negativeMask]
+        self.genePhenotypeTable = self.phenotypeTable.loc[~self.libraryView.negativeMask]
+
+    #the baseline pandas grouping by gene or by gene and transcript, and the scores of groupby apply
+    def groupbyGene(self, byTranscript):
+        groupKeys = ['gene','transcripts'] if byTranscript else 'gene'
+        return self.genePhenotypeTable.groupby([self.libraryTable.loc[self.genePhenotypeTable.index, key] for key in groupKeys]
+            if byTranscript else self.libraryTable.loc[self.genePhenotypeTable.index, groupKeys])
+
+    def applyByGene(self, byTranscript, scoreFunction, *args):
+        return self.groupbyGene(byTranscript).apply(scoreFunction, *args)
+
+    def assertTablesEqual(self, table, expectedTable):
+        self.assertTrue(table.index.equals(expectedTable.index))
+        self.assertTrue(np.array_equal(np.isnan(table.values), np.isnan(expectedTable.values)))
+        self.assertTrue(np.allclose(table.values[~np.isnan(table.values)], expectedTable.values[~np.isnan(expectedTable.values)], rtol=1e-12, atol=0))
+
+    #groups, means and counts match a pandas groupby on gene names, or gene and transcript names; rows missing from the
+    #library are in no group
+    def testGeneGroupsMatchGroupby(self):
+        extraTable = pd.DataFrame([[1.0, 2.0, 3.0]], index=['sg_not_in_library'], columns=self.genePhenotypeTable.columns)
+
+        for byTranscript in [False, True]:
+            geneGroups = process_experiments.groupByGene(self.genePhenotypeTable.append(extraTable), self.libraryView, byTranscript)
+            groupedPhenotypeTable = self.groupbyGene(byTranscript)
+
+            self.assertTablesEqual(geneGroups.mean(), groupedPhenotypeTable.mean())
+            self.assertTablesEqual(geneGroups.count().astype(float), groupedPhenotypeTable.count().astype(float))
+            self.assertEqual(geneGroups.groupCodes[-1], -1)
+
+            rowGenes = self.libraryTable.loc[self.genePhenotypeTable.index, 'gene'].values
+            groupGenes = self.libraryView.geneNames[geneGroups.groupGenes]
+            if byTranscript:
+                rowGroups = zip(rowGenes, self.libraryTable.loc[self.genePhenotypeTable.index, 'transcripts'].values)
+                self.assertTrue(np.array_equal(groupGenes, geneGroups.groupIndex.get_level_values('gene')))
+            else:
+                rowGroups = list(rowGenes)
+                self.assertTrue(np.array_equal(groupGenes, geneGroups.groupIndex))
+
+            self.assertEqual(list(geneGroups.groupIndex[geneGroups.groupCodes[:-1]]), rowGroups)
+
+            columns = list(self.genePhenotypeTable.columns[1:])
+            self.assertTablesEqual(geneGroups.select(columns).mean(), groupedPhenotypeTable.mean()[columns])
+
+    def testMannWhitneyMatchesApplyMW(self):
+        for byTranscript in [False, True]:
+            geneGroups = process_experiments.groupByGene(self.genePhenotypeTable, self.libraryView, byTranscript)
+            self.assertTablesEqual(process_experiments.groupedMannWhitney(geneGroups, self.negativeTable),
+                self.applyByGene(byTranscript, process_experiments.applyMW, self.negativeTable))
+
+    def testMannWhitneyMatchesScipy(self):
+        negValues = self.negativeTable.iloc[:,0].dropna().values
+        values = np.round(self.randomState.normal(0.5, 1, 30), 1)
+        groupCodes = np.repeat(np.arange(3), 10)
+
+        pvals = process_experiments.mannWhitneyByGroup(values, groupCodes, 4, negValues)
+
+        for group in range(3):
+            self.assertAlmostEqual(pvals[group], stats.mannwhitneyu(values[groupCodes == group], negValues, alternative='two-sided')[1], places=12)
+        self.assertTrue(np.isnan(pvals[3]))
+
+    #groups without values, as when every sgRNA of a column is filtered to nan, score nan instead of failing
+    def testMannWhitneyWithoutValues(self):
+        negValues = self.negativeTable.iloc[:,0].dropna().values
+
+        self.assertTrue(np.all(np.isnan(process_experiments.mannWhitneyByGroup(np.array([np.nan, np.nan]), np.array([0, 1]), 2, negValues))))
+        self.assertTrue(np.all(np.isnan(process_experiments.mannWhitneyByGroup(np.array([]), np.array([], dtype=int), 2, negValues))))
+
+        nanTable = self.genePhenotypeTable.copy()
+        nanTable.iloc[:,1] = np.nan
+        pvals = process_experiments.groupedMannWhitney(process_experiments.groupByGene(nanTable, self.libraryView, False), self.negativeTable)
+
+        self.assertTrue(pvals.iloc[:,1].isnull().all())
+        self.assertTrue(pvals.iloc[:,0].notnull().any())
+
+    #means of the strongest N match averageBestN through groupby apply, including ties in magnitude, groups smaller than
+    #N and groups of only nans, and counts match count()
+    def testAverageBestNMatchesApply(self):
+        for byTranscript in [False, True]:
+            geneGroups = process_experiments.groupByGene(self.genePhenotypeTable, self.libraryView, byTranscript)
+            expectedCounts = self.groupbyGene(byTranscript).count()
+
+            for numToAverage in [1, 2, 3, 10]:
+                means, counts = process_experiments.groupedAverageBestN(geneGroups, numToAverage)
+
+                self.assertTablesEqual(means, self.applyByGene(byTranscript, process_experiments.averageBestN, numToAverage))
+                self.assertTablesEqual(counts.astype(float), expectedCounts.astype(float))
+
+    #nth best scores match the calculate_nth aggregation over groupby, where nans are sorted along with the values
+    def testNthBestMatchesAggregate(self):
+        for byTranscript in [False, True]:
+            geneGroups = process_experiments.groupByGene(self.genePhenotypeTable, self.libraryView, byTranscript)
+            groupedPhenotypeTable = self.groupbyGene(byTranscript)
+
+            for nth in [1, 2, 3, 7]:
+                nthScores, counts = process_experiments.groupedNthBest(geneGroups, nth)
+                expectedScores = groupedPhenotypeTable.aggregate(lambda x: sorted(x, key=abs, reverse=True)[nth-1] if nth <= len(x) else np.nan)
+
+                self.assertTablesEqual(nthScores, expectedScores)
+                self.assertTablesEqual(counts.astype(float), groupedPhenotypeTable.count().astype(float))
+
+    #the baseline pseudogenes, drawn one pseudogene (or transcript) at a time
+    def pseudogenesByLoop(self, libraryTable, pseudogeneDist, numPseudogenes, pseudogeneSize, randomState):
+        pseudoLibTables = []
+        sourceList = []
+
+        if pseudogeneDist == 'manual':
+            for pseudogene in range(numPseudogenes):
+                randIndices = randomState.randint(0, len(self.negativeTable), pseudogeneSize)
+                pseudoIndex = ['pseudo_%d_%d' % (pseudogene,i) for i in range(pseudogeneSize)]
+                pseudoSeqs = ['seq_%d_%d' % (pseudogene,i) for i in range(pseudogeneSize)]
+                sourceList.append(pd.Series(self.negativeTable.index[randIndices], index=pseudoIndex))
+                pseudoLibTables.append(pd.DataFrame({'gene':['pseudo_%d'%pseudogene]*pseudogeneSize,
+                    'transcripts':['na']*pseudogeneSize,
+                    'sequence':pseudoSeqs},index=pseudoIndex))
+        else:
+            for pseudogene, (gene, group) in enumerate(libraryTable.drop_duplicates(['gene','sequence']).groupby('gene')):
+                if gene == 'negative_control':
+                    continue
+                for transcript, (transcriptName, transcriptGroup) in enumerate(group.groupby('transcripts')):
+                    randIndices = randomState.randint(0, len(self.negativeTable), len(transcriptGroup))
+                    pseudoIndex = ['pseudo_%d_%d_%d' % (pseudogene, transcript, i) for i in range(len(transcriptGroup))]
+                    pseudoSeqs = ['seq_%d_%d_%d' % (pseudogene, transcript, i) for i in range(len(transcriptGroup))]
+                    sourceList.append(pd.Series(self.negativeTable.index[randIndices], index=pseudoIndex))
+                    pseudoLibTables.append(pd.DataFrame({'gene':['pseudo_%d'%pseudogene]*len(transcriptGroup),
+                        'transcripts':['pseudo_transcript_%d'%transcript]*len(transcriptGroup),
+                        'sequence':pseudoSeqs},index=pseudoIndex))
+
+        return pd.concat(pseudoLibTables), pd.concat(sourceList)
+
+    #pseudogenes of both distributions have the index, columns and negative controls of the baseline loop drawn from the
+    #same random state; the library has a gene sorted after negative_control and an sgRNA repeated under a second id
+    def testPseudogenesMatchLoop(self):
+        firstRow = self.libraryTable.loc[self.libraryTable['gene'] == 'gene_01'].iloc[0]
+        extraRows = [[firstRow['gene'], firstRow['transcripts'], firstRow['sequence']], ['zeta', 'P0', 'seq_zeta']]
+        libraryTable = self.libraryTable.append(pd.DataFrame(extraRows, index=['sg_repeated', 'sg_zeta'], columns=self.libraryTable.columns))
+
+        for pseudogeneDist, numPseudogenes, pseudogeneSize in [('manual', 30, 4), ('auto', None, None)]:
+            pseudoLib, pseudoSources = process_experiments.generatePseudogenes(self.negativeTable, libraryTable, pseudogeneDist, numPseudogenes, pseudogeneSize, 
+                np.random.RandomState(5))
+            expectedLib, expectedSources = self.pseudogenesByLoop(libraryTable, pseudogeneDist, numPseudogenes, pseudogeneSize, np.random.RandomState(5))
+
+            self.assertTrue(pseudoLib.index.equals(expectedLib.index))
+            for column in ['gene', 'transcripts', 'sequence']:
+                self.assertEqual(pseudoLib[column].tolist(), expectedLib[column].tolist())
+            self.assertTrue(pseudoSources.equals(expectedSources))
+
+        self.assertIn('pseudo_%d' % (len(libraryTable['gene'].unique()) - 1), pseudoLib['gene'].values)
+
+    #a seeded random state draws the same negative controls on every run
+    def testPseudogeneSeed(self):
+        def drawSources(seed):
+            return process_experiments.generatePseudogenes(self.negativeTable, self.libraryTable, 'auto', randomState=np.random.RandomState(seed))[1]
+
+        self.assertTrue(drawSources(5).equals(drawSources(5)))
+        self.assertFalse(drawSources(5).equals(drawSources(6)))
+
+    #the baseline collapse of transcript scores to the scores of each gene's transcript with the lowest p-value
+    def bestTranscriptByApply(self, geneTable):
+        def getBestTranscript(group):
+            return group.set_index('transcripts').drop(('gene',''),axis=1).idxmin()
+
+        geneTableTransGroups = geneTable.reorder_levels([2,0,1],axis=1)['Mann-Whitney p-value'].reset_index().groupby('gene')
+        bestTranscriptFrame = geneTableTransGroups.apply(getBestTranscript)
+
+        tupList = []
+        bestTransList = []
+        for tup, group in geneTable.groupby(level=range(2),axis=1):
+            tupList.append(tup)
+            curFrame = geneTable.loc[zip(bestTranscriptFrame.index,bestTranscriptFrame[tup]),tup]
+            bestTransList.append(curFrame.reset_index().set_index('gene'))
+
+        return pd.concat(bestTransList, axis=1, keys=tupList)
+
+    #transcript-level scores of the two analyses that collapse_to_transcripts needs, arranged as in the gene table
+    def scoreTranscripts(self, phenotypeTable):
+        phenotypeTable, negativeTable = phenotypeTable.copy(), self.negativeTable.copy()
+        phenotypeTable.columns = negativeTable.columns = pd.MultiIndex.from_tuples(list(phenotypeTable.columns))
+
+        geneGroups = process_experiments.groupByGene(phenotypeTable, self.libraryView, True)
+        analysisTables = [process_experiments.applyGeneScoreFunction(geneGroups, negativeTable, analysis, analysisParamList)
+            for analysis, analysisParamList in [('calculate_ave', [3]), ('calculate_mw', [])]]
+
+        return pd.concat(analysisTables, axis=1).reorder_levels([1,2,0],axis=1).sort_index(axis=1)
+
+    #the best transcript of each gene and its scores match the baseline, where every gene has a p-value in each column;
+    #p-values are rounded so that transcripts of a gene tie and the first of them is taken, and nan p-values are skipped
+    def testBestTranscriptMatchesApply(self):
+        geneTable = self.scoreTranscripts(self.genePhenotypeTable.loc[self.libraryTable.loc[self.genePhenotypeTable.index, 'gene'] != 'gene_00'])
+        pvalColumns = [column for column in geneTable.columns if column[2] == 'Mann-Whitney p-value']
+        geneTable[pvalColumns] = geneTable[pvalColumns].round(1)
+        self.assertTrue(geneTable[pvalColumns].groupby(level='gene').count().values.min() > 0)
+        self.assertTrue(geneTable[pvalColumns].isnull().any().any())
+        self.assertTrue(any(geneTable[column].dropna().groupby(level='gene').apply(lambda pvals: pvals.duplicated().any()).any() for column in pvalColumns))
+
+        collapsedTable = process_experiments.scoreGeneByBestTranscript(geneTable)
+        expectedTable = self.bestTranscriptByApply(geneTable)
+
+        self.assertEqual(list(collapsedTable.columns), list(expectedTable.columns))
+        self.assertTrue(collapsedTable.index.equals(expectedTable.index))
+        for column in collapsedTable.columns:
+            if column[2] == 'transcripts':
+                self.assertEqual(collapsedTable[column].tolist(), expectedTable[column].tolist())
+            else:
+                self.assertTablesEqual(collapsedTable[[column]].astype(float), expectedTable[[column]].astype(float))
+
+    #genes without a p-value in a column get a row of nans for that column
+    def testBestTranscriptWithoutPvalues(self):
+        collapsedTable = process_experiments.scoreGeneByBestTranscript(self.scoreTranscripts(self.genePhenotypeTable))
+
+        self.assertTrue(collapsedTable.loc['gene_00'].isnull().all())
+        self.assertFalse(collapsedTable.drop('gene_00').xs('Mann-Whitney p-value', axis=1, level=2).isnull().any().any())
+
+    #p-values are (k + 1)/(numDraws + 1) for k null scores at least as large, so they lie in [1/(numDraws + 1), 1] and do
+    #not increase with the magnitude of scores of the same group size; nan scores get nan p-values
+    def testEmpiricalPvalues(self):
+        numDraws = 500
+        negValues = self.negativeTable.iloc[:,0].dropna().values
+        scores = np.r_[np.linspace(-2, 2, 41), np.nan, np.linspace(-2, 2, 41)]
+        counts = np.r_[np.full(41, 3, dtype=int), 0, np.full(41, 6, dtype=int)]
+
+        pvals = process_experiments.empiricalPvalues(scores, counts, negValues, 2, numDraws, 0)
+
+        self.assertTrue(np.isnan(pvals[41]))
+        scoredPvals = pvals[~np.isnan(scores)]
+        self.assertTrue(np.all(scoredPvals >= 1.0 / (numDraws + 1)))
+        self.assertTrue(np.all(scoredPvals <= 1.0))
+        self.assertTrue(np.allclose(scoredPvals * (numDraws + 1), np.round(scoredPvals * (numDraws + 1))))
+
+        for sizeRows in [np.arange(41), np.arange(42, 83)]:
+            order = np.argsort(np.abs(scores[sizeRows]), kind='mergesort')
+            self.assertTrue(np.all(np.diff(pvals[sizeRows][order]) <= 0))
+
+        self.assertTrue(np.array_equal(scoredPvals, process_experiments.empiricalPvalues(scores, counts, negValues, 2, numDraws, 0)[~np.isnan(scores)]))
+
+    #FDRs equal the step-up minimum of p * n / rank over the non-nan p-values, capped at 1
+    def testBenjaminiHochberg(self):
+        pvals = self.randomState.uniform(0, 0.2, 50)
+        pvals[[3, 17, 30]] = np.nan
+        pvals[[5, 6]] = pvals[4]
+
+        fdrs = process_experiments.benjaminiHochberg(pvals)
+
+        isValid = ~np.isnan(pvals)
+        self.assertTrue(np.array_equal(np.isnan(fdrs), ~isValid))
+
+        validPvals, validFdrs = pvals[isValid], fdrs[isValid]
+        ranks = np.array([np.sum(validPvals <= pval) for pval in validPvals], dtype=float)
+        expectedFdrs = np.array([min(1.0, np.min(validPvals[validPvals >= pval] * len(validPvals) / ranks[validPvals >= pval])) for pval in validPvals])
+        self.assertTrue(np.allclose(validFdrs, expectedFdrs, rtol=1e-12, atol=0))
+
+        order = np.argsort(validPvals)
+        self.assertTrue(np.all(np.diff(validFdrs[order]) >= 0))
+        self.assertTrue(np.all(validFdrs >= validPvals))
+        self.assertTrue(np.all(validFdrs <= 1.0))
+        self.assertTrue(np.all(np.isnan(process_experiments.benjaminiHochberg(np.array([np.nan, np.nan])))))
+
+    #with a configured seed, each column's empirical scores are the same on every run and whichever columns are scored with it
+    def testEmpiricalSeeds(self):
+        geneGroups = process_experiments.groupByGene(self.genePhenotypeTable, self.libraryView, False)
+        columns = list(self.genePhenotypeTable.columns)
+        columnSeeds = [process_experiments.getEmpiricalSeed(7, column) for column in columns]
+
+        pvals, fdrs = process_experiments.groupedEmpiricalAverageBestN(geneGroups, self.negativeTable, 3, 200, columnSeeds=columnSeeds)
+        repeatedPvals = process_experiments.groupedEmpiricalAverageBestN(geneGroups, self.negativeTable, 3, 200, columnSeeds=columnSeeds)[0]
+        columnPvals = process_experiments.groupedEmpiricalAverageBestN(geneGroups.select(columns[1:2]), self.negativeTable, 3, 200, 
+            columnSeeds=columnSeeds[1:2])[0]
+
+        self.assertTrue(pvals.equals(repeatedPvals))
+        self.assertTrue(pvals[columns[1:2]].equals(columnPvals))
+        self.assertNotEqual(columnSeeds[0], columnSeeds[1])
+        self.assertNotEqual(columnSeeds[0], process_experiments.getEmpiricalSeed(8, columns[0]))
+
+
+class StageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cacheDirectory = tempfile.mkdtemp()
+        self.table = pd.DataFrame(np.arange(12, dtype=float).reshape(4, 3), index=pd.Index(['sg_a', 'sg_b', 'sg_c', 'sg_d'], name='sgId'), 
+            columns=pd.MultiIndex.from_tuples([('gamma','Rep1'), ('gamma','Rep2'), ('rho','Rep1')]))
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDirectory)
+
+    def assertTablesEqual(self, table, expectedTable):
+        self.assertTrue(table.index.equals(expectedTable.index))
+        self.assertEqual(list(table.columns), list(expectedTable.columns))
+        self.assertTrue(np.array_equal(table.values, expectedTable.values))
+
+    #a stage is loaded only with the key it was saved with, also by a later run, and not once the cache version changes
+    def testStageKeys(self):
+        stageCache = process_experiments.StageCache(self.cacheDirectory)
+        key = stageCache.makeKey('settings', 1)
+        self.assertIsNone(stageCache.load('phenotypes', key))
+
+        stageCache.save('phenotypes', key, self.table)
+        self.assertTablesEqual(stageCache.load('phenotypes', key), self.table)
+        self.assertIsNone(stageCache.load('phenotypes', stageCache.makeKey('settings', 2)))
+        self.assertIsNone(stageCache.load('counts', key))
+
+        self.assertTablesEqual(process_experiments.StageCache(self.cacheDirectory).load('phenotypes', key), self.table)
+
+        savedVersion = process_experiments.stageCacheVersion
+        process_experiments.stageCacheVersion = savedVersion + 1
+        try:
+            newVersionCache = process_experiments.StageCache(self.cacheDirectory)
+            self.assertIsNone(newVersionCache.load('phenotypes', key))
+            self.assertNotEqual(newVersionCache.makeKey('settings', 1), key)
+        finally:
+            process_experiments.stageCacheVersion = savedVersion
+
+    #cached columns are returned for the keys still in use, grouped by key, and a stage whose write was interrupted is
+    #not loaded
+    def testColumnKeys(self):
+        stageCache = process_experiments.StageCache(self.cacheDirectory)
+        stageCache.saveColumns('counts', self.table, ['key_a', 'key_b', 'key_a'])
+
+        cachedColumns = stageCache.loadColumns('counts', ['key_a', 'key_c'])
+        self.assertEqual(list(cachedColumns), ['key_a'])
+        self.assertTablesEqual(cachedColumns['key_a'], self.table.iloc[:,[0,2]])
+        self.assertEqual(stageCache.loadColumns('counts', ['key_c']), dict())
+
+        def failWrite(*args):
+            raise IOError('No space left on device')
+
+        savedWriteBinaryTable = screen_analysis.writeBinaryTable
+        screen_analysis.writeBinaryTable = failWrite
+        try:
+            self.assertRaises(IOError, stageCache.saveColumns, 'counts', self.table, ['key_d', 'key_e', 'key_f'])
+        finally:
+            screen_analysis.writeBinaryTable = savedWriteBinaryTable
+
+        self.assertEqual(process_experiments.StageCache(self.cacheDirectory).loadColumns('counts', ['key_a', 'key_d']), dict())
+
+    #file hashes change with the file's contents, and are reused while its size and modification time are unchanged
+    def testHashFile(self):
+        stageCache = process_experiments.StageCache(self.cacheDirectory)
+        fileName = os.path.join(self.cacheDirectory, 'counts.txt')
+        with open(fileName, 'w') as countsFile:
+            countsFile.write('sg_a\t1\n')
+        os.utime(fileName, (1000000000, 1000000000))
+
+        fileHash = stageCache.hashFile(fileName)
+        self.assertEqual(process_experiments.StageCache(self.cacheDirectory).hashFile(fileName), fileHash)
+
+        with open(fileName, 'w') as countsFile:
+            countsFile.write('sg_a\t2\n')
+        os.utime(fileName, (1000000000, 1000000000))
+        self.assertEqual(stageCache.hashFile(fileName), fileHash)
+
+        os.utime(fileName, (1000000001, 1000000001))
+        self.assertNotEqual(stageCache.hashFile(fileName), fileHash)
+
+    #plots are cached only while their key is unchanged and every figure file the stage drew is still there and indexed
+    def testPlotFiles(self):
+        stageCache = process_experiments.StageCache(self.cacheDirectory)
+        key = stageCache.makeKey('png', ['key_a'])
+        figureFiles = ['000_fig_volcano.png', '001_fig_volcano.png', '002_fig_volcano.png']
+        figureRegistry = screen_analysis.FigureRegistry(self.cacheDirectory)
+        for number, fileName in enumerate(figureFiles):
+            open(os.path.join(self.cacheDirectory, fileName), 'w').close()
+            if number < 2:
+                figureRegistry.recordFigure(number, fileName, 'volcano', None, 0)
+
+        stageCache.setPlots('phenotypes', key, figureFiles)
+        self.assertFalse(stageCache.hasPlots('phenotypes', key, self.cacheDirectory))
+        figureFiles = figureFiles[:2]
+
+        self.assertFalse(stageCache.hasPlots('genes', key, self.cacheDirectory))
+        stageCache.setPlots('genes', key, figureFiles)
+        self.assertTrue(process_experiments.StageCache(self.cacheDirectory).hasPlots('genes', key, self.cacheDirectory))
+        self.assertFalse(stageCache.hasPlots('genes', stageCache.makeKey('pdf', ['key_a']), self.cacheDirectory))
+
+        os.remove(os.path.join(self.cacheDirectory, figureFiles[1]))
+        self.assertFalse(stageCache.hasPlots('genes', key, self.cacheDirectory))
+
+    #without a cache directory nothing is stored or loaded
+    def testNoCacheDirectory(self):
+        stageCache = process_experiments.StageCache(None)
+        key = stageCache.makeKey('settings')
+
+        stageCache.save('phenotypes', key, self.table)
+        stageCache.saveColumns('counts', self.table, ['key_a', 'key_b', 'key_c'])
+        stageCache.setPlots('genes', key, ['fig.png'])
+
+        self.assertIsNone(stageCache.load('phenotypes', key))
+        self.assertEqual(stageCache.loadColumns('counts', ['key_a']), dict())
+        self.assertFalse(stageCache.hasPlots('genes', key, self.cacheDirectory))
+        self.assertIsNone(stageCache.hashFile(os.path.abspath(__file__)))
+
+
+if __name__ == '__main__':
+    unittest.main()
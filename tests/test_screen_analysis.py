@@ -0,0 +1,198 @@
+# Tests for figure saving and rendering, binary table formats and library views in screen_analysis.py
+
+import os
+import sys
+import shutil
+import types
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import screen_analysis
+
+
+class PlotDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.plotDirectory = tempfile.mkdtemp()
+        self.savedSettings = (screen_analysis.plotDirectory, screen_analysis.plotWithPylab, screen_analysis.figureRegistry)
+
+    def tearDown(self):
+        screen_analysis.plotDirectory, screen_analysis.plotWithPylab, screen_analysis.figureRegistry = self.savedSettings
+        shutil.rmtree(self.plotDirectory)
+
+    #setting the module's plotDirectory directly, without changeDisplayFigureSettings, numbers and indexes the figures
+    def testPlotDirectorySetDirectly(self):
+        screen_analysis.plotDirectory = self.plotDirectory
+        screen_analysis.plotWithPylab = False
+
+        fileNames = [screen_analysis.displayFigure(plt.figure(), 'test_plot', {'figure':i}) for i in range(2)]
+
+        self.assertEqual([os.path.basename(fileName) for fileName in fileNames], ['000_fig_test_plot.png', '001_fig_test_plot.png'])
+        self.assertTrue(all(os.path.exists(fileName) for fileName in fileNames))
+        self.assertEqual([entry['number'] for entry in screen_analysis.readFigureIndex(self.plotDirectory)], [0, 1])
+        self.assertEqual(len(screen_analysis.findFigures(self.plotDirectory, 'test_plot', figure=1)), 1)
+
+
+#a plotting function that saves numFigures figures of a line, or none (as plots skipped for too few points do)
+def drawLines(data, name, numFigures=1):
+    for i in range(numFigures):
+        fig = plt.figure(figsize=(0.2, 0.2))
+        plt.plot(data['values'])
+        screen_analysis.displayFigure(fig, name, {'name':name, 'figure':i})
+
+def failingPlot(data):
+    raise ValueError('plot failed')
+
+
+class PlotSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.plotDirectory = tempfile.mkdtemp()
+        self.savedSettings = (screen_analysis.plotDirectory, screen_analysis.plotWithPylab, screen_analysis.figureRegistry)
+
+    def tearDown(self):
+        screen_analysis.plotDirectory, screen_analysis.plotWithPylab, screen_analysis.figureRegistry = self.savedSettings
+        shutil.rmtree(self.plotDirectory)
+
+    #the figure files of each submission, the files in the plot directory and the index entries after drawing the jobs
+    def renderJobs(self, plotWorkers):
+        plotDirectory = os.path.join(self.plotDirectory, 'workers_%d' % plotWorkers)
+        os.mkdir(plotDirectory)
+        screen_analysis.changeDisplayFigureSettings(newDirectory=plotDirectory, newPlotWithPylab=False)
+
+        plotScheduler = screen_analysis.PlotScheduler(plotWorkers)
+        figureFileLists = [plotScheduler.submit({'values':[0, 1, 3]}, [(drawLines, ('plot_%d' % i,), {'numFigures':i % 3}) for i in range(7)]),
+            plotScheduler.submit({'values':[2, 1]}, [(drawLines, ('skipped',), {'numFigures':0}), (drawLines, ('last',), {})])]
+        plotScheduler.close()
+
+        indexEntries = [(entry['number'], entry['file'], entry['title'], entry['parameters']) for entry in screen_analysis.readFigureIndex(plotDirectory)]
+        return figureFileLists, sorted(os.listdir(plotDirectory)), indexEntries
+
+    #figures drawn by two workers get the file names and index entries of drawing them in this process, numbered from the
+    #figures saved so that jobs without figures leave no gaps
+    def testWorkersMatchSerial(self):
+        serialOutput = self.renderJobs(1)
+        workerOutput = self.renderJobs(2)
+
+        self.assertEqual(workerOutput, serialOutput)
+
+        figureFileLists, fileNames, indexEntries = serialOutput
+        self.assertEqual([entry[0] for entry in indexEntries], range(7))
+        self.assertEqual(figureFileLists[1], ['006_fig_last.png'])
+        self.assertEqual(sum(figureFileLists, []), [entry[1] for entry in indexEntries])
+        self.assertEqual(fileNames, sorted(sum(figureFileLists, []) + [screen_analysis.figureIndexFileName]))
+
+    #an error in a worker is raised by close, which stops the workers and leaves no unnumbered figures behind
+    def testWorkerErrorCleansUp(self):
+        screen_analysis.changeDisplayFigureSettings(newDirectory=self.plotDirectory, newPlotWithPylab=False)
+
+        plotScheduler = screen_analysis.PlotScheduler(2)
+        plotScheduler.submit({'values':[0, 1, 3]}, [(drawLines, ('plot_%d' % i,), {'numFigures':2}) for i in range(4)])
+        plotScheduler.submit({'values':[2, 1]}, [(drawLines, ('plot',), {}), (failingPlot, (), {})])
+
+        self.assertRaises(ValueError, plotScheduler.close)
+        self.assertFalse(any(fileName.startswith(screen_analysis.unnumberedFigurePrefix) for fileName in os.listdir(self.plotDirectory)))
+
+
+class BinaryFormatTest(unittest.TestCase):
+    def setUp(self):
+        self.savedModules = dict((name, sys.modules[name]) for name in ['feather', 'pyarrow', 'pyarrow.feather', 'pyarrow.parquet'] if name in sys.modules)
+        self.tableDirectory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in ['feather', 'pyarrow', 'pyarrow.feather', 'pyarrow.parquet']:
+            sys.modules.pop(name, None)
+        sys.modules.update(self.savedModules)
+        shutil.rmtree(self.tableDirectory)
+
+    #the feather-format package without a pyarrow that pandas can use does not make feather available
+    def testFeatherNeedsPyarrow(self):
+        sys.modules['feather'] = types.ModuleType('feather')
+        for name in ['pyarrow', 'pyarrow.feather', 'pyarrow.parquet']:
+            sys.modules[name] = None
+
+        self.assertEqual(screen_analysis.getBinaryFormat('auto'), 'npz')
+        self.assertEqual(screen_analysis.getBinaryFormat('feather'), 'npz')
+        self.assertEqual(screen_analysis.getBinaryFormat('off'), None)
+
+    #a gene table with three column levels and text columns with nans reads back from npz as it does from text
+    def testNpzMatchesText(self):
+        columns = pd.MultiIndex.from_tuples([('gamma','Rep1','KS'), ('gamma','Rep1','MW'), ('rho','ave_Rep1_Rep2','MW'), ('rho','ave_Rep1_Rep2','note')])
+        table = pd.DataFrame([[0.5, 1e-3, np.nan, 'a'], [-1.25, 0.2, 0.75, np.nan], [0.0, np.nan, 2.0, 'b']], 
+            index=pd.Index(['gene_a', 'gene_b', 'gene_c'], name='gene'), columns=columns)
+
+        tableName = os.path.join(self.tableDirectory, 'expt_genetable')
+        table.to_csv(tableName + '.txt', sep='\t')
+        textTable = screen_analysis.readTable(tableName, header=range(3), index_col=range(1))
+
+        screen_analysis.writeBinaryTable(textTable, tableName, 'npz')
+        binaryTable = screen_analysis.readTable(tableName, header=range(3), index_col=range(1))
+
+        self.assertTrue(os.path.exists(tableName + '.npz'))
+        self.assertTrue(binaryTable.index.equals(textTable.index))
+        self.assertTrue(binaryTable.columns.equals(textTable.columns))
+        self.assertEqual(binaryTable.columns.names, textTable.columns.names)
+        self.assertTrue(binaryTable.equals(textTable))
+
+
+class LibraryViewTest(unittest.TestCase):
+    #sublibrary names in several cases, negative controls and a gene and a transcript name that are missing
+    def setUp(self):
+        randomState = np.random.RandomState(0)
+        sublibraryNames = ['Kinase', 'kinase', 'KINASE', 'Phosphatase', 'Drug_Targets']
+        genes = ['negative_control'] * 5 + ['gene_%d' % i for i in range(8)]
+
+        libraryRows = [('sg_%d' % i, genes[randomState.randint(len(genes))], 'P%d' % randomState.randint(2), 
+            sublibraryNames[randomState.randint(len(sublibraryNames))]) for i in range(300)]
+        self.libraryTable = pd.DataFrame([row[1:] for row in libraryRows], index=[row[0] for row in libraryRows], columns=['gene', 'transcripts', 'sublibrary'])
+        self.libraryTable.loc[['sg_3', 'sg_4'], 'gene'] = np.nan
+        self.libraryTable.loc[['sg_5'], 'transcripts'] = np.nan
+
+    #sublibrary masks match the row by row test that processExperimentsFromConfig once applied
+    def testSublibraryMask(self):
+        for sublibraries in [['kinase'], ['kinase', 'phosphatase'], ['drug_targets', 'other'], []]:
+            expectedMask = self.libraryTable.apply(lambda row: row['sublibrary'].lower() in sublibraries, axis=1).values
+            self.assertTrue(np.array_equal(screen_analysis.getSublibraryMask(self.libraryTable, sublibraries), expectedMask))
+
+            libraryView = screen_analysis.LibraryView(self.libraryTable, sublibraries)
+            self.assertTrue(libraryView.table.equals(self.libraryTable[expectedMask]))
+
+    #gene codes and names give back each row's gene, the negative control mask and gene masks are those of comparing names
+    def testGeneCodes(self):
+        libraryView = screen_analysis.LibraryView(self.libraryTable, ['kinase', 'phosphatase'])
+        table = libraryView.table
+        hasGene = table['gene'].notnull().values
+
+        self.assertEqual(list(libraryView.geneNames), sorted(table['gene'].dropna().unique()))
+        self.assertTrue(np.array_equal(libraryView.geneNames[libraryView.geneCodes[hasGene]], table['gene'].values[hasGene]))
+        self.assertTrue(np.all(libraryView.geneCodes[~hasGene] == -1))
+        self.assertTrue(libraryView.negativeMask.equals(table['gene'] == 'negative_control'))
+
+        self.assertTrue(libraryView.geneMask('gene_1').equals(table['gene'] == 'gene_1'))
+        self.assertTrue(libraryView.geneMask(set(['gene_1', 'gene_5', 'not_a_gene'])).equals(table['gene'].isin(['gene_1', 'gene_5'])))
+
+        hasTranscript = hasGene & table['transcripts'].notnull().values
+        transcriptPairs = libraryView.transcriptNames[libraryView.transcriptCodes[hasTranscript]]
+        self.assertEqual(list(transcriptPairs), zip(table['gene'].values[hasTranscript], table['transcripts'].values[hasTranscript]))
+        self.assertEqual(list(libraryView.transcriptNames), sorted(set(transcriptPairs)))
+        self.assertTrue(np.all(libraryView.transcriptCodes[~hasTranscript] == -1))
+        self.assertTrue(np.array_equal(libraryView.geneNames[libraryView.transcriptGenes], libraryView.transcriptNames.get_level_values('gene')))
+
+    #appended rows are coded with the rest of the library
+    def testAppend(self):
+        libraryView = screen_analysis.LibraryView(self.libraryTable, ['kinase'])
+        extraTable = pd.DataFrame([['pseudo_1', 'pseudo_1', 'pseudo']], index=['pseudo_sg_1'], columns=['gene', 'transcripts', 'sublibrary'])
+        appendedView = libraryView.append(extraTable)
+
+        self.assertEqual(list(appendedView.table.index), list(libraryView.table.index) + ['pseudo_sg_1'])
+        self.assertTrue(appendedView.geneMask('pseudo_1').equals(pd.Series(appendedView.table.index == 'pseudo_sg_1', index=appendedView.table.index)))
+        self.assertTrue(appendedView.negativeMask.equals(appendedView.table['gene'] == 'negative_control'))
+
+
+if __name__ == '__main__':
+    unittest.main()